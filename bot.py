@@ -1,9 +1,16 @@
 import asyncio
+import base64
 import functools
+import heapq
+import html
+import io
+import itertools
 import logging
+import platform
 import random
 import re
 import time
+import weakref
 from typing import Optional, List, Dict, Any
 
 from aiogram import Bot, Dispatcher, Router, F, BaseMiddleware
@@ -15,15 +22,27 @@ from aiogram.types import (
 )
 from aiogram.filters import Command, CommandStart, CommandObject
 from aiogram.enums import ParseMode
-from aiogram.exceptions import TelegramBadRequest
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 
-from config import BOT_TOKEN, CLASSES, CRIMES, RANDOM_EVENTS, WELCOME_MESSAGES, JAIL_PHRASES
+from config import BOT_TOKEN, CLASSES, CRIMES, RANKS, RANDOM_EVENTS, WELCOME_MESSAGES, JAIL_PHRASES
 import aiohttp
 import json
 import os
 from dotenv import load_dotenv
+from collections import Counter
 from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
+
+try:
+    import orjson
+    json_loads = orjson.loads
+
+    def json_dumps(obj) -> str:
+        return orjson.dumps(obj).decode()
+except ImportError:  # orjson не установлен — стандартный парсер
+    json_loads = json.loads
+    json_dumps = json.dumps
 
 load_dotenv()
 
@@ -33,6 +52,12 @@ load_dotenv()
 _http_session: Optional[aiohttp.ClientSession] = None
 _http_session_lock = asyncio.Lock()
 
+# Пул соединений: API-хостов немного, держим keep-alive и кэш DNS
+HTTP_POOL_LIMIT = 100
+HTTP_POOL_LIMIT_PER_HOST = 20
+HTTP_DNS_CACHE_TTL = 300
+HTTP_KEEPALIVE_TIMEOUT = 75
+
 
 async def get_http_session() -> aiohttp.ClientSession:
     """Получить глобальную HTTP сессию (создаёт если нет, потокобезопасно)"""
@@ -42,9 +67,18 @@ async def get_http_session() -> aiohttp.ClientSession:
             # Double-check после получения блокировки
             if _http_session is None or _http_session.closed:
                 timeout = aiohttp.ClientTimeout(total=60, connect=10)
+                connector = aiohttp.TCPConnector(
+                    limit=HTTP_POOL_LIMIT,
+                    limit_per_host=HTTP_POOL_LIMIT_PER_HOST,
+                    ttl_dns_cache=HTTP_DNS_CACHE_TTL,
+                    keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+                    enable_cleanup_closed=True,
+                )
                 _http_session = aiohttp.ClientSession(
+                    connector=connector,
                     timeout=timeout,
-                    headers={"User-Agent": "TetaRozaBot/1.0"}
+                    headers={"User-Agent": "TetaRozaBot/1.0"},
+                    json_serialize=json_dumps,
                 )
     return _http_session
 
@@ -62,14 +96,17 @@ USE_POSTGRES = os.getenv("DATABASE_URL") or os.getenv("POSTGRES_URL")
 if USE_POSTGRES:
     from database_postgres import (
         init_db, get_player, create_player, set_player_class, update_player_stats,
-        get_top_players, is_in_jail, put_in_jail, get_all_active_players,
+        add_players_money,
+        get_top_players, put_in_jail, get_all_active_players,
         add_to_treasury, get_treasury, log_event, add_achievement,
         save_chat_message, get_chat_statistics, get_player_achievements, close_db,
+        queue_chat_message, queue_media, queue_chat_info, queue_treasury,
+        on_messages_written, start_write_buffers, stop_write_buffers,
         save_summary, get_previous_summaries, save_memory, get_memories,
         get_user_messages, full_cleanup, get_database_stats,
         get_all_chats_stats, get_chat_details, get_top_users_global, search_user,
         health_check, save_chat_info,
-        save_media, get_random_media, get_media_stats, increment_media_usage,
+        save_media, save_media_bulk, get_vk_media_keys, get_random_media, get_media_stats,
         migrate_media_from_messages,
         get_user_profile, get_user_gender, analyze_and_update_user_gender,
         update_user_gender_incrementally, update_user_profile_comprehensive,
@@ -82,7 +119,8 @@ if USE_POSTGRES:
 else:
     from database import (
         init_db, get_player, create_player, set_player_class, update_player_stats,
-        get_top_players, is_in_jail, put_in_jail, get_all_active_players,
+        add_players_money,
+        get_top_players, put_in_jail, get_all_active_players,
         add_to_treasury, get_treasury, log_event, add_achievement,
         save_chat_message, get_chat_statistics, get_player_achievements,
         save_summary, get_previous_summaries, save_memory, get_memories,
@@ -91,18 +129,26 @@ else:
     )
     close_db = None
     # Заглушки для SQLite
+    queue_chat_message = save_chat_message
+    queue_treasury = add_to_treasury
+    def start_write_buffers(): pass
+    def on_messages_written(callback): pass
+    async def stop_write_buffers(): pass
     async def full_cleanup(): return {}
     async def get_database_stats(): return {}
-    async def get_all_chats_stats(): return []
-    async def get_chat_details(chat_id): return {}
+    async def get_all_chats_stats(limit=50): return []
+    async def get_chat_details(chat_id, top_limit=10): return {}
     async def get_top_users_global(limit=20): return []
     async def search_user(query): return []
     async def health_check(): return False
     async def save_chat_info(chat_id, title=None, username=None, chat_type=None): pass
+    queue_chat_info = save_chat_info
     async def save_media(chat_id, user_id, file_id, file_type, file_unique_id=None, description=None, caption=None): return False
+    queue_media = save_media
+    async def save_media_bulk(rows): return 0
+    async def get_vk_media_keys(chat_id): return set()
     async def get_random_media(chat_id, file_type=None): return None
     async def get_media_stats(chat_id): return {'total': 0}
-    async def increment_media_usage(media_id): pass
     async def migrate_media_from_messages(): return {'migrated': 0, 'skipped': 0, 'errors': 0}
     # Заглушки для профилирования пользователей (только PostgreSQL)
     async def get_user_profile(user_id, chat_id=None): return None
@@ -135,11 +181,40 @@ logger = logging.getLogger(__name__)
 bot = Bot(token=BOT_TOKEN)
 dp = Dispatcher()
 router = Router()
-scheduler = AsyncIOScheduler()
+# Задачи не копятся: пропущенные запуски схлопываются в один, без параллельных копий
+scheduler = AsyncIOScheduler(job_defaults={
+    "coalesce": True,
+    "max_instances": 1,
+    "misfire_grace_time": 600,
+})
 
 # Хранение активных событий и кулдаунов
 active_events = {}  # chat_id -> event_data
-cooldowns = {}  # (user_id, chat_id, action) -> timestamp
+cooldowns = {}  # _cooldown_key(user_id, chat_id, action, subject) -> timestamp
+# Куча (timestamp, key) для очистки без обхода всего словаря; устаревшие
+# записи (ключ перезаписан или снят через reset_cooldown) просто пропускаются
+_cooldown_heap: list = []
+# Очистка идёт в планировщике порциями, между порциями отдаём управление циклу
+MEMORY_CLEANUP_CHUNK = 10_000
+
+# Ключи кулдаунов и rate limit — одно int вместо кортежа со строкой.
+# Поля не перекрываются, поэтому коллизий нет (id берём как uint64)
+_INT64_MASK = (1 << 64) - 1
+# action -> номер, выдаётся при первом использовании. Имена действий — только
+# константы из кода: переменную часть (цель, номер дела) передаём в subject,
+# иначе словарь рос бы с каждой новой целью
+_ACTION_IDS: Dict[str, int] = {}
+
+
+def _cooldown_key(user_id: int, chat_id: int, action: str, subject: int = 0) -> int:
+    """Упаковать (user_id, chat_id, action, subject) в один int-ключ"""
+    action_id = _ACTION_IDS.get(action)
+    if action_id is None:
+        action_id = _ACTION_IDS[action] = len(_ACTION_IDS)
+    # action_id — в старших битах: ширина не ограничена, коллизий нет при любом числе действий
+    key = (action_id << 64) | (subject & _INT64_MASK)
+    key = (key << 64) | (user_id & _INT64_MASK)
+    return (key << 64) | (chat_id & _INT64_MASK)
 
 # ==================== ЗАЩИТА ОТ КОМАНД В РЕПЛАЙ НА БОТА ====================
 
@@ -236,9 +311,10 @@ async def check_command_reply_to_bot(message: Message) -> bool:
     return True
 
 
-def check_cooldown(user_id: int, chat_id: int, action: str, cooldown_seconds: int) -> tuple[bool, int]:
-    """Проверить кулдаун. Возвращает (можно_ли, оставшееся_время)"""
-    key = (user_id, chat_id, action)
+def check_cooldown(user_id: int, chat_id: int, action: str, cooldown_seconds: int,
+                   subject: int = 0) -> tuple[bool, int]:
+    """Проверить кулдаун (subject — цель или вариант действия). Возвращает (можно_ли, оставшееся_время)"""
+    key = _cooldown_key(user_id, chat_id, action, subject)
     current_time = time.time()
     
     if key in cooldowns:
@@ -246,95 +322,122 @@ def check_cooldown(user_id: int, chat_id: int, action: str, cooldown_seconds: in
         if remaining > 0:
             return False, int(remaining)
     
-    cooldowns[key] = current_time + cooldown_seconds
-    
-    # Очистка старых записей (раз в 100 записей или каждые 500 записей)
-    if len(cooldowns) > 500 or (len(cooldowns) > 100 and len(cooldowns) % 50 == 0):
-        cleanup_cooldowns()
-    
+    expires = current_time + cooldown_seconds
+    cooldowns[key] = expires
+    heapq.heappush(_cooldown_heap, (expires, key))
     return True, 0
 
 
-def cleanup_cooldowns():
-    """Удалить истёкшие кулдауны"""
-    current_time = time.time()
-    expired_keys = [k for k, v in cooldowns.items() if v < current_time]
-    for key in expired_keys:
-        del cooldowns[key]
+def reset_cooldown(user_id: int, chat_id: int, action: str, subject: int = 0):
+    """Снять кулдаун (действие не выполнилось)"""
+    cooldowns.pop(_cooldown_key(user_id, chat_id, action, subject), None)
 
 
-def cleanup_api_calls():
-    """Удалить устаревшие записи API вызовов"""
+async def cleanup_cooldowns():
+    """Удалить истёкшие кулдауны"""
+    current_time = time.time()
+    popped = 0
+    while _cooldown_heap and _cooldown_heap[0][0] < current_time:
+        expires, key = heapq.heappop(_cooldown_heap)
+        if cooldowns.get(key) == expires:
+            del cooldowns[key]
+        popped += 1
+        if popped % MEMORY_CLEANUP_CHUNK == 0:
+            await asyncio.sleep(0)
+
+
+async def cleanup_api_buckets():
+    """Удалить вёдра rate limit, которые уже успели наполниться до конца"""
     current_time = time.time()
-    for key in list(api_calls.keys()):
-        if key in api_calls:
-            # Удаляем записи старше 5 минут
-            api_calls[key] = [t for t in api_calls[key] if current_time - t < 300]
-            # Если список пустой — удаляем ключ
-            if not api_calls[key]:
-                del api_calls[key]
+    for i, key in enumerate(list(api_buckets.keys()), 1):
+        # За окно простоя ведро полностью восполняется — оно не отличается от нового
+        bucket = api_buckets.get(key)
+        if bucket is not None and current_time - bucket[1] >= _API_WINDOWS[key & 0xFF]:
+            del api_buckets[key]
+        if i % MEMORY_CLEANUP_CHUNK == 0:
+            await asyncio.sleep(0)
 
 
 # ==================== УТИЛИТЫ ====================
 
+# Ссылки на фоновые задачи, чтобы их не собрал GC до завершения
+_background_tasks: set = set()
+
+
+def spawn_background(coro) -> asyncio.Task:
+    """Запустить корутину в фоне (fire-and-forget) с удержанием ссылки на задачу"""
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+
 def split_long_message(text: str, max_length: int = 4000) -> list[str]:
     """
     Безопасно разбивает длинный текст на части.
-    Разрезает по границам абзацев или предложений, не посередине слов/HTML-тегов.
+    Режет по последней границе абзаца/строки/предложения/слова перед лимитом,
+    не посередине слов/HTML-тегов. Один rfind на часть — без склеек строк.
     """
     if len(text) <= max_length:
         return [text]
     
     parts = []
-    current = ""
-    
-    # Сначала пробуем разбить по абзацам
-    paragraphs = text.split('\n\n')
-    
-    for para in paragraphs:
-        if len(current) + len(para) + 2 <= max_length:
-            current = current + "\n\n" + para if current else para
-        else:
-            # Если абзац слишком длинный, разбиваем по предложениям
-            if len(para) > max_length:
-                if current:
-                    parts.append(current.strip())
-                    current = ""
-                
-                # Разбиваем абзац по предложениям
-                sentences = para.replace('. ', '.|').replace('! ', '!|').replace('? ', '?|').split('|')
-                for sent in sentences:
-                    if len(current) + len(sent) + 1 <= max_length:
-                        current = current + " " + sent if current else sent
-                    else:
-                        if current:
-                            parts.append(current.strip())
-                        # Если предложение слишком длинное, режем по словам
-                        if len(sent) > max_length:
-                            words = sent.split(' ')
-                            current = ""
-                            for word in words:
-                                if len(current) + len(word) + 1 <= max_length:
-                                    current = current + " " + word if current else word
-                                else:
-                                    if current:
-                                        parts.append(current.strip())
-                                    current = word
-                        else:
-                            current = sent
-            else:
-                if current:
-                    parts.append(current.strip())
-                current = para
-    
-    if current:
-        parts.append(current.strip())
+    half = max_length // 2
+    
+    while len(text) > max_length:
+        # Ищем самую «крупную» границу, но не раньше середины окна
+        cut = text.rfind('\n\n', 0, max_length)
+        if cut < half:
+            cut = text.rfind('\n', 0, max_length)
+        if cut < half:
+            cut = max(text.rfind('. ', 0, max_length), text.rfind('! ', 0, max_length),
+                      text.rfind('? ', 0, max_length))
+            if cut >= half:
+                cut += 1  # Знак препинания остаётся в текущей части
+        if cut < half:
+            cut = text.rfind(' ', 0, max_length)
+        if cut <= 0:
+            # Одно гигантское слово — режем жёстко
+            cut = max_length
+        
+        part = text[:cut].strip()
+        if part:
+            parts.append(part)
+        text = text[cut:].lstrip()
+    
+    text = text.strip()
+    if text:
+        parts.append(text)
     
     return parts if parts else [text[:max_length]]
 
 
 # ==================== СБОР КОНТЕКСТА (DRY) ====================
 
+# Кэш контекста для AI-команд подряд {(chat_id, user_id): (expires_ts, limit, result)}.
+# Запись сбрасывается, когда новое сообщение пользователя реально попало в БД
+USER_CONTEXT_TTL = 60
+USER_CONTEXT_ERROR_TTL = 5  # после ошибки БД — ненадолго, чтобы не долбить её каждым сообщением
+USER_CONTEXT_CACHE_MAX = 1000
+_user_context_cache: dict = {}
+# Идущие выборки {(chat_id, user_id): [сколько выборок, был ли сброс]} — результат
+# выборки, во время которой пришли новые сообщения, в кэш не кладём
+_user_context_fetching: dict = {}
+
+
+def _invalidate_user_contexts(rows):
+    """Сбросить контекст авторов записанных сообщений (строки chat_messages)"""
+    for row in rows:
+        key = (row[0], row[1])
+        _user_context_cache.pop(key, None)
+        state = _user_context_fetching.get(key)
+        if state is not None:
+            state[1] = True
+
+
+on_messages_written(_invalidate_user_contexts)
+
+
 async def gather_user_context(chat_id: int, user_id: int, limit: int = 1000) -> tuple[str, int]:
     """
     Собирает контекст сообщений пользователя для AI-команд.
@@ -347,6 +450,17 @@ async def gather_user_context(chat_id: int, user_id: int, limit: int = 1000) ->
     if not USE_POSTGRES:
         return "Сообщений нет — база данных недоступна", 0
     
+    key = (chat_id, user_id)
+    now = time.monotonic()
+    entry = _user_context_cache.pop(key, None)
+    if entry is not None and entry[0] > now and entry[1] == limit:
+        # Переставляем в конец — вытесняются давно не запрошенные
+        _user_context_cache[key] = entry
+        return entry[2]
+    
+    ttl = USER_CONTEXT_TTL
+    state = _user_context_fetching.setdefault(key, [0, False])
+    state[0] += 1
     try:
         user_messages = await get_user_messages(chat_id, user_id, limit=limit)
         if user_messages:
@@ -362,26 +476,44 @@ async def gather_user_context(chat_id: int, user_id: int, limit: int = 1000) ->
                 # - 20 самых длинных (информативных)
                 # - 15 последних (актуальных)
                 # - 5 случайных из середины (для разнообразия)
-                interesting = sorted(texts, key=len, reverse=True)[:20]
-                recent = texts[:15]
+                # nlargest — O(N log k) без полной сортировки всей истории
+                all_texts = heapq.nlargest(20, texts, key=len)
+                seen = set(all_texts)
                 
                 # Случайные из середины (если есть)
                 middle_texts = texts[15:-20] if len(texts) > 35 else []
-                import random
                 random_middle = random.sample(middle_texts, min(5, len(middle_texts))) if middle_texts else []
                 
-                all_texts = list(dict.fromkeys(interesting + recent + random_middle))[:40]
+                # Добавляем последние и случайные без повторов, сохраняя порядок
+                for text in itertools.chain(texts[:15], random_middle):
+                    if text not in seen:
+                        seen.add(text)
+                        all_texts.append(text)
                 
                 for i, text in enumerate(all_texts, 1):
-                    truncated = text[:200] + "..." if len(text) > 200 else text
-                    context_parts.append(f'{i}. "{truncated}"')
+                    context_parts.append(f'{i}. "{text if len(text) <= 200 else text[:200] + "..."}"')
     except Exception as e:
         logger.warning(f"Could not fetch user messages: {e}")
+        # Уже собранное не выбрасываем; результат кэшируем ненадолго
+        ttl = USER_CONTEXT_ERROR_TTL
+    finally:
+        state[0] -= 1
+        if state[0] == 0:
+            del _user_context_fetching[key]
     
     if context_parts:
-        return "\n".join(context_parts), messages_found
+        result = "\n".join(context_parts), messages_found
     else:
-        return "Сообщений нет — молчит как партизан", 0
+        # Пустой результат тоже кэшируем, чтобы не дёргать БД для молчунов
+        result = "Сообщений нет — молчит как партизан", 0
+    
+    if state[1]:
+        # Пока читали, появились новые сообщения — результат уже неполный
+        return result
+    _user_context_cache[key] = (now + ttl, limit, result)
+    while len(_user_context_cache) > USER_CONTEXT_CACHE_MAX:
+        del _user_context_cache[next(iter(_user_context_cache))]
+    return result
 
 
 async def gather_user_memory(chat_id: int, user_id: int, user_name: str = "") -> str:
@@ -488,7 +620,7 @@ async def gather_user_memory(chat_id: int, user_id: int, user_name: str = "") ->
 # ==================== RATE LIMITER ДЛЯ API ====================
 
 # Глобальный счётчик API вызовов (защита от спама)
-api_calls = {}  # (chat_id, api_type) -> [timestamps]
+api_buckets = {}  # упакованный (chat_id, api_type) -> [токены, время последнего пополнения]
 API_LIMITS = {
     "poem": (5, 60),      # 5 вызовов в минуту на чат
     "diagnosis": (5, 60),
@@ -500,6 +632,8 @@ API_LIMITS = {
     "ventilate": (10, 60),  # 10 проветриваний в минуту
     "dream": (5, 60),     # 5 снов в минуту на чат
 }
+_API_TYPE_IDS = {api_type: i for i, api_type in enumerate(API_LIMITS)}
+_API_WINDOWS = tuple(window for _, window in API_LIMITS.values())
 
 
 def check_api_rate_limit(chat_id: int, api_type: str) -> tuple[bool, int]:
@@ -507,27 +641,30 @@ def check_api_rate_limit(chat_id: int, api_type: str) -> tuple[bool, int]:
     Проверить rate limit для API.
     Возвращает (можно_ли, секунд_до_сброса)
     """
-    if api_type not in API_LIMITS:
+    api_id = _API_TYPE_IDS.get(api_type)
+    if api_id is None:
         return True, 0
     
     max_calls, window_seconds = API_LIMITS[api_type]
-    key = (chat_id, api_type)
+    key = ((chat_id & _INT64_MASK) << 8) | api_id
     current_time = time.time()
     
-    # Очищаем старые записи
-    if key in api_calls:
-        api_calls[key] = [t for t in api_calls[key] if current_time - t < window_seconds]
+    # Token bucket: max_calls токенов, пополняются равномерно за window_seconds
+    bucket = api_buckets.get(key)
+    if bucket is None:
+        bucket = api_buckets[key] = [float(max_calls), current_time]
     else:
-        api_calls[key] = []
+        refill = (current_time - bucket[1]) * max_calls / window_seconds
+        bucket[0] = min(max_calls, bucket[0] + refill)
+        bucket[1] = current_time
     
     # Проверяем лимит
-    if len(api_calls[key]) >= max_calls:
-        oldest = min(api_calls[key])
-        wait_time = int(window_seconds - (current_time - oldest))
-        return False, max(1, wait_time)
+    if bucket[0] < 1:
+        wait_time = (1 - bucket[0]) * window_seconds / max_calls
+        return False, max(1, int(wait_time))
     
-    # Добавляем текущий вызов
-    api_calls[key].append(current_time)
+    # Списываем токен за текущий вызов
+    bucket[0] -= 1
     return True, 0
 
 
@@ -536,16 +673,16 @@ def check_api_rate_limit(chat_id: int, api_type: str) -> tuple[bool, int]:
 class BotMetrics:
     """Простые метрики для мониторинга"""
     def __init__(self):
-        self.commands_count = {}  # command -> count
-        self.api_calls_count = {}  # api_type -> count
+        self.commands_count = Counter()  # command -> count
+        self.api_calls_count = Counter()  # api_type -> count
         self.errors_count = 0
         self.start_time = time.time()
     
     def track_command(self, command: str):
-        self.commands_count[command] = self.commands_count.get(command, 0) + 1
+        self.commands_count[command] += 1
     
     def track_api_call(self, api_type: str):
-        self.api_calls_count[api_type] = self.api_calls_count.get(api_type, 0) + 1
+        self.api_calls_count[api_type] += 1
     
     def track_error(self):
         self.errors_count += 1
@@ -556,7 +693,7 @@ class BotMetrics:
             "uptime_seconds": uptime,
             "uptime_human": f"{uptime // 3600}ч {(uptime % 3600) // 60}м",
             "total_commands": sum(self.commands_count.values()),
-            "top_commands": sorted(self.commands_count.items(), key=lambda x: -x[1])[:5],
+            "top_commands": self.commands_count.most_common(5),
             "total_api_calls": sum(self.api_calls_count.values()),
             "api_calls": self.api_calls_count,
             "errors": self.errors_count
@@ -567,11 +704,7 @@ metrics = BotMetrics()
 
 # ==================== КОМАНДЫ ====================
 
-@router.message(CommandStart())
-async def cmd_start(message: Message):
-    """Начало игры — РАЗЪЁБ приветствие"""
-    if message.chat.type == "private":
-        welcome_private = """
+WELCOME_PRIVATE_TEXT = """
 🦯 *ХРОМАЯ ШЛЮХА ТЁТЯ РОЗА*
 
 Здарова. Я Тётя Роза — пьяная цыганка-астролог из соседнего подъезда.
@@ -590,13 +723,11 @@ async def cmd_start(message: Message):
 
 _Бот разработан каналом_ [Чернила и Кровь](https://t.me/dark_bookshelf)
 """
-        await message.answer(welcome_private, parse_mode=ParseMode.MARKDOWN)
-        return
-    
-    welcome_group = f"""
+
+WELCOME_GROUP_TEMPLATE = """
 🦯 *ХРОМАЯ ШЛЮХА ТЁТЯ РОЗА*
 
-{message.from_user.first_name}, ты попал.
+{name}, ты попал.
 
 Тётя Роза — пьяная цыганка-астролог из соседнего подъезда — теперь живёт в этом чате. Она видит каждое твоё сообщение. Каждую фотку. Каждый стикер. Она запоминает. Она ждёт.
 
@@ -609,9 +740,28 @@ _Бот разработан каналом_ [Чернила и Кровь](http
 ━━━━━━━━━━━━━━━━━━━━━━━━
 _Бот разработан каналом_ [Чернила и Кровь](https://t.me/dark_bookshelf)
 """
+
+TOP_KEYBOARD = InlineKeyboardMarkup(inline_keyboard=[
+    [
+        InlineKeyboardButton(text="⭐ По опыту", callback_data="top_experience"),
+        InlineKeyboardButton(text="💰 По лавэ", callback_data="top_money")
+    ],
+    [
+        InlineKeyboardButton(text="🎯 По делам", callback_data="top_crimes_success"),
+        InlineKeyboardButton(text="⚔️ По PvP", callback_data="top_pvp_wins")
+    ]
+])
+
+
+@router.message(CommandStart())
+async def cmd_start(message: Message):
+    """Начало игры — РАЗЪЁБ приветствие"""
+    if message.chat.type == "private":
+        await message.answer(WELCOME_PRIVATE_TEXT, parse_mode=ParseMode.MARKDOWN)
+        return
     
     await message.answer(
-        welcome_group,
+        WELCOME_GROUP_TEMPLATE.format(name=message.from_user.first_name),
         parse_mode=ParseMode.MARKDOWN,
         disable_web_page_preview=True
     )
@@ -700,21 +850,10 @@ async def cmd_top(message: Message):
     
     chat_id = message.chat.id
     
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [
-            InlineKeyboardButton(text="⭐ По опыту", callback_data="top_experience"),
-            InlineKeyboardButton(text="💰 По лавэ", callback_data="top_money")
-        ],
-        [
-            InlineKeyboardButton(text="🎯 По делам", callback_data="top_crimes_success"),
-            InlineKeyboardButton(text="⚔️ По PvP", callback_data="top_pvp_wins")
-        ]
-    ])
-    
     players = await get_top_players(chat_id, limit=10, sort_by="experience")
     text = format_top_players(players, "experience")
     
-    await message.answer(text, reply_markup=keyboard)
+    await message.answer(text, reply_markup=TOP_KEYBOARD)
 
 
 @router.callback_query(F.data.startswith("top_"))
@@ -723,27 +862,45 @@ async def show_top(callback: CallbackQuery):
     sort_by = callback.data.replace("top_", "")
     chat_id = callback.message.chat.id
     
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [
-            InlineKeyboardButton(text="⭐ По опыту", callback_data="top_experience"),
-            InlineKeyboardButton(text="💰 По лавэ", callback_data="top_money")
-        ],
-        [
-            InlineKeyboardButton(text="🎯 По делам", callback_data="top_crimes_success"),
-            InlineKeyboardButton(text="⚔️ По PvP", callback_data="top_pvp_wins")
-        ]
-    ])
-    
     players = await get_top_players(chat_id, limit=10, sort_by=sort_by)
     text = format_top_players(players, sort_by)
     
     try:
-        await callback.message.edit_text(text, reply_markup=keyboard)
+        await callback.message.edit_text(text, reply_markup=TOP_KEYBOARD)
     except TelegramBadRequest:
-        await callback.message.answer(text, reply_markup=keyboard)
+        await callback.message.answer(text, reply_markup=TOP_KEYBOARD)
     await callback.answer()
 
 
+# Строки дел не меняются — рендерим один раз по позиции в CRIMES
+_CRIME_LINES = tuple(
+    f"{c['name']}\n"
+    f"  💰 {c['min_reward']}-{c['max_reward']} лавэ | "
+    f"🎯 {c['success_rate']}% | ⏰ КД {c['cooldown']}с"
+    for c in CRIMES
+)
+_CRIME_BUTTONS = tuple(
+    InlineKeyboardButton(text=f"{c['name']} (ур.{c['min_level']}+)", callback_data=f"crime_{i}")
+    for i, c in enumerate(CRIMES)
+)
+
+
+def _build_crime_menu(player_level: int) -> tuple:
+    """Клавиатура и текст доступных дел для уровня — за один проход по CRIMES"""
+    buttons = []
+    lines = []
+    for i, crime in enumerate(CRIMES):
+        if crime['min_level'] > player_level:
+            continue
+        buttons.append([_CRIME_BUTTONS[i]])
+        lines.append(_CRIME_LINES[i])
+    return InlineKeyboardMarkup(inline_keyboard=buttons), "\n".join(lines)
+
+
+# Меню дел зависит только от уровня — строим заранее для всех рангов
+_CRIME_MENUS = {rank['level']: _build_crime_menu(rank['level']) for rank in RANKS}
+
+
 @router.message(Command("crime", "delo", "work"))
 async def cmd_crime(message: Message):
     """Пойти на дело"""
@@ -759,34 +916,19 @@ async def cmd_crime(message: Message):
         await message.answer("❌ Сначала вступи в гильдию! /start")
         return
     
-    # Проверка тюрьмы
-    in_jail, remaining = await is_in_jail(user_id, chat_id)
-    if in_jail:
+    # Проверка тюрьмы — jail_until уже есть в строке игрока, второй запрос не нужен
+    remaining = (player.get('jail_until') or 0) - int(time.time())
+    if remaining > 0:
         phrase = random.choice(JAIL_PHRASES).format(time=remaining)
         await message.answer(phrase)
         return
     
     # Показываем доступные дела
-    rank = get_rank(player['experience'])
-    player_level = rank['level']
-    
-    available_crimes = [c for c in CRIMES if c['min_level'] <= player_level]
-    
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(
-            text=f"{crime['name']} (ур.{crime['min_level']}+)",
-            callback_data=f"crime_{i}"
-        )]
-        for i, crime in enumerate(CRIMES)
-        if crime['min_level'] <= player_level
-    ])
-    
-    crimes_text = "\n".join([
-        f"{crime['name']}\n"
-        f"  💰 {crime['min_reward']}-{crime['max_reward']} лавэ | "
-        f"🎯 {crime['success_rate']}% | ⏰ КД {crime['cooldown']}с"
-        for crime in available_crimes
-    ])
+    player_level = get_rank(player['experience'])['level']
+    menu = _CRIME_MENUS.get(player_level)
+    if menu is None:
+        menu = _build_crime_menu(player_level)
+    keyboard, crimes_text = menu
     
     await message.answer(
         f"🔫 *ВЫБЕРИ ДЕЛО:*\n\n{crimes_text}",
@@ -829,6 +971,16 @@ async def next_meme_callback(callback: CallbackQuery):
         await callback.answer("Ошибка загрузки мема", show_alert=True)
 
 
+async def grant_achievements(user_id: int, player: Dict[str, Any]) -> list:
+    """Выдать заслуженные достижения (запись параллельно), вернуть только новые"""
+    achievements = check_achievements(player)
+    if not achievements:
+        return []
+    # check_achievements отдаёт и уже полученные — add_achievement вернёт для них False
+    granted = await asyncio.gather(*(add_achievement(user_id, ach_id) for ach_id, _ in achievements))
+    return [ach_data for (_, ach_data), ok in zip(achievements, granted) if ok]
+
+
 @router.callback_query(F.data.startswith("crime_"))
 async def do_crime(callback: CallbackQuery):
     """Выполнить преступление"""
@@ -857,14 +1009,14 @@ async def do_crime(callback: CallbackQuery):
         await callback.answer(f"❌ Нужен уровень {crime['min_level']}!", show_alert=True)
         return
     
-    # Проверка тюрьмы
-    in_jail, remaining = await is_in_jail(user_id, chat_id)
-    if in_jail:
+    # Проверка тюрьмы — jail_until уже есть в строке игрока, второй запрос не нужен
+    remaining = (player.get('jail_until') or 0) - int(time.time())
+    if remaining > 0:
         await callback.answer(f"⛓️ Ты в тюрьме ещё {remaining} сек!", show_alert=True)
         return
     
     # Проверка кулдауна
-    can_do, cooldown_remaining = check_cooldown(user_id, chat_id, f"crime_{crime_index}", crime['cooldown'])
+    can_do, cooldown_remaining = check_cooldown(user_id, chat_id, "crime", crime['cooldown'], subject=crime_index)
     if not can_do:
         await callback.answer(f"⏰ Подожди ещё {cooldown_remaining} сек!", show_alert=True)
         return
@@ -876,18 +1028,18 @@ async def do_crime(callback: CallbackQuery):
         reward = calculate_crime_reward(crime, player)
         exp_gain = get_experience_for_action("crime_medium", True)
         
-        # Обновляем статистику
-        await update_player_stats(
-            user_id, chat_id,
-            money=f"+{reward}",
-            experience=f"+{exp_gain}",
-            crimes_success=f"+1",
-            total_stolen=f"+{reward}"
-        )
-        
-        # 10% идёт в общак
+        # Обновляем статистику, 10% идёт в общак — независимые записи
         treasury_cut = int(reward * 0.1)
-        await add_to_treasury(chat_id, treasury_cut)
+        await asyncio.gather(
+            update_player_stats(
+                user_id, chat_id,
+                money=f"+{reward}",
+                experience=f"+{exp_gain}",
+                crimes_success=f"+1",
+                total_stolen=f"+{reward}"
+            ),
+            queue_treasury(chat_id, treasury_cut),
+        )
         
         crime_msg = get_random_crime_message(crime, True, reward=reward)
         
@@ -899,17 +1051,20 @@ async def do_crime(callback: CallbackQuery):
             f"🏦 {treasury_cut} ушло в общак"
         )
         
-        # Проверяем достижения
-        updated_player = await get_player(user_id, chat_id)
-        achievements = check_achievements(updated_player)
-        for ach_id, ach_data in achievements:
-            if await add_achievement(user_id, ach_id):
-                result_text += f"\n\n🏆 *НОВОЕ ДОСТИЖЕНИЕ!*\n{ach_data['name']}"
+        # Проверяем достижения — применяем дельты к уже прочитанной строке
+        updated_player = {
+            **player,
+            'money': player['money'] + reward,
+            'experience': player['experience'] + exp_gain,
+            'crimes_success': player['crimes_success'] + 1,
+            'total_stolen': player['total_stolen'] + reward,
+        }
+        for ach_data in await grant_achievements(user_id, updated_player):
+            result_text += f"\n\n🏆 *НОВОЕ ДОСТИЖЕНИЕ!*\n{ach_data['name']}"
         
-        # Проверяем повышение ранга
-        old_rank = get_rank(player['experience'])
+        # Проверяем повышение ранга (текущий ранг уже посчитан при проверке уровня)
         new_rank = get_rank(updated_player['experience'])
-        if new_rank['level'] > old_rank['level']:
+        if new_rank['level'] > rank['level']:
             result_text += f"\n\n🎉 *ПОВЫШЕНИЕ!*\nТеперь ты {new_rank['name']}!"
     
     else:
@@ -917,11 +1072,13 @@ async def do_crime(callback: CallbackQuery):
         jail_time = crime['jail_time']
         exp_gain = get_experience_for_action("crime_medium", False)
         
-        await put_in_jail(user_id, chat_id, jail_time)
-        await update_player_stats(
-            user_id, chat_id,
-            crimes_fail=f"+1",
-            experience=f"+{exp_gain}"
+        await asyncio.gather(
+            put_in_jail(user_id, chat_id, jail_time),
+            update_player_stats(
+                user_id, chat_id,
+                crimes_fail=f"+1",
+                experience=f"+{exp_gain}"
+            ),
         )
         
         crime_msg = get_random_crime_message(crime, False, jail=jail_time)
@@ -940,6 +1097,14 @@ async def do_crime(callback: CallbackQuery):
     await callback.answer()
 
 
+MENTION_TYPES = frozenset({"mention", "text_mention"})
+
+
+def first_mention(entities):
+    """Первое упоминание пользователя среди entities (или None)"""
+    return next((e for e in entities if e.type in MENTION_TYPES), None)
+
+
 @router.message(Command("attack", "naezd", "rob"))
 async def cmd_attack(message: Message):
     """Наехать на другого игрока"""
@@ -955,53 +1120,48 @@ async def cmd_attack(message: Message):
         await message.answer("❌ Сначала вступи в гильдию! /start")
         return
     
-    # Проверка тюрьмы
-    in_jail, remaining = await is_in_jail(user_id, chat_id)
-    if in_jail:
+    # Проверка тюрьмы — jail_until уже есть в строке игрока, второй запрос не нужен
+    remaining = (player.get('jail_until') or 0) - int(time.time())
+    if remaining > 0:
         phrase = random.choice(JAIL_PHRASES).format(time=remaining)
         await message.answer(phrase)
         return
     
-    # Проверка кулдауна
-    can_do, cooldown_remaining = check_cooldown(user_id, chat_id, "attack", 60)
-    if not can_do:
-        await message.answer(f"⏰ Братиш, не гони! Подожди {cooldown_remaining} сек")
-        return
-    
     # Определяем жертву
     victim_user = None
     
     if message.reply_to_message and message.reply_to_message.from_user:
         victim_user = message.reply_to_message.from_user
     elif message.entities:
-        for entity in message.entities:
-            if entity.type == "mention":
-                # Тут нужно получить пользователя по username - сложно без кеша
-                pass
+        # text_mention несёт пользователя целиком; @username без кеша не резолвим
+        mention = first_mention(message.entities)
+        if mention is not None and mention.user:
+            victim_user = mention.user
     
     if not victim_user:
         await message.answer(
             "❌ На кого наезжать-то?\n"
             "Ответь на сообщение жертвы или упомяни её!"
         )
-        # Сбрасываем кулдаун, так как действие не выполнено
-        cooldowns.pop((user_id, chat_id, "attack"), None)
         return
     
     if victim_user.id == user_id:
         await message.answer("🤡 Сам на себя наезжать? Ты чё, дурак?")
-        cooldowns.pop((user_id, chat_id, "attack"), None)
         return
     
     if victim_user.is_bot:
         await message.answer("🤖 На ботов не наезжают, это западло!")
-        cooldowns.pop((user_id, chat_id, "attack"), None)
         return
     
     victim = await get_player(victim_user.id, chat_id)
     if not victim or not victim['player_class']:
         await message.answer("❌ Этот лох не в криминале! Нечего брать.")
-        cooldowns.pop((user_id, chat_id, "attack"), None)
+        return
+    
+    # Кулдаун ставим только когда жертва валидна — откатывать ничего не нужно
+    can_do, cooldown_remaining = check_cooldown(user_id, chat_id, "attack", 60)
+    if not can_do:
+        await message.answer(f"⏰ Братиш, не гони! Подожди {cooldown_remaining} сек")
         return
     
     # Проверяем, есть ли что брать
@@ -1023,21 +1183,21 @@ async def cmd_attack(message: Message):
         steal_amount = calculate_pvp_steal_amount(victim)
         exp_gain = get_experience_for_action("pvp_win", True)
         
-        # Обновляем атакующего
-        await update_player_stats(
-            user_id, chat_id,
-            money=f"+{steal_amount}",
-            experience=f"+{exp_gain}",
-            pvp_wins=f"+1",
-            total_stolen=f"+{steal_amount}"
-        )
-        
-        # Обновляем жертву
-        await update_player_stats(
-            victim_user.id, chat_id,
-            money=f"-{steal_amount}",
-            pvp_losses=f"+1",
-            total_lost=f"+{steal_amount}"
+        # Обновляем атакующего и жертву параллельно
+        await asyncio.gather(
+            update_player_stats(
+                user_id, chat_id,
+                money=f"+{steal_amount}",
+                experience=f"+{exp_gain}",
+                pvp_wins=f"+1",
+                total_stolen=f"+{steal_amount}"
+            ),
+            update_player_stats(
+                victim_user.id, chat_id,
+                money=f"-{steal_amount}",
+                pvp_losses=f"+1",
+                total_lost=f"+{steal_amount}"
+            ),
         )
         
         msg = get_random_attack_message(
@@ -1051,24 +1211,23 @@ async def cmd_attack(message: Message):
         
         # Проверяем достижения
         updated_player = await get_player(user_id, chat_id)
-        achievements = check_achievements(updated_player)
-        for ach_id, ach_data in achievements:
-            if await add_achievement(user_id, ach_id):
-                result_text += f"\n\n🏆 *ДОСТИЖЕНИЕ!* {ach_data['name']}"
+        for ach_data in await grant_achievements(user_id, updated_player):
+            result_text += f"\n\n🏆 *ДОСТИЖЕНИЕ!* {ach_data['name']}"
     
     else:
         exp_gain = get_experience_for_action("pvp_lose", False)
         
-        await update_player_stats(
-            user_id, chat_id,
-            pvp_losses=f"+1",
-            experience=f"+{exp_gain}"
-        )
-        
-        await update_player_stats(
-            victim_user.id, chat_id,
-            pvp_wins=f"+1",
-            experience=f"+{get_experience_for_action('pvp_win', True)}"
+        await asyncio.gather(
+            update_player_stats(
+                user_id, chat_id,
+                pvp_losses=f"+1",
+                experience=f"+{exp_gain}"
+            ),
+            update_player_stats(
+                victim_user.id, chat_id,
+                pvp_wins=f"+1",
+                experience=f"+{get_experience_for_action('pvp_win', True)}"
+            ),
         )
         
         msg = get_random_attack_message(
@@ -1102,10 +1261,7 @@ async def cmd_treasury(message: Message):
     )
 
 
-@router.message(Command("help", "commands", "info"))
-async def cmd_help(message: Message):
-    """Справка по командам"""
-    help_text = """
+HELP_TEXT = """
 🦯 *ХРОМАЯ ШЛЮХА ТЁТЯ РОЗА*
 
 ━━━━━━━━━━━━━━━━━━━━━━━━
@@ -1129,7 +1285,12 @@ _Бот запоминает все мемы и иногда выдаёт их 
 /profile — Твоё досье 📋
 /социал — Социальный граф чата 🕸️
 """
-    await message.answer(help_text, parse_mode=ParseMode.MARKDOWN)
+
+
+@router.message(Command("help", "commands", "info"))
+async def cmd_help(message: Message):
+    """Справка по командам"""
+    await message.answer(HELP_TEXT, parse_mode=ParseMode.MARKDOWN)
 
 
 @router.message(Command("досье", "профиль", "dossier"))
@@ -1340,7 +1501,8 @@ async def cmd_learn_user(message: Message):
     user_name = message.from_user.first_name or "Аноним"
     
     # Rate limit — не чаще раза в 5 минут
-    if not check_cooldown(user_id, chat_id, "learnme", 300):
+    can_do, _ = check_cooldown(user_id, chat_id, "learnme", 300)
+    if not can_do:
         await message.reply("⏳ Подожди 5 минут между обучениями!")
         return
     
@@ -1390,7 +1552,7 @@ async def cmd_learn_user(message: Message):
                     "user_name": user_name
                 }, timeout=aiohttp.ClientTimeout(total=15)) as response:
                     if response.status == 200:
-                        result = await response.json()
+                        result = await response.json(loads=json_loads)
                         
                         if result.get("has_facts") and result.get("facts"):
                             for fact in result["facts"][:3]:
@@ -1455,7 +1617,8 @@ async def cmd_deep_learn(message: Message):
     user_name = message.from_user.first_name or "Аноним"
     
     # Rate limit — не чаще раза в 30 минут (это тяжёлая операция)
-    if not check_cooldown(user_id, chat_id, "deeplearn", 1800):
+    can_do, _ = check_cooldown(user_id, chat_id, "deeplearn", 1800)
+    if not can_do:
         await message.reply("⏳ Глубокое обучение можно запускать раз в 30 минут!")
         return
     
@@ -1509,7 +1672,7 @@ async def cmd_deep_learn(message: Message):
                     "user_name": user_name
                 }, timeout=aiohttp.ClientTimeout(total=15)) as response:
                     if response.status == 200:
-                        result = await response.json()
+                        result = await response.json(loads=json_loads)
                         analyzed += 1
                         
                         if result.get("has_facts") and result.get("facts"):
@@ -1594,8 +1757,7 @@ async def cmd_psychoanalysis(message: Message):
     target_username = target_user.username
     
     # Кулдаун 2 минуты на пользователя
-    cooldown_key = f"psycho_{target_id}"
-    can_do, remaining = check_cooldown(message.from_user.id, message.chat.id, cooldown_key, 120)
+    can_do, remaining = check_cooldown(message.from_user.id, message.chat.id, "psycho", 120, subject=target_id)
     if not can_do:
         await message.answer(f"⏰ Психоанализ {target_name} можно делать раз в 2 минуты. Подожди {remaining} сек")
         return
@@ -1801,6 +1963,15 @@ async def cmd_social_graph(message: Message):
         await message.answer("❌ Ошибка построения графа")
 
 
+# Строки достижений не зависят от игрока — рендерим один раз
+_ACH_UNLOCKED_LINES = {
+    ach_id: f"✅ {ach['name']}\n_{ach['description']}_\n\n" for ach_id, ach in ACHIEVEMENTS.items()
+}
+_ACH_LOCKED_LINES = {
+    ach_id: f"🔒 ???\n_{ach['description']}_\n\n" for ach_id, ach in ACHIEVEMENTS.items()
+}
+
+
 @router.message(Command("achievements", "ach"))
 async def cmd_achievements(message: Message):
     """Показать достижения"""
@@ -1808,15 +1979,12 @@ async def cmd_achievements(message: Message):
         return
     
     user_id = message.from_user.id
-    earned = await get_player_achievements(user_id)
+    earned = set(await get_player_achievements(user_id))
     
-    text = "🏆 *ТВОИ ДОСТИЖЕНИЯ*\n\n"
-    
-    for ach_id, ach_data in ACHIEVEMENTS.items():
-        if ach_id in earned:
-            text += f"✅ {ach_data['name']}\n_{ach_data['description']}_\n\n"
-        else:
-            text += f"🔒 ???\n_{ach_data['description']}_\n\n"
+    text = "🏆 *ТВОИ ДОСТИЖЕНИЯ*\n\n" + "".join(
+        _ACH_UNLOCKED_LINES[ach_id] if ach_id in earned else _ACH_LOCKED_LINES[ach_id]
+        for ach_id in ACHIEVEMENTS
+    )
     
     await message.answer(text, parse_mode=ParseMode.MARKDOWN)
 
@@ -1833,9 +2001,9 @@ async def trigger_random_event(chat_id: int):
         active_events[chat_id] = {
             'type': 'jackpot',
             'amount': amount,
-            'grabbed': [],
+            'grabbed': set(),
             'max_grabbers': 3,
-            'expires': time.time() + 30
+            'expires': time.monotonic() + 30
         }
         
         await bot.send_message(
@@ -1851,8 +2019,8 @@ async def trigger_random_event(chat_id: int):
         # Облава
         active_events[chat_id] = {
             'type': 'raid',
-            'hidden': [],
-            'expires': time.time() + 30
+            'hidden': set(),
+            'expires': time.monotonic() + 30
         }
         
         await bot.send_message(
@@ -1877,9 +2045,9 @@ async def trigger_random_event(chat_id: int):
         active_events[chat_id] = {
             'type': 'lottery',
             'amount': amount,
-            'taken': [],
+            'taken': set(),
             'max_takers': 5,
-            'expires': time.time() + 20
+            'expires': time.monotonic() + 20
         }
         
         await bot.send_message(
@@ -1892,17 +2060,56 @@ async def trigger_random_event(chat_id: int):
         )
 
 
+def get_active_event(chat_id: int, event_type: str) -> Optional[dict]:
+    """Незавершённое событие нужного типа в чате (или None)"""
+    event = active_events.get(chat_id)
+    if event is None or event['type'] != event_type or time.monotonic() > event['expires']:
+        return None
+    return event
+
+
+def cleanup_active_events():
+    """Удалить истёкшие события (облаву снимает finish_raid_event)"""
+    now = time.monotonic()
+    expired = [
+        chat_id for chat_id, event in active_events.items()
+        if event['type'] != 'raid' and now > event['expires']
+    ]
+    for chat_id in expired:
+        del active_events[chat_id]
+
+
+# Ответы на /grab и /take копятся и уходят одним сообщением на всю пачку
+EVENT_CLAIMS_FLUSH_DELAY = 1.0
+
+
+def queue_event_claim(chat_id: int, event: dict, line: str, progress: str):
+    """Добавить строку «хапнул/урвал» в общий ответ по событию"""
+    pending = event.setdefault('pending_claims', [])
+    pending.append(line)
+    event['claims_progress'] = progress
+    if len(pending) == 1:
+        spawn_background(_flush_event_claims(chat_id, event))
+
+
+async def _flush_event_claims(chat_id: int, event: dict):
+    await asyncio.sleep(EVENT_CLAIMS_FLUSH_DELAY)
+    lines = event['pending_claims']
+    event['pending_claims'] = []
+    try:
+        await bot.send_message(chat_id, "\n".join(lines) + f"\n({event['claims_progress']})")
+    except Exception as e:
+        logger.warning(f"Failed to send event claims to {chat_id}: {e}")
+
+
 @router.message(Command("grab"))
 async def cmd_grab(message: Message):
     """Хапнуть деньги при событии 'инкассатор'"""
     chat_id = message.chat.id
     user_id = message.from_user.id
     
-    if chat_id not in active_events:
-        return
-    
-    event = active_events[chat_id]
-    if event['type'] != 'jackpot' or time.time() > event['expires']:
+    event = get_active_event(chat_id, 'jackpot')
+    if event is None:
         return
     
     if user_id in event['grabbed']:
@@ -1913,18 +2120,23 @@ async def cmd_grab(message: Message):
         await message.answer("😭 Опоздал! Всё уже разобрали!")
         return
     
+    # Бронируем место до первого await: проверка и запись идут без переключения
+    # задач, поэтому параллельные команды не переполнят событие
+    event['grabbed'].add(user_id)
+    
     player = await get_player(user_id, chat_id)
     if not player or not player['player_class']:
+        event['grabbed'].discard(user_id)
         return
     
     share = event['amount'] // event['max_grabbers']
-    event['grabbed'].append(user_id)
     
     await update_player_stats(user_id, chat_id, money=f"+{share}")
     
-    await message.answer(
-        f"💰 {message.from_user.first_name} хапнул {share} лавэ! "
-        f"({len(event['grabbed'])}/{event['max_grabbers']})"
+    queue_event_claim(
+        chat_id, event,
+        f"💰 {message.from_user.first_name} хапнул {share} лавэ!",
+        f"{len(event['grabbed'])}/{event['max_grabbers']}"
     )
 
 
@@ -1934,44 +2146,38 @@ async def cmd_hide(message: Message):
     chat_id = message.chat.id
     user_id = message.from_user.id
     
-    if chat_id not in active_events:
-        return
-    
-    event = active_events[chat_id]
-    if event['type'] != 'raid' or time.time() > event['expires']:
+    event = get_active_event(chat_id, 'raid')
+    if event is None:
         return
     
     if user_id in event['hidden']:
         await message.answer("🙈 Ты уже спрятался!")
         return
     
-    event['hidden'].append(user_id)
+    event['hidden'].add(user_id)
     await message.answer(f"🏃 {message.from_user.first_name} спрятался!")
 
 
 async def finish_raid_event(chat_id: int):
     """Завершить событие облавы"""
-    if chat_id not in active_events:
-        return
-    
     event = active_events.get(chat_id)
-    if not event or event['type'] != 'raid':
+    if event is None or event['type'] != 'raid':
         return
     
-    hidden_users = event['hidden']
     all_players = await get_all_active_players(chat_id)
     
-    caught = []
-    for player in all_players:
-        if player['user_id'] not in hidden_users:
-            # Проверяем, был ли игрок активен недавно
-            if player['money'] > 50:
-                fine = min(player['money'] // 2, 200)
-                await update_player_stats(player['user_id'], chat_id, money=f"-{fine}")
-                caught.append((player['first_name'], fine))
+    hidden = event['hidden']
+    # Штрафуем всех попавшихся одним пакетом вместо UPDATE на каждого
+    fined = [
+        (player, min(player['money'] // 2, 200))
+        for player in all_players
+        if player['user_id'] not in hidden and player['money'] > 50
+    ]
+    await add_players_money(chat_id, [(player['user_id'], -fine) for player, fine in fined])
+    caught = [(player['first_name'], fine) for player, fine in fined]
     
     if caught:
-        caught_text = "\n".join([f"• {name}: -{fine} лавэ" for name, fine in caught])
+        caught_text = "\n".join(f"• {name}: -{fine} лавэ" for name, fine in caught)
         await bot.send_message(
             chat_id,
             f"🚔 *ОБЛАВА ЗАВЕРШЕНА!*\n\n"
@@ -1994,11 +2200,8 @@ async def cmd_take(message: Message):
     chat_id = message.chat.id
     user_id = message.from_user.id
     
-    if chat_id not in active_events:
-        return
-    
-    event = active_events[chat_id]
-    if event['type'] != 'lottery' or time.time() > event['expires']:
+    event = get_active_event(chat_id, 'lottery')
+    if event is None:
         return
     
     if user_id in event['taken']:
@@ -2009,21 +2212,27 @@ async def cmd_take(message: Message):
         await message.answer("😭 Всё уже разобрали!")
         return
     
+    # Бронируем место до первого await: проверка и запись идут без переключения
+    # задач, поэтому параллельные команды не переполнят событие
+    event['taken'].add(user_id)
+    
     player = await get_player(user_id, chat_id)
     if not player or not player['player_class']:
+        event['taken'].discard(user_id)
         return
     
     share = event['amount'] // event['max_takers']
-    event['taken'].append(user_id)
-    
-    await update_player_stats(user_id, chat_id, money=f"+{share}")
     
-    # Уменьшаем общак
-    await add_to_treasury(chat_id, -share)
+    # Начисляем долю и уменьшаем общак — независимые записи
+    await asyncio.gather(
+        update_player_stats(user_id, chat_id, money=f"+{share}"),
+        add_to_treasury(chat_id, -share),
+    )
     
-    await message.answer(
-        f"💸 {message.from_user.first_name} урвал {share} лавэ из общака! "
-        f"({len(event['taken'])}/{event['max_takers']})"
+    queue_event_claim(
+        chat_id, event,
+        f"💸 {message.from_user.first_name} урвал {share} лавэ из общака!",
+        f"{len(event['taken'])}/{event['max_takers']}"
     )
 
 
@@ -2035,9 +2244,11 @@ VISION_API_URL = os.getenv("VISION_API_URL", "")
 POEM_API_URL = os.getenv("POEM_API_URL", "")
 
 
+@functools.lru_cache(maxsize=None)
 def get_api_url(endpoint: str) -> str:
     """
     Надёжно формирует URL для Vercel API endpoint.
+    VERCEL_API_URL задаётся при старте, поэтому результат кэшируется.
     
     Args:
         endpoint: Название endpoint без слэша (например: "burn", "dream", "reply")
@@ -2064,12 +2275,54 @@ def get_api_url(endpoint: str) -> str:
 
 # ==================== ОПИСАНИЕ ФОТО ====================
 
+# Вызовы AI API: в одном чате — по очереди, всего — не больше AI_CALLS_MAX сразу.
+# Блокировки чатов живут, пока их кто-то держит или ждёт (WeakValueDictionary)
+AI_CALLS_MAX = 32
+_ai_calls_semaphore = asyncio.Semaphore(AI_CALLS_MAX)
+_ai_chat_locks: "weakref.WeakValueDictionary[int, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+
+@asynccontextmanager
+async def ai_call_slot(chat_id: int):
+    """Слот для запроса к AI API: очередь внутри чата + общий лимит"""
+    lock = _ai_chat_locks.get(chat_id)
+    if lock is None:
+        lock = _ai_chat_locks[chat_id] = asyncio.Lock()
+    async with lock, _ai_calls_semaphore:
+        yield
+
+
+async def post_ai_api(chat_id: int, url: str, **kwargs) -> tuple[int, Any]:
+    """POST к AI API в слоте ai_call_slot: (статус, JSON при 200, иначе текст ответа).
+    Слот держим только на запрос и чтение ответа — сообщения правим уже без него"""
+    session = await get_http_session()
+    async with ai_call_slot(chat_id), session.post(url, **kwargs) as response:
+        if response.status == 200:
+            return 200, await response.json(loads=json_loads)
+        return response.status, await response.text()
+
+
+# Файлы крупнее порога кодируем в потоке, чтобы не держать event loop
+B64_THREAD_THRESHOLD = 256 * 1024
+
+
+def _b64encode_ascii(data) -> str:
+    if isinstance(data, io.BytesIO):
+        data = data.getbuffer()  # без копии содержимого BytesIO
+    return base64.b64encode(data).decode('ascii')
+
+
+async def b64encode_file(data) -> str:
+    """base64 для скачанного файла (bytes или BytesIO) без блокировки event loop"""
+    size = data.getbuffer().nbytes if isinstance(data, io.BytesIO) else len(data)
+    if size < B64_THREAD_THRESHOLD:
+        return _b64encode_ascii(data)
+    return await asyncio.to_thread(_b64encode_ascii, data)
+
+
 @router.message(Command("describe", "photo", "wtf"))
 async def cmd_describe_photo(message: Message):
     """Описание фото через Claude Vision — ответь на фото или кинь фото с командой"""
-    import base64
-    import io
-    
     photo = None
     
     # Проверяем: это ответ на сообщение с фото?
@@ -2096,12 +2349,14 @@ async def cmd_describe_photo(message: Message):
     # Проверка кулдауна
     user_id = message.from_user.id
     chat_id = message.chat.id
-    if not check_cooldown(user_id, chat_id, "describe", 15):
+    can_do, _ = check_cooldown(user_id, chat_id, "describe", 15)
+    if not can_do:
         await message.answer("⏳ Подожди немного, глаза устали!")
         return
     
     # Rate limit для Vision API
-    if not check_api_rate_limit(chat_id, "vision"):
+    allowed, _ = check_api_rate_limit(chat_id, "vision")
+    if not allowed:
         await message.answer("⏳ Слишком много запросов. Подожди минутку!")
         return
     
@@ -2113,37 +2368,29 @@ async def cmd_describe_photo(message: Message):
         file = await bot.get_file(photo.file_id)
         photo_bytes = await bot.download_file(file.file_path)
         
-        # Конвертируем в base64
-        if isinstance(photo_bytes, io.BytesIO):
-            photo_data = photo_bytes.getvalue()
-        else:
-            photo_data = photo_bytes
-        
-        image_base64 = base64.b64encode(photo_data).decode('utf-8')
+        image_base64 = await b64encode_file(photo_bytes)
         
         # Отправляем на анализ (используем глобальную сессию)
-        session = await get_http_session()
-        async with session.post(
+        status, result = await post_ai_api(
+            chat_id,
             VISION_API_URL,
             json={
                 "image_base64": image_base64,
                 "media_type": "image/jpeg"
             },
             timeout=aiohttp.ClientTimeout(total=30)
-        ) as response:
-                if response.status == 200:
-                    result = await response.json()
-                    description = result.get("description", "Хуйня какая-то, не разобрать...")
-                    
-                    # Красиво оформляем ответ
-                    await processing_msg.edit_text(
-                        f"🔮 *Тётя Роза видит:*\n\n{description}",
-                        parse_mode=ParseMode.MARKDOWN
-                    )
-                else:
-                    error = await response.text()
-                    logger.error(f"Vision API error: {response.status} - {error}")
-                    await processing_msg.edit_text("❌ Карты затуманились... Попробуй позже!")
+        )
+        if status == 200:
+            description = result.get("description", "Хуйня какая-то, не разобрать...")
+            
+            # Текст от модели экранируем: в Markdown непарный * или _ ломает отправку
+            await processing_msg.edit_text(
+                f"🔮 <b>Тётя Роза видит:</b>\n\n{html.escape(description, quote=False)}",
+                parse_mode=ParseMode.HTML
+            )
+        else:
+            logger.error(f"Vision API error: {status} - {result}")
+            await processing_msg.edit_text("❌ Карты затуманились... Попробуй позже!")
     
     except asyncio.TimeoutError:
         await processing_msg.edit_text("⏰ Слишком долго смотрела в шар, устала. Попробуй ещё раз!")
@@ -2193,7 +2440,7 @@ async def cmd_poem(message: Message):
         target_name = "Аноним"
     
     # Проверяем API URL
-    poem_api_url = os.getenv("POEM_API_URL") or get_api_url("poem")
+    poem_api_url = POEM_API_URL or get_api_url("poem")
     
     if not poem_api_url or "your-vercel" in poem_api_url:
         await message.answer("❌ API для стихов не настроен!")
@@ -2239,25 +2486,22 @@ async def cmd_poem(message: Message):
         logger.info(f"Poem: {target_name}, {messages_found} msgs, memory: {bool(target_user_id)}")
         
         metrics.track_api_call("poem")
-        session = await get_http_session()
-        async with session.post(
-                poem_api_url,
-                json={"name": target_name, "context": context}
-            ) as response:
-                if response.status == 200:
-                    result = await response.json()
-                    
-                    if "error" in result:
-                        await processing_msg.edit_text(f"❌ Ошибка: {result['error']}")
-                        return
-                    
-                    poem = result.get("poem", "Муза молчит...")
-                    
-                    await processing_msg.edit_text(poem)
-                else:
-                    error = await response.text()
-                    logger.error(f"Poem API error: {response.status} - {error}")
-                    await processing_msg.edit_text("❌ Муза сегодня не в духе. Попробуй позже!")
+        status, result = await post_ai_api(
+            chat_id,
+            poem_api_url,
+            json={"name": target_name, "context": context}
+        )
+        if status == 200:
+            if "error" in result:
+                await processing_msg.edit_text(f"❌ Ошибка: {result['error']}")
+                return
+            
+            poem = result.get("poem", "Муза молчит...")
+            
+            await processing_msg.edit_text(poem)
+        else:
+            logger.error(f"Poem API error: {status} - {result}")
+            await processing_msg.edit_text("❌ Муза сегодня не в духе. Попробуй позже!")
                     
     except asyncio.TimeoutError:
         await processing_msg.edit_text("⏰ Муза задумалась слишком надолго...")
@@ -2346,29 +2590,26 @@ async def cmd_diagnosis(message: Message):
         logger.info(f"Diagnosis: {target_name}, {messages_found} msgs, memory: {bool(user_memory)}")
         
         metrics.track_api_call("diagnosis")
-        session = await get_http_session()
-        async with session.post(
-                diagnosis_api_url,
-                json={
-                    "name": target_name, 
-                    "username": target_username or "", 
-                    "context": full_context,
-                    "profile": user_profile
-                }
-            ) as response:
-                if response.status == 200:
-                    result = await response.json()
-                    
-                    if "error" in result:
-                        await processing_msg.edit_text(f"❌ Ошибка: {result['error']}")
-                        return
-                    
-                    diagnosis = result.get("diagnosis", "Диагноз: хуй знает")
-                    await processing_msg.edit_text(diagnosis)
-                else:
-                    error = await response.text()
-                    logger.error(f"Diagnosis API error: {response.status} - {error}")
-                    await processing_msg.edit_text("❌ Тётя Роза уснула. Попробуй позже!")
+        status, result = await post_ai_api(
+            chat_id,
+            diagnosis_api_url,
+            json={
+                "name": target_name, 
+                "username": target_username or "", 
+                "context": full_context,
+                "profile": user_profile
+            }
+        )
+        if status == 200:
+            if "error" in result:
+                await processing_msg.edit_text(f"❌ Ошибка: {result['error']}")
+                return
+            
+            diagnosis = result.get("diagnosis", "Диагноз: хуй знает")
+            await processing_msg.edit_text(diagnosis)
+        else:
+            logger.error(f"Diagnosis API error: {status} - {result}")
+            await processing_msg.edit_text("❌ Тётя Роза уснула. Попробуй позже!")
                     
     except asyncio.TimeoutError:
         await processing_msg.edit_text("⏰ Тётя Роза слишком долго искала очки...")
@@ -2443,7 +2684,7 @@ async def cmd_imagine(message: Message):
                 error = await resp.text()
                 await processing.edit_text(f"❌ Ошибка генерации промпта: {error[:200]}")
                 return
-            result = await resp.json()
+            result = await resp.json(loads=json_loads)
 
         image_prompt = result.get("prompt", "")
         if not image_prompt:
@@ -2469,7 +2710,7 @@ async def cmd_imagine(message: Message):
                 error = await fal_resp.text()
                 await processing.edit_text(f"❌ Flux вернул ошибку: {error[:200]}")
                 return
-            fal_result = await fal_resp.json()
+            fal_result = await fal_resp.json(loads=json_loads)
 
         images = fal_result.get("images", [])
         if not images:
@@ -2593,7 +2834,7 @@ async def cmd_video(message: Message, command: CommandObject):
             if resp.status not in (200, 201):
                 await processing.edit_text(f"❌ Kling ошибка: {(await resp.text())[:200]}")
                 return
-            submit_result = await resp.json()
+            submit_result = await resp.json(loads=json_loads)
 
         request_id = submit_result.get("request_id")
         if not request_id:
@@ -2608,7 +2849,7 @@ async def cmd_video(message: Message, command: CommandObject):
                 headers=fal_headers,
                 timeout=aiohttp.ClientTimeout(total=10)
             ) as resp:
-                status_data = await resp.json()
+                status_data = await resp.json(loads=json_loads)
 
             status = status_data.get("status", "")
             if status == "COMPLETED":
@@ -2632,7 +2873,7 @@ async def cmd_video(message: Message, command: CommandObject):
             headers=fal_headers,
             timeout=aiohttp.ClientTimeout(total=10)
         ) as resp:
-            video_result = await resp.json()
+            video_result = await resp.json(loads=json_loads)
 
         video_url = video_result.get("video", {}).get("url", "")
         if not video_url:
@@ -2722,7 +2963,7 @@ async def cmd_animate(message: Message):
             if resp.status not in (200, 201):
                 await processing.edit_text(f"❌ Kling ошибка: {(await resp.text())[:200]}")
                 return
-            submit_result = await resp.json()
+            submit_result = await resp.json(loads=json_loads)
 
         request_id = submit_result.get("request_id")
         if not request_id:
@@ -2736,7 +2977,7 @@ async def cmd_animate(message: Message):
                 headers=fal_headers,
                 timeout=aiohttp.ClientTimeout(total=10)
             ) as resp:
-                status_data = await resp.json()
+                status_data = await resp.json(loads=json_loads)
 
             status = status_data.get("status", "")
             if status == "COMPLETED":
@@ -2759,7 +3000,7 @@ async def cmd_animate(message: Message):
             headers=fal_headers,
             timeout=aiohttp.ClientTimeout(total=10)
         ) as resp:
-            video_result = await resp.json()
+            video_result = await resp.json(loads=json_loads)
 
         video_url = video_result.get("video", {}).get("url", "")
         if not video_url:
@@ -2832,7 +3073,7 @@ async def cmd_enhance(message: Message):
             if resp.status != 200:
                 await processing.edit_text(f"❌ AuraSR ошибка: {(await resp.text())[:200]}")
                 return
-            result = await resp.json()
+            result = await resp.json(loads=json_loads)
 
         enhanced_url = result.get("image", {}).get("url", "")
         if not enhanced_url:
@@ -2927,7 +3168,7 @@ async def cmd_music(message: Message, command: CommandObject):
                 await processing.edit_text(
                     f"📭 У {target_name} слишком мало сохранённых сообщений — не о чём петь!"
                 )
-                cooldowns.pop((message.from_user.id, message.chat.id, "music"), None)
+                reset_cooldown(message.from_user.id, message.chat.id, "music")
                 return
         else:
             # Режим чата — случайные сообщения из всей истории чата
@@ -2938,7 +3179,7 @@ async def cmd_music(message: Message, command: CommandObject):
                     "📭 Слишком мало сообщений в базе — не о чём петь!\n"
                     "Напишите хоть что-нибудь сначала."
                 )
-                cooldowns.pop((message.from_user.id, message.chat.id, "music"), None)
+                reset_cooldown(message.from_user.id, message.chat.id, "music")
                 return
 
             # Равномерная выборка: не более 15 сообщений на автора,
@@ -2953,7 +3194,6 @@ async def cmd_music(message: Message, command: CommandObject):
             text_msgs = balanced[:500]
 
         # Шаг 1: форматируем сообщения для Claude
-        import datetime as _dt
         lines = []
         for m in text_msgs:
             text = m.get("message_text") or m.get("text", "")
@@ -2964,7 +3204,7 @@ async def cmd_music(message: Message, command: CommandObject):
             time_tag = ""
             if ts:
                 try:
-                    h = _dt.datetime.fromtimestamp(int(ts)).hour
+                    h = datetime.fromtimestamp(int(ts)).hour
                     time_tag = "[ночь] " if h < 6 else "[утро] " if h < 12 else "[день] " if h < 18 else "[вечер] "
                 except Exception:
                     pass
@@ -3036,7 +3276,7 @@ async def cmd_music(message: Message, command: CommandObject):
             if resp.status != 200:
                 await processing.edit_text(f"❌ Ошибка генерации текста: {(await resp.text())[:200]}")
                 return
-            claude_result = await resp.json()
+            claude_result = await resp.json(loads=json_loads)
 
         raw = claude_result.get("content", [{}])[0].get("text", "").strip()
         if "```" in raw:
@@ -3044,7 +3284,7 @@ async def cmd_music(message: Message, command: CommandObject):
             if raw.startswith("json"):
                 raw = raw[4:]
         try:
-            music_data = json.loads(raw.strip())
+            music_data = json_loads(raw.strip())
         except Exception:
             await processing.edit_text(f"❌ Claude вернул не JSON: {raw[:200]}")
             return
@@ -3082,7 +3322,7 @@ async def cmd_music(message: Message, command: CommandObject):
             if suno_resp.status != 200:
                 await processing.edit_text(f"❌ Suno ошибка: {(await suno_resp.text())[:200]}")
                 return
-            suno_result = await suno_resp.json()
+            suno_result = await suno_resp.json(loads=json_loads)
 
         task_id = suno_result.get("task_id", "")
         if not task_id:
@@ -3102,7 +3342,7 @@ async def cmd_music(message: Message, command: CommandObject):
                 if fetch_resp.status != 200:
                     logger.warning(f"SUNO fetch HTTP {fetch_resp.status}: {await fetch_resp.text()}")
                     continue
-                fetch_data = await fetch_resp.json()
+                fetch_data = await fetch_resp.json(loads=json_loads)
 
             status = fetch_data.get("status", "")
             logger.info(f"SUNO poll #{attempt+1} status={status!r} full={fetch_data}")
@@ -3183,7 +3423,7 @@ async def cmd_podcast(message: Message, command: CommandObject):
         all_msgs = await get_random_messages_for_music(message.chat.id, limit=800)
         if len(all_msgs) < 5:
             await processing.edit_text("📭 Слишком мало сообщений — не о чём говорить!")
-            cooldowns.pop((message.from_user.id, message.chat.id, "podcast"), None)
+            reset_cooldown(message.from_user.id, message.chat.id, "podcast")
             return
 
         # Балансировка по авторам
@@ -3195,7 +3435,6 @@ async def cmd_podcast(message: Message, command: CommandObject):
                 balanced.append(m)
                 author_counts[author] = author_counts.get(author, 0) + 1
 
-        import datetime as _dt2
         lines = []
         for m in balanced[:400]:
             text = m.get("message_text", "")
@@ -3206,7 +3445,7 @@ async def cmd_podcast(message: Message, command: CommandObject):
             time_tag = ""
             if ts:
                 try:
-                    h = _dt2.datetime.fromtimestamp(int(ts)).hour
+                    h = datetime.fromtimestamp(int(ts)).hour
                     time_tag = "[ночь] " if h < 6 else "[утро] " if h < 12 else "[день] " if h < 18 else "[вечер] "
                 except Exception:
                     pass
@@ -3257,7 +3496,7 @@ async def cmd_podcast(message: Message, command: CommandObject):
             if resp.status != 200:
                 await processing.edit_text(f"❌ Ошибка генерации скрипта: {(await resp.text())[:200]}")
                 return
-            claude_result = await resp.json()
+            claude_result = await resp.json(loads=json_loads)
 
         script = claude_result.get("content", [{}])[0].get("text", "").strip()
         if not script:
@@ -3271,7 +3510,6 @@ async def cmd_podcast(message: Message, command: CommandObject):
         from google import genai as _genai
         from google.genai import types as _gtypes
         import wave as _wave
-        import io as _io
 
         def _generate_audio(api_key: str, script_text: str) -> bytes:
             client = _genai.Client(api_key=api_key)
@@ -3308,20 +3546,19 @@ async def cmd_podcast(message: Message, command: CommandObject):
             raw = response.candidates[0].content.parts[0].inline_data.data
 
             # inline_data.data может быть base64-строкой или bytes — декодируем
-            import base64 as _b64
             if isinstance(raw, str):
-                pcm_data = _b64.b64decode(raw)
+                pcm_data = base64.b64decode(raw)
             elif isinstance(raw, bytes):
                 # Проверяем: вдруг это всё же base64 в bytes
                 try:
-                    pcm_data = _b64.b64decode(raw)
+                    pcm_data = base64.b64decode(raw)
                 except Exception:
                     pcm_data = raw
             else:
                 pcm_data = bytes(raw)
 
             # PCM → WAV в памяти (24kHz, 16-bit, mono)
-            buf = _io.BytesIO()
+            buf = io.BytesIO()
             with _wave.open(buf, "wb") as wf:
                 wf.setnchannels(1)
                 wf.setsampwidth(2)
@@ -3416,24 +3653,21 @@ async def cmd_burn(message: Message):
         logger.info(f"Burn: {target_name}, {messages_found} msgs, memory: {bool(user_memory)}")
         
         metrics.track_api_call("burn")
-        session = await get_http_session()
-        async with session.post(
-                burn_api_url,
-                json={"name": target_name, "username": target_username or "", "context": full_context}
-            ) as response:
-                if response.status == 200:
-                    result = await response.json()
-                    
-                    if "error" in result:
-                        await processing_msg.edit_text(f"❌ Ошибка: {result['error']}")
-                        return
-                    
-                    burn_text = result.get("result", "Не загорелся — слишком сырой")
-                    await processing_msg.edit_text(burn_text)
-                else:
-                    error = await response.text()
-                    logger.error(f"Burn API error: {response.status} - {error}")
-                    await processing_msg.edit_text("❌ Костёр потух. Попробуй позже!")
+        status, result = await post_ai_api(
+            chat_id,
+            burn_api_url,
+            json={"name": target_name, "username": target_username or "", "context": full_context}
+        )
+        if status == 200:
+            if "error" in result:
+                await processing_msg.edit_text(f"❌ Ошибка: {result['error']}")
+                return
+            
+            burn_text = result.get("result", "Не загорелся — слишком сырой")
+            await processing_msg.edit_text(burn_text)
+        else:
+            logger.error(f"Burn API error: {status} - {result}")
+            await processing_msg.edit_text("❌ Костёр потух. Попробуй позже!")
                     
     except asyncio.TimeoutError:
         await processing_msg.edit_text("⏰ Долго горит... слишком много пиздежа было")
@@ -3508,24 +3742,21 @@ async def cmd_drink(message: Message):
         logger.info(f"Drink: {target_name}, {messages_found} msgs, memory: {bool(user_memory)}")
         
         metrics.track_api_call("drink")
-        session = await get_http_session()
-        async with session.post(
-                drink_api_url,
-                json={"name": target_name, "username": target_username or "", "context": full_context}
-            ) as response:
-                if response.status == 200:
-                    result = await response.json()
-                    
-                    if "error" in result:
-                        await processing_msg.edit_text(f"❌ Ошибка: {result['error']}")
-                        return
-                    
-                    drink_text = result.get("result", "Отказался бухать — ссыкло")
-                    await processing_msg.edit_text(drink_text)
-                else:
-                    error = await response.text()
-                    logger.error(f"Drink API error: {response.status} - {error}")
-                    await processing_msg.edit_text("❌ Тётя Роза уже в отключке. Попробуй позже!")
+        status, result = await post_ai_api(
+            chat_id,
+            drink_api_url,
+            json={"name": target_name, "username": target_username or "", "context": full_context}
+        )
+        if status == 200:
+            if "error" in result:
+                await processing_msg.edit_text(f"❌ Ошибка: {result['error']}")
+                return
+            
+            drink_text = result.get("result", "Отказался бухать — ссыкло")
+            await processing_msg.edit_text(drink_text)
+        else:
+            logger.error(f"Drink API error: {status} - {result}")
+            await processing_msg.edit_text("❌ Тётя Роза уже в отключке. Попробуй позже!")
                     
     except asyncio.TimeoutError:
         await processing_msg.edit_text("⏰ Слишком долго бухали... оба вырубились")
@@ -3549,7 +3780,8 @@ async def cmd_suck(message: Message):
     chat_id = message.chat.id
     
     # Проверка кулдауна
-    if not check_cooldown(user_id, chat_id, "suck", 10):
+    can_do, _ = check_cooldown(user_id, chat_id, "suck", 10)
+    if not can_do:
         await message.answer("⏳ Рот занят. Подожди!")
         return
     
@@ -3652,7 +3884,7 @@ async def cmd_suck(message: Message):
             "memory": user_memory
         }) as response:
                 if response.status == 200:
-                    result = await response.json()
+                    result = await response.json(loads=json_loads)
                     text = result.get("text", f"🍭 {target_name}, соси. Тётя Роза так сказала.")
                     
                     # Заменяем имя на кликабельное упоминание в ответе
@@ -3678,7 +3910,16 @@ async def cmd_suck(message: Message):
 
 # ==================== ПРОВЕТРИТЬ ЧАТ ====================
 
-VENTILATE_API_URL = os.getenv("VENTILATE_API_URL", "")
+# Env не меняется во время работы — вычисляем URL один раз при импорте
+VENTILATE_API_URL = os.getenv("VENTILATE_API_URL") or get_api_url("ventilate")
+
+# Запасные события при ошибке API: (mentions, gender) -> текст.
+# Форматируется только выбранный вариант.
+VENTILATE_FALLBACK_TEMPLATES = (
+    lambda m, g: f"🪟 Тётя Роза открыла форточку в чате.\n\nЗалетел голубь. Насрал на {m['acc']}. Улетел.\n\nПроветрено.",
+    lambda m, g: f"🪟 Тётя Роза открыла форточку в чате.\n\nСквозняком сдуло {m['acc']} куда-то в угол чата. {m['nom']} там теперь сидит.\n\nСвежо.",
+    lambda m, g: f"🪟 Тётя Роза открыла форточку в чате.\n\nВорвался холод. {m['nom']} {'замёрзла' if g == 'женский' else 'замёрз'} нахуй.\n\nЗакрываю.",
+)
 
 
 def make_user_mention(user_id: int, name: str, username: str = None) -> str:
@@ -3688,6 +3929,16 @@ def make_user_mention(user_id: int, name: str, username: str = None) -> str:
     return f'<a href="tg://user?id={user_id}">{safe_name}</a>'
 
 
+# Константы склонения — собираются один раз при импорте, а не на каждый вызов
+_NAME_CASES = ('nom', 'gen', 'dat', 'acc', 'ins', 'pre')
+# Неизменяемые имена (иностранные)
+_UNCHANGEABLE_NAMES = frozenset({'алекс', 'макс', 'крис', 'ким', 'ли', 'джон', 'том', 'бен', 'сэм', 'дэн'})
+# После г/к/х/ш/ч (и ж/щ у женских) родительный падеж на -и, а не на -ы
+_GEN_I_ENDINGS_FEMALE = frozenset({'ка', 'га', 'ха', 'ша', 'ча', 'ща', 'жа'})
+_GEN_I_ENDINGS_MALE = frozenset({'ка', 'га', 'ха', 'ша', 'ча'})
+_VOWELS = frozenset('аеёиоуыэюя')
+
+
 def decline_russian_name(name: str, gender: str = "мужской") -> dict:
     """
     Склонение русских имён по падежам.
@@ -3695,15 +3946,13 @@ def decline_russian_name(name: str, gender: str = "мужской") -> dict:
     """
     name = name.strip()
     if not name:
-        return {case: name for case in ['nom', 'gen', 'dat', 'acc', 'ins', 'pre']}
+        return dict.fromkeys(_NAME_CASES, name)
     
     # Определяем тип окончания
     name_lower = name.lower()
     
-    # Неизменяемые имена (иностранные)
-    unchangeable = ['алекс', 'макс', 'крис', 'ким', 'ли', 'джон', 'том', 'бен', 'сэм', 'дэн']
-    if name_lower in unchangeable or len(name) <= 2:
-        return {case: name for case in ['nom', 'gen', 'dat', 'acc', 'ins', 'pre']}
+    if name_lower in _UNCHANGEABLE_NAMES or len(name) <= 2:
+        return dict.fromkeys(_NAME_CASES, name)
     
     base = name[:-1] if len(name) > 1 else name
     last = name[-1].lower()
@@ -3713,7 +3962,7 @@ def decline_russian_name(name: str, gender: str = "мужской") -> dict:
     
     # Женские имена на -а (Маша, Аня, Лена)
     if last == 'а' and gender == "женский":
-        result['gen'] = base + 'ы' if last2 not in ['ка', 'га', 'ха', 'ша', 'ча', 'ща', 'жа'] else base + 'и'
+        result['gen'] = base + 'ы' if last2 not in _GEN_I_ENDINGS_FEMALE else base + 'и'
         result['dat'] = base + 'е'
         result['acc'] = base + 'у'
         result['ins'] = base + 'ой'
@@ -3738,7 +3987,7 @@ def decline_russian_name(name: str, gender: str = "мужской") -> dict:
     # Мужские имена на -а/-я (Никита, Илья, Саша)
     elif last in ['а', 'я'] and gender == "мужской":
         if last == 'а':
-            result['gen'] = base + 'ы' if last2 not in ['ка', 'га', 'ха', 'ша', 'ча'] else base + 'и'
+            result['gen'] = base + 'ы' if last2 not in _GEN_I_ENDINGS_MALE else base + 'и'
             result['dat'] = base + 'е'
             result['acc'] = base + 'у'
             result['ins'] = base + 'ой'
@@ -3783,7 +4032,7 @@ def decline_russian_name(name: str, gender: str = "мужской") -> dict:
         result['pre'] = base + 'и'
         
     # Мужские имена на согласную (Иван, Пётр, Олег, Максим)
-    elif last not in 'аеёиоуыэюя':
+    elif last not in _VOWELS:
         result['gen'] = name + 'а'
         result['dat'] = name + 'у'
         result['acc'] = name + 'а'
@@ -3792,11 +4041,21 @@ def decline_russian_name(name: str, gender: str = "мужской") -> dict:
         
     # Для остальных — без изменений
     else:
-        result = {case: name for case in ['nom', 'gen', 'dat', 'acc', 'ins', 'pre']}
+        result = dict.fromkeys(_NAME_CASES, name)
     
     return result
 
 
+# Плейсхолдеры жертвы от API: {VICTIM} и {VICTIM_<ПАДЕЖ>} — за один проход
+_VICTIM_PLACEHOLDER_RE = re.compile(r'\{VICTIM(?:_(NOM|GEN|DAT|ACC|INS|PRE))?\}')
+
+
+@functools.lru_cache(maxsize=4096)
+def _name_form_re(form: str) -> re.Pattern:
+    """Форма имени целым словом и не внутри HTML тега (компилируется один раз)"""
+    return re.compile(r'(?<![а-яА-Яa-zA-Z>])' + re.escape(form) + r'(?![а-яА-Яa-zA-Z<])')
+
+
 @router.message(Command("ventilate", "проветрить", "форточка", "свежесть"))
 async def cmd_ventilate(message: Message):
     """Проветрить чат — абсурдное событие с рандомным участником"""
@@ -3855,16 +4114,22 @@ async def cmd_ventilate(message: Message):
     
     # Получаем последние сообщения жертвы для определения пола
     victim_profile = {}
-    try:
-        if USE_POSTGRES and victim_id:
-            # Берём до 1000 сообщений для точного определения пола по глаголам
-            messages = await get_user_messages(chat_id, victim_id, limit=1000)
+    if USE_POSTGRES and victim_id:
+        # Сообщения (до 1000 — для точного определения пола по глаголам) и полный
+        # профиль жертвы (per-chat!) независимы — запрашиваем параллельно
+        messages, profile = await asyncio.gather(
+            get_user_messages(chat_id, victim_id, limit=1000),
+            get_user_profile_for_ai(victim_id, chat_id, victim_name, victim_username or ""),
+            return_exceptions=True
+        )
+        if isinstance(messages, Exception):
+            logger.warning(f"Could not get victim messages: {messages}")
+        else:
             victim_messages = [m.get('message_text', '') for m in messages if m.get('message_text')]
-            
-            # Получаем полный профиль жертвы для персонализации (per-chat!)
-            victim_profile = await get_user_profile_for_ai(victim_id, chat_id, victim_name, victim_username or "")
-    except Exception as e:
-        logger.warning(f"Could not get victim data: {e}")
+        if isinstance(profile, Exception):
+            logger.warning(f"Could not get victim profile: {profile}")
+        else:
+            victim_profile = profile or {}
     
     # Определяем пол: сначала из профиля, потом по имени
     if victim_profile and victim_profile.get('gender') and victim_profile.get('gender') != 'unknown':
@@ -3905,9 +4170,6 @@ async def cmd_ventilate(message: Message):
         'pre': mention_with_case(declined['pre']),
     }
     
-    # Проверяем API
-    ventilate_url = VENTILATE_API_URL or get_api_url("ventilate")
-    
     processing_msg = await message.answer("🪟 Открываю форточку...")
     metrics.track_command("ventilate")
     
@@ -3915,7 +4177,7 @@ async def cmd_ventilate(message: Message):
         metrics.track_api_call("ventilate")
         session = await get_http_session()
         async with session.post(
-                ventilate_url,
+                VENTILATE_API_URL,
                 json={
                     "victim_name": victim_name,
                     "victim_username": victim_username or "",
@@ -3926,56 +4188,50 @@ async def cmd_ventilate(message: Message):
                 }
             ) as response:
                 if response.status == 200:
-                    result = await response.json()
+                    result = await response.json(loads=json_loads)
                     text = result.get("text", "🪟 Форточка не открылась. Заклинило.")
                     
                     # API возвращает пол — ИСПОЛЬЗУЕМ ЕГО (он точнее, т.к. анализирует сообщения)
                     api_gender = result.get("gender", gender)
                     
-                    # Пересклоняем имя с правильным полом
-                    declined = decline_russian_name(victim_name, api_gender)
-                    mentions = {
-                        'nom': mention_with_case(declined['nom']),
-                        'gen': mention_with_case(declined['gen']),
-                        'dat': mention_with_case(declined['dat']),
-                        'acc': mention_with_case(declined['acc']),
-                        'ins': mention_with_case(declined['ins']),
-                        'pre': mention_with_case(declined['pre']),
-                    }
+                    # Пересклоняем имя, только если API поправил пол
+                    if api_gender != gender:
+                        declined = decline_russian_name(victim_name, api_gender)
+                        mentions = {
+                            'nom': mention_with_case(declined['nom']),
+                            'gen': mention_with_case(declined['gen']),
+                            'dat': mention_with_case(declined['dat']),
+                            'acc': mention_with_case(declined['acc']),
+                            'ins': mention_with_case(declined['ins']),
+                            'pre': mention_with_case(declined['pre']),
+                        }
                     
                     # 1. Заменяем плейсхолдеры на кликабельные склонённые упоминания
-                    text = text.replace("{VICTIM_NOM}", mentions['nom'])
-                    text = text.replace("{VICTIM_GEN}", mentions['gen'])
-                    text = text.replace("{VICTIM_DAT}", mentions['dat'])
-                    text = text.replace("{VICTIM_ACC}", mentions['acc'])
-                    text = text.replace("{VICTIM_INS}", mentions['ins'])
-                    text = text.replace("{VICTIM_PRE}", mentions['pre'])
-                    text = text.replace("{VICTIM}", mentions['nom'])
+                    text = _VICTIM_PLACEHOLDER_RE.sub(
+                        lambda m: mentions[(m.group(1) or 'NOM').lower()], text
+                    )
                     
                     # 2. Заменяем @username на кликабельную ссылку
                     if victim_username:
                         text = text.replace(f"@{victim_username}", mentions['nom'])
                     
                     # 3. Заменяем все формы имени на кликабельные (если AI написал напрямую)
-                    # Собираем все уникальные формы имени
-                    unique_forms = list(set(declined.values()))
-                    # Сортируем по длине (сначала длинные, чтобы "Александра" заменилась раньше "Александр")
-                    unique_forms.sort(key=len, reverse=True)
+                    # Уникальные формы имени → первый падеж с такой формой (за один проход)
+                    form_cases = {}
+                    for case_key, case_form in declined.items():
+                        form_cases.setdefault(case_form, case_key)
                     
-                    for case_form in unique_forms:
+                    # Сначала длинные, чтобы "Александра" заменилась раньше "Александр"
+                    for case_form in sorted(form_cases, key=len, reverse=True):
                         if case_form and len(case_form) > 1:
-                            # Находим какой падеж это
-                            case_key = next((k for k, v in declined.items() if v == case_form), 'nom')
-                            mention = mentions[case_key]
+                            mention = mentions[form_cases[case_form]]
                             
                             # Пропускаем если форма уже в тексте как часть ссылки
                             if f'>{case_form}<' in text:
                                 continue
                             
                             # Заменяем только если не внутри HTML тега
-                            # Паттерн: имя окружено не-буквами и не > или <
-                            pattern = r'(?<![а-яА-Яa-zA-Z>])' + re.escape(case_form) + r'(?![а-яА-Яa-zA-Z<])'
-                            text = re.sub(pattern, mention, text, count=5)
+                            text = _name_form_re(case_form).sub(mention, text, count=5)
                     
                     await processing_msg.edit_text(text, parse_mode=ParseMode.HTML)
                 else:
@@ -3983,12 +4239,8 @@ async def cmd_ventilate(message: Message):
                     logger.error(f"Ventilate API error: {response.status} - {error_text}")
                     # Fallback с кликабельным упоминанием и склонением
                     # Используем gender (не api_gender), т.к. api_gender определён только при успехе
-                    fallback_events = [
-                        f"🪟 Тётя Роза открыла форточку в чате.\n\nЗалетел голубь. Насрал на {mentions['acc']}. Улетел.\n\nПроветрено.",
-                        f"🪟 Тётя Роза открыла форточку в чате.\n\nСквозняком сдуло {mentions['acc']} куда-то в угол чата. {mentions['nom']} там теперь сидит.\n\nСвежо.",
-                        f"🪟 Тётя Роза открыла форточку в чате.\n\nВорвался холод. {mentions['nom']} {'замёрзла' if gender == 'женский' else 'замёрз'} нахуй.\n\nЗакрываю."
-                    ]
-                    await processing_msg.edit_text(random.choice(fallback_events), parse_mode=ParseMode.HTML)
+                    fallback = random.choice(VENTILATE_FALLBACK_TEMPLATES)
+                    await processing_msg.edit_text(fallback(mentions, gender), parse_mode=ParseMode.HTML)
     
     except asyncio.TimeoutError:
         await processing_msg.edit_text("🪟 Форточка заклинила. Попробуй позже.")
@@ -4087,7 +4339,7 @@ async def generate_smart_reply(message: Message) -> str:
             "chat_context": chat_context[:1500] if chat_context else ""
         }, timeout=aiohttp.ClientTimeout(total=15)) as response:
             if response.status == 200:
-                result = await response.json()
+                result = await response.json(loads=json_loads)
                 reply = result.get("reply", "")
                 if reply:
                     logger.info(f"SMART REPLY generated for {user_name}: {reply[:50]}...")
@@ -4220,7 +4472,7 @@ async def extract_and_save_facts(message: Message) -> bool:
                 "user_name": user_name
             }, timeout=aiohttp.ClientTimeout(total=10)) as response:
                 if response.status == 200:
-                    result = await response.json()
+                    result = await response.json(loads=json_loads)
                     if result.get("has_facts") and result.get("facts"):
                         facts_to_save = result["facts"][:5]
                         api_success = True
@@ -4285,12 +4537,14 @@ async def cmd_say(message: Message):
     # Проверка кулдауна (TTS дорогой)
     user_id = message.from_user.id
     chat_id = message.chat.id
-    if not check_cooldown(user_id, chat_id, "say", 20):
+    can_do, _ = check_cooldown(user_id, chat_id, "say", 20)
+    if not can_do:
         await message.reply("⏳ Голосовые связки отдыхают. Подожди!")
         return
     
     # Rate limit для TTS API
-    if not check_api_rate_limit(chat_id, "tts"):
+    allowed, _ = check_api_rate_limit(chat_id, "tts")
+    if not allowed:
         await message.reply("⏳ Слишком много голосовых запросов!")
         return
     
@@ -4348,7 +4602,7 @@ async def cmd_say(message: Message):
                 await processing_msg.edit_text(f"❌ Ошибка генерации: {response.status}")
                 return
             
-            result = await response.json()
+            result = await response.json(loads=json_loads)
         
         audio_base64 = result.get("audio")
         if not audio_base64:
@@ -4356,7 +4610,6 @@ async def cmd_say(message: Message):
             return
         
         # Декодируем base64 в bytes
-        import base64
         audio_bytes = base64.b64decode(audio_base64)
         
         # Создаём файл для отправки
@@ -4487,7 +4740,7 @@ async def cmd_dream(message: Message):
                 await processing_msg.edit_text(f"Бля, забыла что снилось...")
                 return
             
-            result = await response.json()
+            result = await response.json(loads=json_loads)
         
         dream_text = result.get("dream", "Ничего не помню, память отшибло...")
         
@@ -4535,7 +4788,7 @@ async def search_images_serpapi(query: str, num_results: int = 20) -> list:
             timeout=aiohttp.ClientTimeout(total=20)
         ) as response:
             if response.status == 200:
-                data = await response.json()
+                data = await response.json(loads=json_loads)
                 return data.get("images_results", [])
             else:
                 error = await response.text()
@@ -4701,7 +4954,7 @@ async def cmd_svodka(message: Message):
             "📭 Слишком мало сообщений за последние 5 часов.\n"
             "Нужно хотя бы 5 сообщений для сводки!"
         )
-        cooldowns.pop((user_id, chat_id, "svodka"), None)
+        reset_cooldown(user_id, chat_id, "svodka")
         return
     
     # Получаем память (предыдущие сводки и воспоминания)
@@ -4737,7 +4990,7 @@ async def cmd_svodka(message: Message):
                 }
             ) as response:
                 if response.status == 200:
-                    result = await response.json()
+                    result = await response.json(loads=json_loads)
                     summary = result.get("summary", "Ошибка генерации сводки")
                     
                     # Сохраняем сводку в память
@@ -4793,15 +5046,15 @@ async def cmd_svodka(message: Message):
                         "❌ Ошибка при генерации сводки.\n"
                         "Попробуй позже или проверь настройки API."
                     )
-                    cooldowns.pop((user_id, chat_id, "svodka"), None)
+                    reset_cooldown(user_id, chat_id, "svodka")
     
     except asyncio.TimeoutError:
         await message.answer("⏰ Таймаут при генерации сводки. Попробуй позже.")
-        cooldowns.pop((user_id, chat_id, "svodka"), None)
+        reset_cooldown(user_id, chat_id, "svodka")
     except Exception as e:
         logger.error(f"Error generating summary: {e}")
         await message.answer("❌ Не удалось сгенерировать сводку. Попробуй позже!")
-        cooldowns.pop((user_id, chat_id, "svodka"), None)
+        reset_cooldown(user_id, chat_id, "svodka")
 
 
 # ==================== СБОР СООБЩЕНИЙ ====================
@@ -5258,8 +5511,8 @@ async def _save_text_message(message: Message):
     chat_id = message.chat.id
     user_id = message.from_user.id
     
-    # Сохраняем информацию о чате
-    await save_chat_info(
+    # Сохраняем информацию о чате (через буфер — это на каждое сообщение)
+    await queue_chat_info(
         chat_id=chat_id,
         title=message.chat.title,
         username=message.chat.username,
@@ -5276,18 +5529,22 @@ async def _save_text_message(message: Message):
         reply_to_first_name = message.reply_to_message.from_user.first_name
         reply_to_username = message.reply_to_message.from_user.username
     
-    await save_chat_message(
+    # Режем только длинные тексты — короткие уходят как есть
+    message_text = message.text or ""
+    if len(message_text) > 500:
+        message_text = message_text[:500]
+    
+    await queue_chat_message(
         chat_id=chat_id,
         user_id=user_id,
         username=message.from_user.username or "",
         first_name=message.from_user.first_name or "Аноним",
-        message_text=message.text[:500] if message.text else "",
+        message_text=message_text,
         message_type="text",
         reply_to_user_id=reply_to_user_id,
         reply_to_first_name=reply_to_first_name,
         reply_to_username=reply_to_username
     )
-    
     # Обновляем профиль пользователя (v2 - с расширенными данными)
     if USE_POSTGRES and message.text:
         try:
@@ -5309,8 +5566,9 @@ async def _save_text_message(message: Message):
     if player and player.get('player_class'):
         can_get_exp, _ = check_cooldown(user_id, chat_id, "message_exp", 30)
         if can_get_exp:
-            exp_gain = random.randint(1, 3)
-            money_gain = random.randint(0, 2)
+            # randrange напрямую — randint лишь обёртка над ним
+            exp_gain = random.randrange(1, 4)
+            money_gain = random.randrange(3)
             await update_player_stats(user_id, chat_id, experience=f"+{exp_gain}", money=f"+{money_gain}")
 
 
@@ -5361,17 +5619,16 @@ async def maybe_periodic_comment(message: Message):
     """Комментарий каждые 20-30 сообщений в чате"""
     chat_id = message.chat.id
 
-    _chat_msg_counter[chat_id] = _chat_msg_counter.get(chat_id, 0) + 1
-    current = _chat_msg_counter[chat_id]
+    current = _chat_msg_counter.get(chat_id, 0) + 1
+    _chat_msg_counter[chat_id] = current
 
-    if chat_id not in _chat_next_threshold:
-        _chat_next_threshold[chat_id] = random.randint(20, 30)
-
-    threshold = _chat_next_threshold[chat_id]
+    threshold = _chat_next_threshold.get(chat_id)
+    if threshold is None:
+        threshold = _chat_next_threshold[chat_id] = random.randrange(20, 31)
 
     if current >= threshold:
         _chat_msg_counter[chat_id] = 0
-        _chat_next_threshold[chat_id] = random.randint(20, 30)
+        _chat_next_threshold[chat_id] = random.randrange(20, 31)
 
         text = random.choice(PERIODIC_COMMENTS)
         try:
@@ -5393,8 +5650,8 @@ async def maybe_random_comment(message: Message) -> bool:
         return False
     
     # Проверяем кулдаун (не чаще раза в 5 минут на чат)
-    cooldown_key = f"random_comment_{chat_id}"
-    can_do, _ = check_cooldown(0, chat_id, cooldown_key, 300)
+    # chat_id уже входит в ключ кулдауна — в имени действия он не нужен
+    can_do, _ = check_cooldown(0, chat_id, "random_comment", 300)
     if not can_do:
         return False
     
@@ -5502,7 +5759,7 @@ async def who_is_this_handler(message: Message):
                     timeout=aiohttp.ClientTimeout(total=30)
                 ) as resp:
                     if resp.status == 200:
-                        result = await resp.json()
+                        result = await resp.json(loads=json_loads)
                         text = result.get("text", "Таблетка закончилась.")
                         await processing.edit_text(f"💊 Рецепт для {clickable}:\n\n{text}", parse_mode=ParseMode.HTML)
                     else:
@@ -6900,8 +7157,7 @@ async def transcribe_voice_message(message: Message) -> str:
         file = await bot.get_file(voice.file_id)
         voice_bytes = await bot.download_file(file.file_path)
         
-        import base64
-        audio_base64 = base64.b64encode(voice_bytes.read()).decode('utf-8')
+        audio_base64 = await b64encode_file(voice_bytes)
         
         # Определяем формат
         file_format = "ogg" if message.voice else "mp4"
@@ -6917,7 +7173,7 @@ async def transcribe_voice_message(message: Message) -> str:
             timeout=aiohttp.ClientTimeout(total=30)
         ) as response:
             if response.status == 200:
-                result = await response.json()
+                result = await response.json(loads=json_loads)
                 text = result.get("text", "")
                 if text:
                     logger.info(f"Voice transcribed: {text[:50]}...")
@@ -6963,8 +7219,7 @@ async def analyze_photo_for_reply(message: Message) -> str:
         file = await bot.get_file(photo.file_id)
         photo_bytes = await bot.download_file(file.file_path)
         
-        import base64
-        image_base64 = base64.b64encode(photo_bytes.read()).decode('utf-8')
+        image_base64 = await b64encode_file(photo_bytes)
         
         # Получаем описание фото
         session = await get_http_session()
@@ -6978,7 +7233,7 @@ async def analyze_photo_for_reply(message: Message) -> str:
             timeout=aiohttp.ClientTimeout(total=10)
         ) as response:
             if response.status == 200:
-                result = await response.json()
+                result = await response.json(loads=json_loads)
                 description = result.get("description", "")
                 if description:
                     # Генерируем грубый ответ на основе описания
@@ -7077,7 +7332,7 @@ async def generate_rude_response_to_content(content_type: str, description: str)
             timeout=aiohttp.ClientTimeout(total=8)
         ) as response:
             if response.status == 200:
-                result = await response.json()
+                result = await response.json(loads=json_loads)
                 text = result.get("text", "")
                 if text and len(text) < 200:
                     return text
@@ -7227,7 +7482,7 @@ async def collect_stickers(message: Message):
     if message.reply_to_message and message.reply_to_message.from_user:
         reply_to_user_id = message.reply_to_message.from_user.id
     
-    await save_chat_message(
+    await queue_chat_message(
         chat_id=message.chat.id,
         user_id=message.from_user.id,
         username=message.from_user.username or "",
@@ -7258,7 +7513,7 @@ async def collect_stickers(message: Message):
     
     # Сохраняем стикер в коллекцию (если это не анимированный/видео стикер)
     if sticker and not sticker.is_video and not sticker.is_animated:
-        await save_media(
+        await queue_media(
             chat_id=message.chat.id,
             user_id=message.from_user.id,
             file_id=sticker.file_id,
@@ -7278,7 +7533,9 @@ async def collect_photos(message: Message):
     if await is_reply_to_bot(message):
         await handle_bot_mention_or_reply(message)
     
-    caption = message.caption[:200] if message.caption else ""
+    caption = message.caption or ""
+    if len(caption) > 200:
+        caption = caption[:200]
     image_description = None
     
     # Анализируем фото через Vision API (только если есть API URL)
@@ -7292,16 +7549,7 @@ async def collect_photos(message: Message):
             # Скачиваем фото
             photo_bytes = await bot.download_file(file.file_path)
             
-            # Конвертируем в base64
-            import base64
-            import io
-            
-            if isinstance(photo_bytes, io.BytesIO):
-                photo_data = photo_bytes.getvalue()
-            else:
-                photo_data = photo_bytes
-            
-            image_base64 = base64.b64encode(photo_data).decode('utf-8')
+            image_base64 = await b64encode_file(photo_bytes)
             
             # Отправляем на анализ
             session = await get_http_session()
@@ -7314,7 +7562,7 @@ async def collect_photos(message: Message):
                 timeout=aiohttp.ClientTimeout(total=30)
             ) as response:
                 if response.status == 200:
-                    result = await response.json()
+                    result = await response.json(loads=json_loads)
                     image_description = result.get("description", "")[:300]
                     logger.info(f"Image analyzed: {image_description[:50]}...")
         except Exception as e:
@@ -7326,7 +7574,7 @@ async def collect_photos(message: Message):
     if message.reply_to_message and message.reply_to_message.from_user:
         reply_to_user_id = message.reply_to_message.from_user.id
     
-    await save_chat_message(
+    await queue_chat_message(
         chat_id=message.chat.id,
         user_id=message.from_user.id,
         username=message.from_user.username or "",
@@ -7360,7 +7608,7 @@ async def collect_photos(message: Message):
             logger.warning(f"Profile update error (photo): {e}", exc_info=True)
     
     # Сохраняем фото в коллекцию мемов
-    await save_media(
+    await queue_media(
         chat_id=message.chat.id,
         user_id=message.from_user.id,
         file_id=photo.file_id,
@@ -7371,11 +7619,9 @@ async def collect_photos(message: Message):
     )
     
     # Шанс 15% для теста (потом вернуть на 2-3%)
-    if random.random() < 0.15:
-        try:
-            await maybe_send_random_meme(message.chat.id, trigger="photo", target_user_id=message.from_user.id)
-        except Exception as e:
-            logger.warning(f"Failed to send random meme after photo: {e}")
+    # Мем шлём в фоне — хэндлер не ждёт отправку
+    if USE_POSTGRES and random.random() < 0.15:
+        spawn_background(maybe_send_random_meme(message.chat.id, trigger="photo", target_user_id=message.from_user.id))
 
 
 @router.message(F.animation)
@@ -7389,12 +7635,14 @@ async def collect_animations(message: Message):
         await handle_bot_mention_or_reply(message)
     
     animation = message.animation
-    caption = message.caption[:200] if message.caption else ""
+    caption = message.caption or ""
+    if len(caption) > 200:
+        caption = caption[:200]
     reply_to_user_id = None
     if message.reply_to_message and message.reply_to_message.from_user:
         reply_to_user_id = message.reply_to_message.from_user.id
     
-    await save_chat_message(
+    await queue_chat_message(
         chat_id=message.chat.id,
         user_id=message.from_user.id,
         username=message.from_user.username or "",
@@ -7423,7 +7671,7 @@ async def collect_animations(message: Message):
     
     # Сохраняем GIF в коллекцию
     if animation:
-        await save_media(
+        await queue_media(
             chat_id=message.chat.id,
             user_id=message.from_user.id,
             file_id=animation.file_id,
@@ -7433,11 +7681,9 @@ async def collect_animations(message: Message):
         )
     
     # Шанс 15% для теста (потом вернуть на 2-3%)
-    if random.random() < 0.15:
-        try:
-            await maybe_send_random_meme(message.chat.id, trigger="animation", target_user_id=message.from_user.id)
-        except Exception as e:
-            logger.warning(f"Failed to send random meme after animation: {e}")
+    # Мем шлём в фоне — хэндлер не ждёт отправку
+    if USE_POSTGRES and random.random() < 0.15:
+        spawn_background(maybe_send_random_meme(message.chat.id, trigger="animation", target_user_id=message.from_user.id))
 
 
 @router.message(F.voice | F.video_note)
@@ -7456,7 +7702,7 @@ async def collect_voice(message: Message):
     if message.reply_to_message and message.reply_to_message.from_user:
         reply_to_user_id = message.reply_to_message.from_user.id
     
-    await save_chat_message(
+    await queue_chat_message(
         chat_id=message.chat.id,
         user_id=message.from_user.id,
         username=message.from_user.username or "",
@@ -7501,7 +7747,7 @@ async def collect_voice(message: Message):
         description = f"Голосовое от {sender_name} ({voice.duration} сек)"
         if transcription:
             description += f": {transcription[:100]}"
-        await save_media(
+        await queue_media(
             chat_id=message.chat.id,
             user_id=message.from_user.id,
             file_id=voice.file_id,
@@ -7510,11 +7756,9 @@ async def collect_voice(message: Message):
             description=description
         )
         # Шанс 15% для теста (потом вернуть на 3%)
-        if random.random() < 0.15:
-            try:
-                await maybe_send_random_meme(message.chat.id, trigger="voice", target_user_id=message.from_user.id)
-            except Exception as e:
-                logger.warning(f"Failed to send random meme after voice: {e}")
+        # Мем шлём в фоне — хэндлер не ждёт отправку
+        if USE_POSTGRES and random.random() < 0.15:
+            spawn_background(maybe_send_random_meme(message.chat.id, trigger="voice", target_user_id=message.from_user.id))
     
     elif message.video_note:
         video_note = message.video_note
@@ -7523,7 +7767,7 @@ async def collect_voice(message: Message):
         description = f"Кружочек от {sender_name} ({video_note.duration} сек)"
         if transcription:
             description += f": {transcription[:100]}"
-        await save_media(
+        await queue_media(
             chat_id=message.chat.id,
             user_id=message.from_user.id,
             file_id=video_note.file_id,
@@ -7532,11 +7776,9 @@ async def collect_voice(message: Message):
             description=description
         )
         # Шанс 15% для теста (потом вернуть на 3%)
-        if random.random() < 0.15:
-            try:
-                await maybe_send_random_meme(message.chat.id, trigger="video_note", target_user_id=message.from_user.id)
-            except Exception as e:
-                logger.warning(f"Failed to send random meme after video_note: {e}")
+        # Мем шлём в фоне — хэндлер не ждёт отправку
+        if USE_POSTGRES and random.random() < 0.15:
+            spawn_background(maybe_send_random_meme(message.chat.id, trigger="video_note", target_user_id=message.from_user.id))
 
 
 @router.message(F.video)
@@ -7550,12 +7792,14 @@ async def collect_videos(message: Message):
         await handle_bot_mention_or_reply(message)
     
     video = message.video
-    caption = message.caption[:200] if message.caption else ""
+    caption = message.caption or ""
+    if len(caption) > 200:
+        caption = caption[:200]
     reply_to_user_id = None
     if message.reply_to_message and message.reply_to_message.from_user:
         reply_to_user_id = message.reply_to_message.from_user.id
     
-    await save_chat_message(
+    await queue_chat_message(
         chat_id=message.chat.id,
         user_id=message.from_user.id,
         username=message.from_user.username or "",
@@ -7586,7 +7830,7 @@ async def collect_videos(message: Message):
     if video:
         sender_name = message.from_user.first_name or "Аноним"
         duration = video.duration or 0
-        await save_media(
+        await queue_media(
             chat_id=message.chat.id,
             user_id=message.from_user.id,
             file_id=video.file_id,
@@ -7597,11 +7841,9 @@ async def collect_videos(message: Message):
         )
     
     # Шанс 15% для теста
-    if random.random() < 0.15:
-        try:
-            await maybe_send_random_meme(message.chat.id, trigger="video", target_user_id=message.from_user.id)
-        except Exception as e:
-            logger.warning(f"Failed to send random meme after video: {e}")
+    # Мем шлём в фоне — хэндлер не ждёт отправку
+    if USE_POSTGRES and random.random() < 0.15:
+        spawn_background(maybe_send_random_meme(message.chat.id, trigger="video", target_user_id=message.from_user.id))
 
 
 @router.message(F.audio)
@@ -7615,12 +7857,14 @@ async def collect_audio(message: Message):
         await handle_bot_mention_or_reply(message)
     
     audio = message.audio
-    caption = message.caption[:200] if message.caption else ""
+    caption = message.caption or ""
+    if len(caption) > 200:
+        caption = caption[:200]
     reply_to_user_id = None
     if message.reply_to_message and message.reply_to_message.from_user:
         reply_to_user_id = message.reply_to_message.from_user.id
     
-    await save_chat_message(
+    await queue_chat_message(
         chat_id=message.chat.id,
         user_id=message.from_user.id,
         username=message.from_user.username or "",
@@ -7660,7 +7904,7 @@ async def collect_audio(message: Message):
         title = audio.title or "Без названия"
         performer = audio.performer or sender_name
         duration = audio.duration or 0
-        await save_media(
+        await queue_media(
             chat_id=message.chat.id,
             user_id=message.from_user.id,
             file_id=audio.file_id,
@@ -7671,17 +7915,18 @@ async def collect_audio(message: Message):
         )
     
     # Шанс 15% для теста
-    if random.random() < 0.15:
-        try:
-            await maybe_send_random_meme(message.chat.id, trigger="audio", target_user_id=message.from_user.id)
-        except Exception as e:
-            logger.warning(f"Failed to send random meme after audio: {e}")
+    # Мем шлём в фоне — хэндлер не ждёт отправку
+    if USE_POSTGRES and random.random() < 0.15:
+        spawn_background(maybe_send_random_meme(message.chat.id, trigger="audio", target_user_id=message.from_user.id))
 
 
 # ==================== СИСТЕМА МЕМОВ ====================
 
+# Свой генератор для мемов: random.Random без обращений к модулю random
+_meme_rng = random.Random()
+
 # Комментарии Тёти Розы к мемам
-MEME_COMMENTS = [
+MEME_COMMENTS = (
     "О, вспомнила! Вот это было, блять... 🤔",
     "А помните эту хуйню? Я — да.",
     "Нашла в архивах. Классика жанра.",
@@ -7697,10 +7942,10 @@ MEME_COMMENTS = [
     "Ваши мемы — моя боль. Вот.",
     "Архив открыт. Берите что дают.",
     "Культурная программа от Тёти Розы.",
-]
+)
 
 # Комментарии к голосовым сообщениям
-VOICE_COMMENTS = [
+VOICE_COMMENTS = (
     "🎤 Нашла в архиве чьё-то пьяное бормотание. Наслаждайтесь.",
     "🎤 Кто-то это записывал. Теперь все послушают.",
     "🎤 Голосовуха из прошлого. Компромат навеки.",
@@ -7716,18 +7961,18 @@ VOICE_COMMENTS = [
     "🎤 Это записали трезвым? Сомневаюсь.",
     "🎤 Голосовое сообщение эпохи. Какой эпохи — хуй знает.",
     "🎤 Компромат дня. Или ночи. Зависит от того, когда записывали.",
-]
+)
 
 # Комментарии к кружочкам
-VIDEO_NOTE_COMMENTS = [
+VIDEO_NOTE_COMMENTS = (
     "🔵 Кружочек из прошлого! Кто-то показал ебало.",
     "🔵 Нашла видосик. Лицо — огонь. В плохом смысле.",
     "🔵 Архивный кружок. Смотрите на это лицо и думайте о жизни.",
     "🔵 Кто-то записал это. Теперь не развидеть.",
-]
+)
 
 # Комментарии к видео
-VIDEO_COMMENTS = [
+VIDEO_COMMENTS = (
     "📹 Видосик из архива! Кто-то снял эту хуйню.",
     "📹 Нашла видео в закромах. Наслаждайтесь.",
     "📹 Архивное видео. Кинематограф уровня 'бог'.",
@@ -7738,10 +7983,10 @@ VIDEO_COMMENTS = [
     "📹 Архив открыт. Видеосекция.",
     "📹 Кто снимал — молодец. Или нет. Смотрите сами.",
     "📹 Культурное наследие чата в видеоформате.",
-]
+)
 
 # Комментарии к аудио
-AUDIO_COMMENTS = [
+AUDIO_COMMENTS = (
     "🎵 Музычка из архива! Кто-то это слушал.",
     "🎵 Нашла трек в закромах. Врубайте.",
     "🎵 Аудио из коллекции. Вкусы у вас... интересные.",
@@ -7752,7 +7997,51 @@ AUDIO_COMMENTS = [
     "🎵 Аудиокультура чата. Наслаждайтесь.",
     "🎵 Трек дня. Или ночи. Зависит от настроения.",
     "🎵 Музыкальный архив открыт. Держите.",
-]
+)
+
+# Аргумент /мем → тип медиа в коллекции
+_MEME_TYPE_MAP = {
+    "фото": "photo", "photo": "photo", "картинка": "photo",
+    "стикер": "sticker", "sticker": "sticker",
+    "гиф": "animation", "gif": "animation", "гифка": "animation",
+    "голосовое": "voice", "voice": "voice", "войс": "voice", "голосовуха": "voice",
+    "кружок": "video_note", "кружочек": "video_note",
+    "видео": "video", "video": "video", "видос": "video", "видосик": "video",
+    "аудио": "audio", "audio": "audio", "музыка": "audio", "трек": "audio"
+}
+
+# Как отправлять медиа из коллекции: тип → (метод Bot, где комментарий)
+# caption — подписью, before/after — отдельным сообщением до/после файла
+_MEDIA_SENDERS = {
+    "photo": ("send_photo", "caption"),
+    "sticker": ("send_sticker", "after"),
+    "animation": ("send_animation", "caption"),
+    "voice": ("send_voice", "before"),
+    "video_note": ("send_video_note", "before"),
+    "video": ("send_video", "caption"),
+    "audio": ("send_audio", "before"),
+}
+
+
+async def send_collected_media(
+    chat_id: int, file_type: str, file_id: str, comment: str,
+    message_thread_id: Optional[int] = None
+) -> bool:
+    """Отправить медиа из коллекции с комментарием. False — неизвестный тип."""
+    sender = _MEDIA_SENDERS.get(file_type)
+    if sender is None:
+        return False
+    method, comment_mode = sender
+    send = getattr(bot, method)
+    if comment_mode == "caption":
+        await send(chat_id, file_id, caption=comment, message_thread_id=message_thread_id)
+        return True
+    if comment_mode == "before":
+        await bot.send_message(chat_id, comment, message_thread_id=message_thread_id)
+    await send(chat_id, file_id, message_thread_id=message_thread_id)
+    if comment_mode == "after":
+        await bot.send_message(chat_id, comment, message_thread_id=message_thread_id)
+    return True
 
 
 async def maybe_send_random_meme(chat_id: int, trigger: str = "random", target_user_id: int = None):
@@ -7760,6 +8049,7 @@ async def maybe_send_random_meme(chat_id: int, trigger: str = "random", target_u
     if not USE_POSTGRES:
         return
     
+    choice = _meme_rng.choice
     try:
         media = await get_random_media(chat_id)
         if not media:
@@ -7767,7 +8057,6 @@ async def maybe_send_random_meme(chat_id: int, trigger: str = "random", target_u
         
         file_id = media['file_id']
         file_type = media['file_type']
-        media_id = media['id']
         description = media.get('description', '')
         
         # Получаем профиль пользователя для персонализации комментария (per-chat!)
@@ -7780,18 +8069,18 @@ async def maybe_send_random_meme(chat_id: int, trigger: str = "random", target_u
         
         # Выбираем комментарий в зависимости от типа
         if file_type == "voice":
-            comment = random.choice(VOICE_COMMENTS)
+            comment = choice(VOICE_COMMENTS)
         elif file_type == "video_note":
-            comment = random.choice(VIDEO_NOTE_COMMENTS)
+            comment = choice(VIDEO_NOTE_COMMENTS)
         elif file_type == "video":
-            comment = random.choice(VIDEO_COMMENTS)
+            comment = choice(VIDEO_COMMENTS)
         elif file_type == "audio":
-            comment = random.choice(AUDIO_COMMENTS)
+            comment = choice(AUDIO_COMMENTS)
         else:
-            comment = random.choice(MEME_COMMENTS)
+            comment = choice(MEME_COMMENTS)
         
         # Персонализированные добавки к комментарию (20% шанс)
-        if user_profile and random.random() < 0.20:
+        if user_profile and _meme_rng.random() < 0.20:
             interests = user_profile.get('interests', [])
             style = user_profile.get('communication_style', '')
             
@@ -7811,30 +8100,11 @@ async def maybe_send_random_meme(chat_id: int, trigger: str = "random", target_u
                 personalized_additions.append(" Ночным совам привет.")
             
             if personalized_additions:
-                comment += random.choice(personalized_additions)
-        
-        # Отправляем в зависимости от типа
-        if file_type == "photo":
-            await bot.send_photo(chat_id, file_id, caption=comment)
-        elif file_type == "sticker":
-            await bot.send_sticker(chat_id, file_id)
-            await bot.send_message(chat_id, comment)
-        elif file_type == "animation":
-            await bot.send_animation(chat_id, file_id, caption=comment)
-        elif file_type == "voice":
-            await bot.send_message(chat_id, comment)
-            await bot.send_voice(chat_id, file_id)
-        elif file_type == "video_note":
-            await bot.send_message(chat_id, comment)
-            await bot.send_video_note(chat_id, file_id)
-        elif file_type == "video":
-            await bot.send_video(chat_id, file_id, caption=comment)
-        elif file_type == "audio":
-            await bot.send_message(chat_id, comment)
-            await bot.send_audio(chat_id, file_id)
+                comment += choice(personalized_additions)
+        
+        if not await send_collected_media(chat_id, file_type, file_id, comment):
+            return
         
-        # Увеличиваем счётчик использования
-        await increment_media_usage(media_id)
         logger.info(f"Sent random meme (type={file_type}) to chat {chat_id}, trigger={trigger}")
         
     except Exception as e:
@@ -7872,19 +8142,8 @@ async def cmd_random_meme(message: Message):
         return
     
     # Определяем тип (если указан)
-    args = message.text.split()
-    file_type = None
-    if len(args) > 1:
-        type_map = {
-            "фото": "photo", "photo": "photo", "картинка": "photo",
-            "стикер": "sticker", "sticker": "sticker",
-            "гиф": "animation", "gif": "animation", "гифка": "animation",
-            "голосовое": "voice", "voice": "voice", "войс": "voice", "голосовуха": "voice",
-            "кружок": "video_note", "кружочек": "video_note",
-            "видео": "video", "video": "video", "видос": "video", "видосик": "video",
-            "аудио": "audio", "audio": "audio", "музыка": "audio", "трек": "audio"
-        }
-        file_type = type_map.get(args[1].lower())
+    args = message.text.split(maxsplit=2)
+    file_type = _MEME_TYPE_MAP.get(args[1].lower()) if len(args) > 1 else None
     
     media = await get_random_media(chat_id, file_type)
     
@@ -7896,40 +8155,23 @@ async def cmd_random_meme(message: Message):
     media_type = media['file_type']
     media_id = media['id']
     
+    choice = _meme_rng.choice
     try:
         # Выбираем комментарий по типу медиа
         if media_type == "voice":
-            comment = random.choice(VOICE_COMMENTS)
-        elif media_type == "video_note":
-            comment = random.choice(VIDEO_NOTE_COMMENTS)
-        else:
-            comment = random.choice(MEME_COMMENTS)
-        
-        if media_type == "photo":
-            await message.answer_photo(file_id, caption=comment)
-        elif media_type == "sticker":
-            await message.answer_sticker(file_id)
-            await message.answer(comment)
-        elif media_type == "animation":
-            await message.answer_animation(file_id, caption=comment)
-        elif media_type == "voice":
-            await message.answer(comment)
-            await message.answer_voice(file_id)
+            comment = choice(VOICE_COMMENTS)
         elif media_type == "video_note":
-            await message.answer(comment)
-            await message.answer_video_note(file_id)
-        elif media_type == "video":
-            await message.answer_video(file_id, caption=comment)
-        elif media_type == "audio":
-            await message.answer(comment)
-            await message.answer_audio(file_id)
+            comment = choice(VIDEO_NOTE_COMMENTS)
         else:
+            comment = choice(MEME_COMMENTS)
+        
+        thread_id = message.message_thread_id if message.is_topic_message else None
+        if not await send_collected_media(chat_id, media_type, file_id, comment, thread_id):
             # Неизвестный тип — просто логируем
             logger.warning(f"Unknown media type: {media_type}")
             await message.answer("❓ Странный мем — не знаю как отправить.")
             return
         
-        await increment_media_usage(media_id)
         metrics.track_command("meme")
         
     except TelegramBadRequest as e:
@@ -8068,7 +8310,7 @@ FUNNY: <тот же смысл но с матом и угаром, максим
                         timeout=aiohttp.ClientTimeout(total=15)
                     ) as ai_resp:
                         if ai_resp.status == 200:
-                            ai_result = await ai_resp.json()
+                            ai_result = await ai_resp.json(loads=json_loads)
                             ai_text = ai_result.get("content", [{}])[0].get("text", "").strip()
                             logger.info(f"AI meme raw: {ai_text}")
                             for line in ai_text.splitlines():
@@ -8107,7 +8349,7 @@ FUNNY: <тот же смысл но с матом и угаром, максим
             if resp.status != 200:
                 await processing.edit_text(f"❌ Supermeme ошибка ({resp.status}): {raw[:150]}")
                 return
-            result = json.loads(raw)
+            result = json_loads(raw)
 
         memes = result.get("memes", [])
         if not memes:
@@ -8218,7 +8460,7 @@ async def cmd_ai_visual(message: Message, command: CommandObject):
             if resp.status != 200:
                 await processing.edit_text(f"❌ Ошибка ({resp.status}): {raw[:150]}")
                 return
-            result = json.loads(raw)
+            result = json_loads(raw)
 
         images = result.get("images", [])
         if not images:
@@ -8315,7 +8557,7 @@ async def cmd_gif(message: Message, command: CommandObject):
                     timeout=aiohttp.ClientTimeout(total=30)
                 ) as resp:
                     if resp.status == 200:
-                        result = await resp.json()
+                        result = await resp.json(loads=json_loads)
                         logger.info(f"Supermeme text-to-gif response: {result}")
                         # Может вернуть url, gifUrl, memes[0], output и т.п.
                         gif_url = (
@@ -8361,22 +8603,25 @@ async def cmd_meme_stats(message: Message):
         return
     
     stats = await get_media_stats(message.chat.id)
+    total, photo, sticker, animation, voice, video_note = (
+        stats.get(k, 0) for k in ('total', 'photo', 'sticker', 'animation', 'voice', 'video_note')
+    )
     
     text = f"""🎭 КОЛЛЕКЦИЯ МЕМОВ ЧАТА
 
-📊 Всего: {stats.get('total', 0)} медиа
+📊 Всего: {total} медиа
 
 По типам:
-🖼 Фото: {stats.get('photo', 0)}
-😀 Стикеры: {stats.get('sticker', 0)}
-🎬 Гифки: {stats.get('animation', 0)}
-🎤 Голосовые: {stats.get('voice', 0)}
-🔵 Кружочки: {stats.get('video_note', 0)}
+🖼 Фото: {photo}
+😀 Стикеры: {sticker}
+🎬 Гифки: {animation}
+🎤 Голосовые: {voice}
+🔵 Кружочки: {video_note}
 
 💡 Кидайте мемы, голосовые, кружочки — бот запоминает и выдаёт!
 Команда /мем — получить рандомный мем
 """
-    await message.answer(text)
+    await message.answer(text, parse_mode=None)
 
 
 # ==================== ОЧИСТКА И МОНИТОРИНГ ====================
@@ -8474,7 +8719,7 @@ async def scheduled_auto_summaries():
                         timeout=aiohttp.ClientTimeout(total=60)
                     ) as response:
                         if response.status == 200:
-                            result = await response.json()
+                            result = await response.json(loads=json_loads)
                             summary = result.get("summary", "")
                             
                             if summary and len(summary) > 50:
@@ -8564,21 +8809,22 @@ async def scheduled_auto_summaries():
 
 
 async def cleanup_memory():
-    """Очистка памяти (cooldowns и api_calls) — запускается каждые 10 минут"""
+    """Очистка памяти (cooldowns, api_buckets, события) — запускается каждую минуту"""
     try:
         cooldowns_before = len(cooldowns)
-        api_calls_before = len(api_calls)
+        api_buckets_before = len(api_buckets)
         
-        cleanup_cooldowns()
-        cleanup_api_calls()
+        await cleanup_cooldowns()
+        await cleanup_api_buckets()
+        cleanup_active_events()
         
         cooldowns_after = len(cooldowns)
-        api_calls_after = len(api_calls)
+        api_buckets_after = len(api_buckets)
         
-        if cooldowns_before != cooldowns_after or api_calls_before != api_calls_after:
+        if cooldowns_before != cooldowns_after or api_buckets_before != api_buckets_after:
             logger.info(
                 f"🧹 Очистка памяти: cooldowns {cooldowns_before}→{cooldowns_after}, "
-                f"api_calls {api_calls_before}→{api_calls_after}"
+                f"api_buckets {api_buckets_before}→{api_buckets_after}"
             )
     except Exception as e:
         logger.error(f"❌ Ошибка очистки памяти: {e}")
@@ -8590,7 +8836,6 @@ def _parse_pub_date(raw: str) -> float:
     """Парсит дату публикации в unix timestamp. Возвращает 0 если не удалось."""
     if not raw:
         return 0.0
-    from datetime import datetime, timezone
     for fmt in (
         "%Y-%m-%d %H:%M:%S %z",
         "%Y-%m-%dT%H:%M:%SZ",
@@ -8634,10 +8879,10 @@ async def _fetch_currents(session: aiohttp.ClientSession) -> list[dict]:
         )
         async with ru as r:
             if r.status == 200:
-                results += _parse_items((await r.json()).get("news", []))
+                results += _parse_items((await r.json(loads=json_loads)).get("news", []))
         async with en as r:
             if r.status == 200:
-                results += _parse_items((await r.json()).get("news", []))
+                results += _parse_items((await r.json(loads=json_loads)).get("news", []))
     except Exception as e:
         logger.warning(f"Currents API error: {e}")
     return results
@@ -8658,7 +8903,7 @@ async def _fetch_gnews(session: aiohttp.ClientSession) -> list[dict]:
                     {"title": a.get("title", ""), "description": a.get("description", ""),
                      "url": a.get("url", ""), "image": a.get("image", ""),
                      "published_at": _parse_pub_date(a.get("publishedAt", ""))}
-                    for a in (await r.json()).get("articles", [])
+                    for a in (await r.json(loads=json_loads)).get("articles", [])
                 ]
     except Exception as e:
         logger.warning(f"GNews API error: {e}")
@@ -8680,7 +8925,7 @@ async def _fetch_thenewsapi(session: aiohttp.ClientSession) -> list[dict]:
                     {"title": a.get("title", ""), "description": a.get("description", ""),
                      "url": a.get("url", ""), "image": a.get("image_url", ""),
                      "published_at": _parse_pub_date(a.get("published_at", ""))}
-                    for a in (await r.json()).get("data", [])
+                    for a in (await r.json(loads=json_loads)).get("data", [])
                 ]
     except Exception as e:
         logger.warning(f"TheNewsAPI error: {e}")
@@ -8699,7 +8944,7 @@ async def _fetch_newsapi(session: aiohttp.ClientSession) -> list[dict]:
             timeout=aiohttp.ClientTimeout(total=15)
         ) as r:
             if r.status == 200:
-                data = await r.json()
+                data = await r.json(loads=json_loads)
                 articles = data.get("articles", [])
                 if not articles:
                     async with session.get(
@@ -8708,7 +8953,7 @@ async def _fetch_newsapi(session: aiohttp.ClientSession) -> list[dict]:
                         timeout=aiohttp.ClientTimeout(total=15)
                     ) as r2:
                         if r2.status == 200:
-                            articles = (await r2.json()).get("articles", [])
+                            articles = (await r2.json(loads=json_loads)).get("articles", [])
                 return [
                     {"title": a.get("title", ""), "description": a.get("description", ""),
                      "url": a.get("url", ""), "image": a.get("urlToImage", ""),
@@ -8723,7 +8968,6 @@ async def _fetch_newsapi(session: aiohttp.ClientSession) -> list[dict]:
 async def _fetch_gdelt(session: aiohttp.ClientSession) -> list[dict]:
     """GDELT DOC API — полностью бесплатно, только свежие новости (последние 30 мин)"""
     try:
-        from datetime import datetime, timedelta, timezone
         # Берём новости за последние 2 часа (30 мин часто пусто)
         since = (datetime.now(timezone.utc) - timedelta(hours=2)).strftime("%Y%m%d%H%M%S")
         # Исключаем технические сайты, берём политику/экономику/общество
@@ -8855,7 +9099,7 @@ async def build_news_digest() -> str | None:
             raw = await resp.text()
             logger.info(f"News AI status={resp.status} body={raw[:300]}")
             if resp.status == 200:
-                result = json.loads(raw)
+                result = json_loads(raw)
                 digest = result.get("content", [{}])[0].get("text", "").strip()
                 if digest:
                     return digest
@@ -8865,7 +9109,6 @@ async def build_news_digest() -> str | None:
         logger.error(f"News digest AI error: {e}")
 
     # Fallback: отдаём сырые заголовки без AI-категоризации
-    from datetime import datetime
     fallback = f"📰 Свежие новости ({datetime.now().strftime('%H:%M')}):\n\n"
     fallback += "\n".join(f"• {h.split(' / ')[0].lstrip('- ')}" for h in headlines[:15])
     return fallback
@@ -8875,33 +9118,28 @@ async def build_news_digest() -> str | None:
 _sent_news: dict[str, float] = {}
 
 
+# Ключевые слова категорий новостей — проверяются по порядку, первое совпадение побеждает
+_NEWS_CATEGORY_KEYWORDS = (
+    ("ЖЁСТКОЕ", ("убит", "убили", "погиб", "погибли", "взрыв", "теракт", "война", "атака",
+                 "катастроф", "авиакрушен", "крушен", "стрельб", "расстрел", "арест",
+                 "задержан", "осуждён", "тюрьм", "убийств", "нападен", "жертв")),
+    ("ГРУСТНОЕ", ("трагедия", "скончался", "умер", "умерла", "похороны", "смерть", "горе",
+                  "пожар", "наводнение", "землетрясение", "голод", "бедствие", "эпидемия")),
+    ("СМЕШНОЕ", ("смешн", "абсурд", "курьёз", "нелепо", "странн", "забавн", "анекдот",
+                 "пьяный", "пьяная", "случайно", "перепутал", "обнаружили на")),
+    ("ВАЖНОЕ", ("санкции", "выборы", "президент", "министр", "правительство", "закон",
+                "цб", "цена", "инфляция", "ввп", "нато", "оон", "байден", "трамп",
+                "путин", "экономик", "кризис", "переговоры", "договор", "ядерн")),
+)
+
+
 def _categorize_news_item(title: str, description: str) -> str:
     """Определяет категорию новости по ключевым словам — без AI, мгновенно."""
     text = (title + " " + description).lower()
 
-    harsh = ["убит", "убили", "погиб", "погибли", "взрыв", "теракт", "война", "атака",
-             "катастроф", "авиакрушен", "крушен", "стрельб", "расстрел", "арест",
-             "задержан", "осуждён", "тюрьм", "убийств", "нападен", "жертв"]
-    sad = ["трагедия", "скончался", "умер", "умерла", "похороны", "смерть", "горе",
-           "пожар", "наводнение", "землетрясение", "голод", "бедствие", "эпидемия"]
-    funny = ["смешн", "абсурд", "курьёз", "нелепо", "странн", "забавн", "анекдот",
-             "пьяный", "пьяная", "случайно", "перепутал", "обнаружили на"]
-    important = ["санкции", "выборы", "президент", "министр", "правительство", "закон",
-                 "цб", "цена", "инфляция", "ввп", "нато", "оон", "байден", "трамп",
-                 "путин", "экономик", "кризис", "переговоры", "договор", "ядерн"]
-
-    for kw in harsh:
-        if kw in text:
-            return "ЖЁСТКОЕ"
-    for kw in sad:
-        if kw in text:
-            return "ГРУСТНОЕ"
-    for kw in funny:
-        if kw in text:
-            return "СМЕШНОЕ"
-    for kw in important:
-        if kw in text:
-            return "ВАЖНОЕ"
+    for category, keywords in _NEWS_CATEGORY_KEYWORDS:
+        if any(kw in text for kw in keywords):
+            return category
     return "ВАЖНОЕ"
 
 
@@ -8976,7 +9214,6 @@ async def scheduled_news_monitor():
             return
 
         # Категоризируем и отправляем каждую новую новость
-        from datetime import datetime
         now = time.time()
         for item in fresh_news[:10]:  # Не больше 10 за раз чтобы не спамить
             title = (item.get("title") or "").strip()
@@ -9034,7 +9271,6 @@ async def scheduled_news_digest():
         digest = await build_news_digest()
         if not digest:
             return
-        from datetime import datetime
         now = datetime.now().strftime("%d.%m %H:%M")
         text = f"📰 <b>Дайджест {now}</b>\n\n{digest}"
         for admin_id in ADMIN_IDS:
@@ -9050,7 +9286,16 @@ async def scheduled_news_digest():
 # ==================== АДМИНКА ====================
 
 # ID администраторов (добавь свой Telegram ID)
-ADMIN_IDS = {int(x) for x in os.getenv("ADMIN_IDS", "").split(",") if x.strip().isdigit()}
+ADMIN_IDS = frozenset(int(x) for x in os.getenv("ADMIN_IDS", "").split(",") if x.strip().isdigit())
+if not ADMIN_IDS:
+    logger.warning("ADMIN_IDS не настроен! Админские команды недоступны.")
+
+
+# Чистка названий/имён от символов разметки за один проход
+_TITLE_TRANS = str.maketrans({'_': ' ', '*': None})
+
+# Платформа не меняется за время жизни процесса — считаем один раз
+_PLATFORM_INFO = f"{platform.system()} {platform.release()}".replace('_', '-')
 
 
 def admin_only(func):
@@ -9082,13 +9327,61 @@ def admin_postgres_only(func):
 
 def is_admin(user_id: int) -> bool:
     """Проверить, является ли пользователь админом"""
-    # Если ADMIN_IDS не настроен — запрещаем всем (безопасность)
-    if not ADMIN_IDS:
-        logger.warning(f"ADMIN_IDS не настроен! Пользователь {user_id} пытался использовать админку.")
-        return False
+    # Пустой ADMIN_IDS — запрещаем всем (безопасность)
     return user_id in ADMIN_IDS
 
 
+# Кэш тяжёлых админских выборок {(fn, args): (expires_ts, value)}
+ADMIN_CACHE_TTL = 60
+ADMIN_CACHE_MAX = 256
+_admin_cache: dict = {}
+
+
+async def cached(fn, *args, ttl: float = ADMIN_CACHE_TTL):
+    """Вызвать DAO-функцию через TTL-кэш (повторные нажатия — из памяти)"""
+    key = (fn.__name__, args)
+    now = time.monotonic()
+    entry = _admin_cache.pop(key, None)
+    if entry is not None and entry[0] > now:
+        # Переставляем в конец — самые свежие обращения вытесняются последними
+        _admin_cache[key] = entry
+        return entry[1]
+    value = await fn(*args)
+    _admin_cache[key] = (now + ttl, value)
+    while len(_admin_cache) > ADMIN_CACHE_MAX:
+        del _admin_cache[next(iter(_admin_cache))]
+    return value
+
+
+# Кэш названий чатов из Telegram API {chat_id: (expires_ts, (title, username))}
+CHAT_INFO_TTL = 600
+CHAT_INFO_NEGATIVE_TTL = 60
+_chat_info_cache: dict = {}
+
+
+async def get_chat_info_cached(chat_id: int) -> tuple:
+    """Название и username чата через bot.get_chat с кэшем в памяти"""
+    now = time.monotonic()
+    entry = _chat_info_cache.get(chat_id)
+    if entry is not None and entry[0] > now:
+        return entry[1]
+    try:
+        tg_chat = await bot.get_chat(chat_id)
+    except Exception:
+        # Недоступные чаты тоже кэшируем, но ненадолго
+        info = (None, None)
+        _chat_info_cache[chat_id] = (now + CHAT_INFO_NEGATIVE_TTL, info)
+        return info
+    info = (tg_chat.title, tg_chat.username)
+    _chat_info_cache[chat_id] = (now + CHAT_INFO_TTL, info)
+    # Сохраняем в БД на будущее
+    try:
+        await save_chat_info(chat_id, tg_chat.title, tg_chat.username, tg_chat.type)
+    except Exception as e:
+        logger.warning(f"save_chat_info failed for {chat_id}: {e}")
+    return info
+
+
 @router.message(Command("admin", "админ", "panel"))
 async def cmd_admin(message: Message):
     """Главное меню админки"""
@@ -9170,7 +9463,6 @@ async def cmd_news_digest(message: Message):
         )
         return
 
-    from datetime import datetime
     now = datetime.now().strftime("%d.%m %H:%M")
     await processing.edit_text(
         f"📰 <b>Дайджест {now}</b>\n\n{digest}",
@@ -9254,16 +9546,23 @@ async def cmd_chats(message: Message):
     
     try:
         processing = await message.answer("📋 Загружаю список чатов...")
-        chats = await get_all_chats_stats()
+        chats = await cached(get_all_chats_stats, 20)
         
         if not chats:
             await processing.edit_text("📭 Нет данных о чатах")
             return
         
-        from datetime import datetime
+        # Если нет инфо — получаем из Telegram API параллельно
+        missing = [
+            chat['chat_id'] for chat in chats
+            if not chat.get('chat_title') and not chat.get('chat_username')
+        ]
+        fetched = dict(zip(missing, await asyncio.gather(
+            *(get_chat_info_cached(cid) for cid in missing)
+        ))) if missing else {}
         
         lines = ["📋 СПИСОК ЧАТОВ\n"]
-        for i, chat in enumerate(chats[:20], 1):
+        for i, chat in enumerate(chats, 1):
             chat_id = chat['chat_id']
             title = chat.get('chat_title')
             username = chat.get('chat_username')
@@ -9272,24 +9571,11 @@ async def cmd_chats(message: Message):
             today = chat['messages_24h']
             last = chat['last_activity']
             
-            # Если нет инфо — получаем из Telegram API
-            if not title and not username:
-                try:
-                    tg_chat = await bot.get_chat(chat_id)
-                    title = tg_chat.title
-                    username = tg_chat.username
-                    # Сохраняем в БД на будущее
-                    await save_chat_info(chat_id, title, username, tg_chat.type)
-                except Exception:
-                    title = None
-                    username = None
+            if chat_id in fetched:
+                title, username = fetched[chat_id]
             
-            # Форматируем время последней активности
-            if last:
-                last_dt = datetime.fromtimestamp(last)
-                last_str = last_dt.strftime("%d.%m %H:%M")
-            else:
-                last_str = "—"
+            # Время последней активности — в локальном времени хоста, как и остальные даты
+            last_str = datetime.fromtimestamp(last).strftime("%d.%m %H:%M") if last else "—"
             
             # Определяем активность
             if today > 100:
@@ -9305,7 +9591,7 @@ async def cmd_chats(message: Message):
             if username:
                 chat_name = f"@{username}"
             elif title:
-                chat_name = title[:30].replace('_', ' ').replace('*', '')
+                chat_name = title[:30].translate(_TITLE_TRANS)
             else:
                 chat_name = f"Чат {chat_id}"
             
@@ -9314,12 +9600,13 @@ async def cmd_chats(message: Message):
                 f"   📝 {total:,} | 👥 {users} | 🕐 {last_str}"
             )
         
-        if len(chats) > 20:
-            lines.append(f"\n...и ещё {len(chats) - 20} чатов")
+        hidden = chats[0]['total_chats'] - len(chats)
+        if hidden > 0:
+            lines.append(f"\n...и ещё {hidden} чатов")
         
         lines.append(f"\n💡 Детали: /chat <id>")
         
-        await processing.edit_text("\n".join(lines))
+        await processing.edit_text("\n".join(lines), parse_mode=None)
     except Exception as e:
         logger.error(f"Error in chats: {e}")
         await message.answer(f"❌ Ошибка: {e}")
@@ -9336,7 +9623,7 @@ async def cmd_chat_details(message: Message):
         return
     
     # Парсим chat_id из команды
-    parts = message.text.split()
+    parts = message.text.split(maxsplit=2)
     if len(parts) < 2:
         await message.answer("❌ Укажи ID чата: `/chat -1001234567890`", parse_mode=ParseMode.MARKDOWN)
         return
@@ -9349,28 +9636,20 @@ async def cmd_chat_details(message: Message):
     
     try:
         processing = await message.answer(f"🔍 Загружаю данные чата {chat_id}...")
-        stats = await get_chat_details(chat_id)
+        stats = await cached(get_chat_details, chat_id, 5)
         
         if not stats or not stats.get('total_messages'):
             await processing.edit_text(f"📭 Чат {chat_id} не найден")
             return
         
-        from datetime import datetime
-        
         # Название чата — получаем из БД или Telegram API
         chat_title = stats.get('chat_title')
         chat_username = stats.get('chat_username')
         
         if not chat_title and not chat_username:
-            try:
-                tg_chat = await bot.get_chat(chat_id)
-                chat_title = tg_chat.title
-                chat_username = tg_chat.username
-                await save_chat_info(chat_id, chat_title, chat_username, tg_chat.type)
-            except Exception:
-                pass
+            chat_title, chat_username = await get_chat_info_cached(chat_id)
         
-        chat_name = f"@{chat_username}" if chat_username else (chat_title or f"Чат {chat_id}").replace('_', ' ')
+        chat_name = f"@{chat_username}" if chat_username else (chat_title or f"Чат {chat_id}").translate(_TITLE_TRANS)
         
         first = stats.get('first_message')
         last = stats.get('last_message')
@@ -9403,14 +9682,14 @@ ID: {chat_id}
         top_users = stats.get('top_users', [])
         if top_users:
             text += "\n🏆 Топ пользователей:\n"
-            for i, u in enumerate(top_users[:5], 1):
-                name = u.get('first_name', '?').replace('_', ' ')
+            for i, u in enumerate(top_users, 1):
+                name = (u.get('first_name') or '?').translate(_TITLE_TRANS)
                 username = u.get('username')
                 count = u.get('msg_count', 0)
                 user_str = f"@{username}" if username else name
                 text += f"{i}. {user_str} — {count:,}\n"
         
-        await processing.edit_text(text)
+        await processing.edit_text(text, parse_mode=None)
     except Exception as e:
         await message.answer(f"❌ Ошибка: {e}")
 
@@ -9427,7 +9706,7 @@ async def cmd_top_users(message: Message):
     
     try:
         processing = await message.answer("🏆 Загружаю топ пользователей...")
-        users = await get_top_users_global(20)
+        users = await cached(get_top_users_global, 20)
         
         if not users:
             await processing.edit_text("📭 Нет данных")
@@ -9505,7 +9784,7 @@ async def cmd_health(message: Message):
             db_ok = await health_check()
             checks.append(f"{'✅' if db_ok else '❌'} PostgreSQL: {'OK' if db_ok else 'FAIL'}")
         except Exception as e:
-            err_msg = str(e)[:50].replace('_', ' ')
+            err_msg = str(e)[:50].translate(_TITLE_TRANS)
             checks.append(f"❌ PostgreSQL: {err_msg}")
     else:
         checks.append("⚠️ PostgreSQL: не используется (SQLite)")
@@ -9515,7 +9794,7 @@ async def cmd_health(message: Message):
         me = await bot.get_me()
         checks.append(f"✅ Бот: @{me.username} (ID: {me.id})")
     except Exception as e:
-        err_msg = str(e)[:50].replace('_', ' ')
+        err_msg = str(e)[:50].translate(_TITLE_TRANS)
         checks.append(f"❌ Бот: {err_msg}")
     
     # Проверка планировщика
@@ -9529,12 +9808,10 @@ async def cmd_health(message: Message):
     checks.append(f"📊 Кулдауны в памяти: {len(cooldowns)}")
     
     # Платформа
-    import platform
-    plat_info = f"{platform.system()} {platform.release()}".replace('_', '-')
-    checks.append(f"🖥 Платформа: {plat_info}")
+    checks.append(f"🖥 Платформа: {_PLATFORM_INFO}")
     
     text = "🏥 СОСТОЯНИЕ СИСТЕМЫ\n\n" + "\n".join(checks)
-    await processing.edit_text(text)
+    await processing.edit_text(text, parse_mode=None)
 
 
 @router.message(Command("metrics", "метрики"))
@@ -9560,9 +9837,9 @@ async def cmd_metrics(message: Message):
 
 ❌ Ошибок: {stats['errors']}
 📦 Cooldowns в памяти: {len(cooldowns)}
-🔄 Rate limits: {len(api_calls)} записей
+🔄 Rate limits: {len(api_buckets)} записей
 """
-    await message.answer(text)
+    await message.answer(text, parse_mode=None)
 
 
 @router.message(Command("cleanup", "clean_db"))
@@ -9991,16 +10268,111 @@ VK_MEME_COMMUNITIES = {
     "cat": "Коты",
 }
 
+# Подсказка /vk_import без аргументов — список пабликов не меняется
+_VK_IMPORT_HELP = (
+    "📥 *Импорт ПОПУЛЯРНЫХ мемов из VK*\n\n"
+    "Использование: `/vk_import <паблик> [кол-во] [мин_лайков]`\n\n"
+    "Примеры:\n"
+    "• `/vk_import mdk` — топ мемов из MDK\n"
+    "• `/vk_import borsch 30` — 30 мемов из Борща\n"
+    "• `/vk_import mdk 20 500` — мемы с 500+ лайками\n\n"
+    "*Доступные паблики:*\n"
+    + "\n".join(f"• `{k}` — {v}" for k, v in VK_MEME_COMMUNITIES.items())
+    + "\n\nИли укажи любой домен паблика!\n"
+    "_По умолчанию: 100+ лайков, сортировка по популярности_"
+)
+
 # Чат для автоматического сбора мемов (установи через /vk_auto)
 VK_AUTO_CHAT_ID = None
 
+# Кэш wall.get {(паблик, count, min_likes): (expires_ts, memes, validators)} — стена
+# меняется за часы. Протухшие записи остаются для условного запроса (ETag/Last-Modified).
+VK_CACHE_TTL = 600
+VK_CACHE_MAX = 32
+_vk_memes_cache: dict = {}
+
+# Типы размеров фото VK от большего к меньшему (o/p/q/r — обрезанные копии)
+_VK_SIZE_ORDER = ("w", "z", "y", "x", "r", "q", "p", "o", "m", "s")
+
+
+def _best_vk_size(sizes: List[Dict]) -> Dict:
+    """Самый большой размер фото VK по букве типа (неизвестные — последний в списке)"""
+    by_type = {size.get("type"): size for size in sizes}
+    for size_type in _VK_SIZE_ORDER:
+        best = by_type.get(size_type)
+        if best is not None:
+            return best
+    return sizes[-1]
+
+# Файлы мемов, которые бот качает сам (если Telegram не забрал по URL)
+VK_DOWNLOAD_CHUNK = 64 * 1024
+VK_MIN_FILE_SIZE = 10_000  # < 10KB — мусор
+VK_MAX_FILE_SIZE = 20 * 1024 * 1024
+
+
+def _vk_post_meme(item: Dict) -> Optional[Dict]:
+    """Первый подходящий мем поста VK (фото или gif) — одно вложение с поста"""
+    likes = item.get("likes", {}).get("count", 0)
+    reposts = item.get("reposts", {}).get("count", 0)
+    # Рассчитываем "популярность" (лайки + репосты*3)
+    popularity = likes + (reposts * 3)
+    
+    for att in item.get("attachments", ()):
+        if att["type"] == "photo":
+            photo = att["photo"]
+            sizes = photo.get("sizes")
+            if not sizes:
+                continue
+            
+            best = _best_vk_size(sizes)
+            width = best.get("width", 0)
+            height = best.get("height", 0)
+            
+            # Фильтр по размеру
+            if width < 400 or height < 300:
+                continue
+            if width == height and width < 500:
+                continue
+            
+            return {
+                "type": "photo",
+                "vk_id": f"photo{photo['owner_id']}_{photo['id']}",
+                "url": best["url"],
+                "text": item.get("text", "")[:200],
+                "width": width,
+                "height": height,
+                "likes": likes,
+                "popularity": popularity
+            }
+        
+        if att["type"] == "doc":
+            doc = att["doc"]
+            if doc.get("ext") == "gif":
+                return {
+                    "type": "animation",
+                    "vk_id": f"doc{doc['owner_id']}_{doc['id']}",
+                    "url": doc["url"],
+                    "text": item.get("text", "")[:200],
+                    "likes": likes,
+                    "popularity": popularity
+                }
+    return None
+
 
 async def fetch_vk_memes(community: str, count: int = 50, min_likes: int = 100) -> List[Dict]:
     """Получить ПОПУЛЯРНЫЕ мемы из VK паблика (фильтр по лайкам)"""
     if not VK_API_TOKEN:
         return []
     
+    cache_key = (community, count, min_likes)
+    now = time.monotonic()
+    entry = _vk_memes_cache.get(cache_key)
+    if entry is not None and entry[0] > now:
+        # В кэше кортеж, наружу — свежий список: вызывающие его фильтруют и меняют
+        return list(entry[1])
+    
     memes = []
+    validators = {}
     session = await get_http_session()
     
     try:
@@ -10017,9 +10389,20 @@ async def fetch_vk_memes(community: str, count: int = 50, min_likes: int = 100)
                 "extended": 0,
                 "access_token": VK_API_TOKEN,
                 "v": VK_API_VERSION
-            }
+            },
+            headers=entry[2] if entry is not None else None
         ) as response:
-            data = await response.json()
+            if response.status == 304 and entry is not None:
+                # Стена не изменилась — продлеваем прошлый результат
+                _vk_memes_cache[cache_key] = (now + VK_CACHE_TTL, entry[1], entry[2])
+                return list(entry[1])
+            
+            if etag := response.headers.get("ETag"):
+                validators["If-None-Match"] = etag
+            if last_modified := response.headers.get("Last-Modified"):
+                validators["If-Modified-Since"] = last_modified
+            
+            data = json_loads(await response.read())
             
             if "error" in data:
                 logger.error(f"VK API error: {data['error']}")
@@ -10028,64 +10411,11 @@ async def fetch_vk_memes(community: str, count: int = 50, min_likes: int = 100)
             items = data.get("response", {}).get("items", [])
             logger.info(f"VK returned {len(items)} posts from {community}")
             
-            # Собираем все посты с картинками и лайками
-            candidates = []
-            
-            for item in items:
-                # Пропускаем репосты
-                if item.get("copy_history"):
-                    continue
-                
-                # Получаем количество лайков
-                likes = item.get("likes", {}).get("count", 0)
-                reposts = item.get("reposts", {}).get("count", 0)
-                views = item.get("views", {}).get("count", 0)
-                
-                # Рассчитываем "популярность" (лайки + репосты*3)
-                popularity = likes + (reposts * 3)
-                
-                attachments = item.get("attachments", [])
-                
-                for att in attachments:
-                    if att["type"] == "photo":
-                        photo = att["photo"]
-                        sizes = photo.get("sizes", [])
-                        
-                        if not sizes:
-                            continue
-                        
-                        best = max(sizes, key=lambda x: x.get("width", 0) * x.get("height", 0))
-                        width = best.get("width", 0)
-                        height = best.get("height", 0)
-                        
-                        # Фильтр по размеру
-                        if width < 400 or height < 300:
-                            continue
-                        if width == height and width < 500:
-                            continue
-                        
-                        candidates.append({
-                            "type": "photo",
-                            "url": best["url"],
-                            "text": item.get("text", "")[:200],
-                            "width": width,
-                            "height": height,
-                            "likes": likes,
-                            "popularity": popularity
-                        })
-                        break  # Одно фото с поста
-                        
-                    elif att["type"] == "doc":
-                        doc = att["doc"]
-                        if doc.get("ext") == "gif":
-                            candidates.append({
-                                "type": "animation",
-                                "url": doc["url"],
-                                "text": item.get("text", "")[:200],
-                                "likes": likes,
-                                "popularity": popularity
-                            })
-                            break
+            # Собираем все посты с картинками и лайками (репосты пропускаем)
+            candidates = [
+                meme for item in items
+                if not item.get("copy_history") and (meme := _vk_post_meme(item)) is not None
+            ]
             
             # Сортируем по популярности (больше лайков = лучше)
             candidates.sort(key=lambda x: x["popularity"], reverse=True)
@@ -10102,107 +10432,216 @@ async def fetch_vk_memes(community: str, count: int = 50, min_likes: int = 100)
     except Exception as e:
         logger.error(f"Error fetching VK memes: {e}")
     
-    return memes[:count]
+    memes = memes[:count]
+    if memes:
+        _vk_memes_cache.pop(cache_key, None)
+        _vk_memes_cache[cache_key] = (now + VK_CACHE_TTL, tuple(memes), validators)
+        while len(_vk_memes_cache) > VK_CACHE_MAX:
+            del _vk_memes_cache[next(iter(_vk_memes_cache))]
+    return memes
+
+
+async def _download_vk_meme(session: aiohttp.ClientSession, url: str) -> Optional[bytes]:
+    """Скачать файл мема из VK потоково. None — файл слишком маленький или большой."""
+    async with session.get(url) as response:
+        response.raise_for_status()
+        # Размер известен заранее — не качаем заведомо неподходящее
+        size = response.content_length
+        if size is not None and not VK_MIN_FILE_SIZE <= size <= VK_MAX_FILE_SIZE:
+            return None
+        buf = bytearray()
+        async for chunk in response.content.iter_chunked(VK_DOWNLOAD_CHUNK):
+            buf += chunk
+            if len(buf) > VK_MAX_FILE_SIZE:
+                return None
+    # Проверяем размер — слишком маленькие пропускаем
+    if len(buf) < VK_MIN_FILE_SIZE:
+        return None
+    return bytes(buf)
+
+
+class TokenBucket:
+    """Ограничитель частоты: rate токенов в секунду, не больше burst подряд"""
+    
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.ts = time.monotonic()
+    
+    async def acquire(self):
+        """Дождаться токена (спим только когда ведро пустое)"""
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.ts) * self.rate)
+            self.ts = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+# Ответы Telegram, когда он не смог сам забрать файл по URL
+_VK_URL_FETCH_ERRORS = (
+    "wrong file identifier/http url",
+    "failed to get http url content",
+    "wrong type of the web page content",
+    "webpage_curl_failed",
+    "webpage_media_empty",
+)
+
+# Загрузки мемов из VK в Telegram — ниже флуд-лимитов на чат
+_vk_send_bucket = TokenBucket(rate=3, burst=5)
+
+# Запросы к VK API — не больше 3 в секунду на токен
+_vk_api_bucket = TokenBucket(rate=3, burst=3)
+
+async def _send_vk_file(send, chat_id: int, file):
+    """Отправить файл через лимитер; на флуд-контроль ждём, сколько сказал Telegram"""
+    await _vk_send_bucket.acquire()
+    try:
+        return await send(chat_id, file)
+    except TelegramRetryAfter as e:
+        logger.warning(f"VK import flood control: retry after {e.retry_after}s")
+        await asyncio.sleep(e.retry_after)
+        await _vk_send_bucket.acquire()
+        return await send(chat_id, file)
+
+
+async def _upload_vk_meme(chat_id: int, meme: Dict, scratch_deletes: list) -> Optional[tuple]:
+    """Загрузить мем в Telegram, вернуть (file_id, file_unique_id).
+
+    Telegram сам скачивает файл по URL; качаем через бота только если
+    CDN VK не отдал файл серверам Telegram. None — файл не подошёл по размеру.
+    Фоновое удаление служебного сообщения добавляется в scratch_deletes.
+    """
+    is_photo = meme["type"] == "photo"
+    send = bot.send_photo if is_photo else bot.send_animation
+    try:
+        sent = await _send_vk_file(send, chat_id, meme["url"])
+    except TelegramBadRequest as e:
+        # Остальные ошибки (чат недоступен, нет прав) повтором не лечатся
+        if not any(marker in str(e).lower() for marker in _VK_URL_FETCH_ERRORS):
+            raise
+        session = await get_http_session()
+        file_data = await _download_vk_meme(session, meme["url"])
+        if file_data is None:
+            return None
+        input_file = BufferedInputFile(file_data, filename="meme.jpg" if is_photo else "meme.gif")
+        sent = await _send_vk_file(send, chat_id, input_file)
+    
+    media = sent.photo[-1] if is_photo else sent.animation
+    # Удаляем отправленное сообщение в фоне — нужен был только file_id
+    scratch_deletes.append(spawn_background(_delete_scratch_message(sent)))
+    # По URL файл мы не видели: мусорные заглушки отсеиваем по размеру из ответа Telegram
+    if media.file_size is not None and media.file_size < VK_MIN_FILE_SIZE:
+        return None
+    return media.file_id, media.file_unique_id
 
 
-async def import_vk_memes_to_chat(chat_id: int, community: str, count: int = 30, min_likes: int = 100) -> Dict[str, int]:
-    """Импортировать ПОПУЛЯРНЫЕ мемы из VK в коллекцию чата"""
+async def _delete_scratch_message(sent: Message):
+    """Удалить служебное сообщение загрузки (если уже удалено — не страшно)"""
+    try:
+        await sent.delete()
+    except TelegramBadRequest:
+        pass
+
+
+async def _wait_vk_scratch_deletes(scratch_deletes: list):
+    """Дождаться фоновых удалений служебных сообщений своей загрузки"""
+    if scratch_deletes:
+        await asyncio.gather(*scratch_deletes, return_exceptions=True)
+
+
+async def import_vk_memes_to_chat(
+    chat_id: int, community: str, count: int = 30, min_likes: int = 100,
+    memes: Optional[List[Dict]] = None
+) -> Dict[str, int]:
+    """Импортировать ПОПУЛЯРНЫЕ мемы из VK в коллекцию чата.
+
+    memes — уже полученные посты паблика (иначе запрашиваем сами).
+    """
     stats = {"imported": 0, "errors": 0, "skipped": 0, "already_exists": 0}
     
-    memes = await fetch_vk_memes(community, count * 2, min_likes)  # Берём больше, т.к. часть пропустим
+    if memes is None:
+        memes = await fetch_vk_memes(community, count * 2, min_likes)  # Берём больше, т.к. часть пропустим
     if not memes:
         return stats
     
-    session = await get_http_session()
+    # Ключи уже импортированного (VK id вложения, у старых записей — хеш URL)
+    existing_keys = await get_vk_media_keys(chat_id)
     
-    # Получаем существующие URL хеши из описаний (для дедупликации)
-    existing_hashes = set()
-    if USE_POSTGRES:
-        from database_postgres import get_pool
-        async with (await get_pool()).acquire() as conn:
-            rows = await conn.fetch("""
-                SELECT caption FROM chat_media 
-                WHERE chat_id = $1 AND description LIKE 'VK:%'
-            """, chat_id)
-            for row in rows:
-                if row['caption']:
-                    # Храним хеш URL в caption
-                    existing_hashes.add(row['caption'][:50])
+    # Отсеиваем дубликаты до загрузки
+    pending = []
+    for meme in memes:
+        vk_id = meme["vk_id"]
+        url_hash = meme["url"].split("?")[0][-50:]  # Последние 50 символов URL без параметров
+        if vk_id in existing_keys or url_hash in existing_keys:
+            stats["already_exists"] += 1
+            continue
+        existing_keys.add(vk_id)
+        pending.append((meme, vk_id))
     
-    imported_count = 0
+    # Строки для коллекции копим и пишем в БД одним запросом в конце
+    rows = []
+    scratch_deletes = []
     
-    for meme in memes:
-        if imported_count >= count:
+    for meme, vk_id in pending:
+        if len(rows) >= count:
             break
-            
+        
         try:
-            # Создаём хеш URL для проверки дубликатов
-            url_hash = meme["url"].split("?")[0][-50:]  # Последние 50 символов URL без параметров
-            
-            if url_hash in existing_hashes:
-                stats["already_exists"] += 1
-                continue
-            
-            # Скачиваем файл
-            async with session.get(meme["url"]) as response:
-                if response.status != 200:
-                    stats["errors"] += 1
-                    continue
-                
-                file_data = await response.read()
-                
-                # Проверяем размер — слишком маленькие пропускаем
-                if len(file_data) < 10000:  # < 10KB
-                    stats["skipped"] += 1
-                    continue
-            
-            # Отправляем в чат (чтобы получить file_id)
-            if meme["type"] == "photo":
-                from aiogram.types import BufferedInputFile
-                input_file = BufferedInputFile(file_data, filename="meme.jpg")
-                sent = await bot.send_photo(chat_id, input_file)
-                file_id = sent.photo[-1].file_id
-                file_unique_id = sent.photo[-1].file_unique_id
-                # Удаляем отправленное сообщение
-                await sent.delete()
-            elif meme["type"] == "animation":
-                from aiogram.types import BufferedInputFile
-                input_file = BufferedInputFile(file_data, filename="meme.gif")
-                sent = await bot.send_animation(chat_id, input_file)
-                file_id = sent.animation.file_id
-                file_unique_id = sent.animation.file_unique_id
-                await sent.delete()
-            else:
+            if meme["type"] not in ("photo", "animation"):
                 continue
             
-            # Сохраняем в коллекцию (caption = url_hash для дедупликации)
-            saved = await save_media(
-                chat_id=chat_id,
-                user_id=0,  # VK import
-                file_id=file_id,
-                file_type=meme["type"],
-                file_unique_id=file_unique_id,
-                description=f"VK: {community}",
-                caption=url_hash  # Храним хеш для проверки дубликатов
-            )
-            
-            if saved:
-                stats["imported"] += 1
-                imported_count += 1
-                existing_hashes.add(url_hash)
-            else:
+            uploaded = await _upload_vk_meme(chat_id, meme, scratch_deletes)
+            if uploaded is None:
                 stats["skipped"] += 1
+                continue
+            file_id, file_unique_id = uploaded
             
-            # Небольшая задержка чтобы не спамить
-            await asyncio.sleep(0.3)
+            rows.append({
+                "chat_id": chat_id,
+                "user_id": 0,  # VK import
+                "file_id": file_id,
+                "file_type": meme["type"],
+                "file_unique_id": file_unique_id,
+                "description": f"VK: {community}",
+                "caption": vk_id,  # Храним VK id для проверки дубликатов
+            })
             
         except Exception as e:
             logger.error(f"Error importing meme: {e}")
             stats["errors"] += 1
     
+    await _wait_vk_scratch_deletes(scratch_deletes)
+    saved = await save_media_bulk(rows)
+    stats["imported"] += saved
+    stats["skipped"] += len(rows) - saved
     return stats
 
 
+async def _vk_newsfeed_search(session: aiohttp.ClientSession, query: str) -> List[Dict]:
+    """Один запрос newsfeed.search (через лимитер запросов к VK API)"""
+    await _vk_api_bucket.acquire()
+    async with session.get(
+        "https://api.vk.com/method/newsfeed.search",
+        params={
+            "q": query,
+            "count": 50,
+            "extended": 0,
+            "access_token": VK_API_TOKEN,
+            "v": VK_API_VERSION
+        }
+    ) as response:
+        data = json_loads(await response.read())
+    
+    if "error" in data:
+        logger.warning(f"VK search error: {data['error']}")
+        return []
+    return data.get("response", {}).get("items", [])
+
+
 async def fetch_trending_vk_memes(min_likes: int = 500, count: int = 20) -> List[Dict]:
     """Получить трендовые мемы со всего VK через поиск"""
     if not VK_API_TOKEN:
@@ -10214,64 +10653,54 @@ async def fetch_trending_vk_memes(min_likes: int = 500, count: int = 20) -> List
     # Поисковые запросы для мемов
     search_queries = ["мем", "смешно", "ржака", "прикол", "угар", "юмор"]
     
+    # Запросы идут параллельно (в темпе лимитера), ответы разбираем по мере готовности
+    searches = [asyncio.create_task(_vk_newsfeed_search(session, query)) for query in search_queries]
     try:
-        for query in search_queries:
+        for search in asyncio.as_completed(searches):
             if len(memes) >= count:
                 break
+            
+            try:
+                items = await search
+            except Exception as e:
+                logger.error(f"Error fetching trending memes: {e}")
+                continue
+            
+            for item in items:
+                if len(memes) >= count:
+                    break
                 
-            async with session.get(
-                "https://api.vk.com/method/newsfeed.search",
-                params={
-                    "q": query,
-                    "count": 50,
-                    "extended": 0,
-                    "access_token": VK_API_TOKEN,
-                    "v": VK_API_VERSION
-                }
-            ) as response:
-                data = await response.json()
-                
-                if "error" in data:
-                    logger.warning(f"VK search error: {data['error']}")
+                likes = item.get("likes", {}).get("count", 0)
+                if likes < min_likes:
                     continue
                 
-                items = data.get("response", {}).get("items", [])
-                
-                for item in items:
-                    if len(memes) >= count:
+                attachments = item.get("attachments", [])
+                for att in attachments:
+                    if att["type"] == "photo":
+                        photo = att["photo"]
+                        sizes = photo.get("sizes", [])
+                        if not sizes:
+                            continue
+                        
+                        best = _best_vk_size(sizes)
+                        width = best.get("width", 0)
+                        height = best.get("height", 0)
+                        
+                        if width < 400 or height < 300:
+                            continue
+                        
+                        memes.append({
+                            "type": "photo",
+                            "vk_id": f"photo{photo['owner_id']}_{photo['id']}",
+                            "url": best["url"],
+                            "text": item.get("text", "")[:100],
+                            "likes": likes
+                        })
                         break
-                    
-                    likes = item.get("likes", {}).get("count", 0)
-                    if likes < min_likes:
-                        continue
-                    
-                    attachments = item.get("attachments", [])
-                    for att in attachments:
-                        if att["type"] == "photo":
-                            photo = att["photo"]
-                            sizes = photo.get("sizes", [])
-                            if not sizes:
-                                continue
-                            
-                            best = max(sizes, key=lambda x: x.get("width", 0) * x.get("height", 0))
-                            width = best.get("width", 0)
-                            height = best.get("height", 0)
-                            
-                            if width < 400 or height < 300:
-                                continue
-                            
-                            memes.append({
-                                "type": "photo",
-                                "url": best["url"],
-                                "text": item.get("text", "")[:100],
-                                "likes": likes
-                            })
-                            break
-            
-            await asyncio.sleep(0.5)  # Задержка между запросами
-                
-    except Exception as e:
-        logger.error(f"Error fetching trending memes: {e}")
+    finally:
+        for search in searches:
+            search.cancel()
+        await asyncio.gather(*searches, return_exceptions=True)
     
     # Сортируем по лайкам
     memes.sort(key=lambda x: x["likes"], reverse=True)
@@ -10291,43 +10720,63 @@ async def auto_fetch_vk_memes():
         # Собираем из топовых пабликов
         total_imported = 0
         
-        for community in ["mdk", "borsch", "mudakoff", "oldlentach"]:
-            stats = await import_vk_memes_to_chat(VK_AUTO_CHAT_ID, community, 5, 500)
-            total_imported += stats.get("imported", 0)
-            await asyncio.sleep(2)
+        # Стена следующего паблика грузится, пока импортируется текущий
+        walls: asyncio.Queue = asyncio.Queue(maxsize=1)
+        
+        async def fetch_walls():
+            for community in ("mdk", "borsch", "mudakoff", "oldlentach"):
+                try:
+                    memes = await fetch_vk_memes(community, 10, 500)
+                except Exception as e:
+                    logger.error(f"Error fetching VK wall {community}: {e}")
+                    memes = []
+                await walls.put((community, memes))
+            await walls.put(None)
+        
+        producer = asyncio.create_task(fetch_walls())
+        try:
+            while (item := await walls.get()) is not None:
+                community, memes = item
+                stats = await import_vk_memes_to_chat(VK_AUTO_CHAT_ID, community, 5, 500, memes=memes)
+                total_imported += stats.get("imported", 0)
+        finally:
+            producer.cancel()
         
         # Собираем трендовые
         trending = await fetch_trending_vk_memes(min_likes=1000, count=10)
         if trending:
-            for meme in trending[:5]:
+            # Отсеиваем уже импортированные до загрузки, как в import_vk_memes_to_chat
+            existing_keys = await get_vk_media_keys(VK_AUTO_CHAT_ID)
+            fresh = []
+            for meme in trending:
+                url_hash = meme["url"].split("?")[0][-50:]
+                if meme["vk_id"] in existing_keys or url_hash in existing_keys:
+                    continue
+                existing_keys.add(meme["vk_id"])
+                fresh.append(meme)
+            
+            rows = []
+            scratch_deletes = []
+            for meme in fresh[:5]:
                 try:
-                    session = await get_http_session()
-                    async with session.get(meme["url"]) as response:
-                        if response.status != 200:
-                            continue
-                        file_data = await response.read()
-                    
-                    from aiogram.types import BufferedInputFile
-                    input_file = BufferedInputFile(file_data, filename="meme.jpg")
-                    sent = await bot.send_photo(VK_AUTO_CHAT_ID, input_file)
-                    file_id = sent.photo[-1].file_id
-                    file_unique_id = sent.photo[-1].file_unique_id
-                    await sent.delete()
+                    uploaded = await _upload_vk_meme(VK_AUTO_CHAT_ID, meme, scratch_deletes)
+                    if uploaded is None:
+                        continue
+                    file_id, file_unique_id = uploaded
                     
-                    url_hash = meme["url"].split("?")[0][-50:]
-                    await save_media(
-                        chat_id=VK_AUTO_CHAT_ID,
-                        user_id=0,
-                        file_id=file_id,
-                        file_type="photo",
-                        file_unique_id=file_unique_id,
-                        description="VK: trending",
-                        caption=url_hash
-                    )
-                    total_imported += 1
-                    await asyncio.sleep(0.5)
+                    rows.append({
+                        "chat_id": VK_AUTO_CHAT_ID,
+                        "user_id": 0,
+                        "file_id": file_id,
+                        "file_type": "photo",
+                        "file_unique_id": file_unique_id,
+                        "description": "VK: trending",
+                        "caption": meme["vk_id"],
+                    })
                 except Exception as e:
                     logger.error(f"Error importing trending meme: {e}")
+            await _wait_vk_scratch_deletes(scratch_deletes)
+            total_imported += await save_media_bulk(rows)
         
         logger.info(f"✅ Автосбор завершён: {total_imported} мемов")
         
@@ -10421,29 +10870,18 @@ async def cmd_vk_import(message: Message):
         )
         return
     
-    # Парсим аргументы: /vk_import mdk 30
-    args = message.text.split()
+    # Парсим аргументы: /vk_import mdk 30 500
+    args = message.text.split(maxsplit=4)[1:]
+    community, count_arg, likes_arg = (args + ["", "", ""])[:3]
     
-    if len(args) < 2:
-        communities_list = "\n".join([f"• `{k}` — {v}" for k, v in VK_MEME_COMMUNITIES.items()])
-        await message.answer(
-            f"📥 *Импорт ПОПУЛЯРНЫХ мемов из VK*\n\n"
-            f"Использование: `/vk_import <паблик> [кол-во] [мин_лайков]`\n\n"
-            f"Примеры:\n"
-            f"• `/vk_import mdk` — топ мемов из MDK\n"
-            f"• `/vk_import borsch 30` — 30 мемов из Борща\n"
-            f"• `/vk_import mdk 20 500` — мемы с 500+ лайками\n\n"
-            f"*Доступные паблики:*\n{communities_list}\n\n"
-            f"Или укажи любой домен паблика!\n"
-            f"_По умолчанию: 100+ лайков, сортировка по популярности_",
-            parse_mode=ParseMode.MARKDOWN
-        )
+    if not community:
+        await message.answer(_VK_IMPORT_HELP, parse_mode=ParseMode.MARKDOWN)
         return
     
-    community = args[1].lower().replace("@", "").replace("https://vk.com/", "")
-    count = int(args[2]) if len(args) > 2 and args[2].isdigit() else 30
+    community = community.lower().removeprefix("https://vk.com/").removeprefix("@")
+    count = int(count_arg) if count_arg.isdigit() else 30
     count = min(count, 100)  # Максимум 100
-    min_likes = int(args[3]) if len(args) > 3 and args[3].isdigit() else 100
+    min_likes = int(likes_arg) if likes_arg.isdigit() else 100
     
     # Определяем chat_id куда импортировать
     if message.chat.type == "private":
@@ -10542,7 +10980,6 @@ async def scheduled_greeting():
         return
 
     try:
-        from datetime import datetime, timezone, timedelta
         moscow_tz = timezone(timedelta(hours=3))
         now = datetime.now(moscow_tz)
         hour = now.hour
@@ -10589,14 +11026,24 @@ async def on_shutdown():
         scheduler.shutdown(wait=False)
         logger.info("⏰ Планировщик остановлен")
     
-    # Закрываем HTTP сессию
-    await close_http_session()
-    logger.info("🌐 HTTP сессия закрыта")
+    # Дожидаемся фоновых задач (отправка мемов и т.п.), пока пул и HTTP сессия открыты
+    if _background_tasks:
+        await asyncio.wait(list(_background_tasks), timeout=10)
+    
+    async def close_http():
+        await close_http_session()
+        logger.info("🌐 HTTP сессия закрыта")
     
-    # Закрываем пул соединений с БД
-    if close_db:
-        await close_db()
-        logger.info("🗄 Соединение с БД закрыто")
+    async def close_storage():
+        # Дописываем буферы записи, пока пул ещё открыт
+        await stop_write_buffers()
+        # Закрываем пул соединений с БД
+        if close_db:
+            await close_db()
+            logger.info("🗄 Соединение с БД закрыто")
+    
+    # HTTP и БД закрываются независимо друг от друга
+    await asyncio.gather(close_http(), close_storage())
     
     # Логируем итоговую статистику
     stats = metrics.get_stats()
@@ -10746,8 +11193,11 @@ async def setup_bot_commands():
 
 async def main():
     """Главная функция запуска бота"""
-    # Инициализация БД
-    await init_db()
+    # Инициализация БД, меню команд в Telegram и HTTP сессия — независимы, параллельно
+    await asyncio.gather(init_db(), setup_bot_commands(), get_http_session())
+    
+    # Фоновая пакетная запись сообщений и медиа чата
+    start_write_buffers()
     
     # Регистрируем middleware для перехвата команд в реплай на бота
     dp.message.outer_middleware(CommandReplyInterceptMiddleware())
@@ -10755,9 +11205,6 @@ async def main():
     # Подключаем роутер
     dp.include_router(router)
     
-    # Настраиваем меню команд в Telegram
-    await setup_bot_commands()
-    
     # Регистрируем shutdown handler
     dp.shutdown.register(on_shutdown)
     
@@ -10773,14 +11220,14 @@ async def main():
     # Итоговый дайджест раз в 6 часов
     scheduler.add_job(scheduled_news_digest, 'interval', hours=6, id='news_digest')
 
-    # Очистка памяти (cooldowns и api_calls) каждые 10 минут
-    scheduler.add_job(cleanup_memory, 'interval', minutes=10, id='memory_cleanup')
+    # Очистка памяти (cooldowns и api_buckets) каждую минуту — вне обработки апдейтов
+    scheduler.add_job(cleanup_memory, 'interval', seconds=60, id='memory_cleanup')
     scheduler.start()
 
     if USE_POSTGRES:
-        logger.info("⏰ Планировщик запущен: очистка БД (6ч), статистика (1ч), авто-сводки (6ч), приветствия (2ч), память (10м)")
+        logger.info("⏰ Планировщик запущен: очистка БД (6ч), статистика (1ч), авто-сводки (6ч), приветствия (2ч), память (1м)")
     else:
-        logger.info("⏰ Планировщик запущен: очистка памяти (10м)")
+        logger.info("⏰ Планировщик запущен: очистка памяти (1м)")
     
     logger.info("🔫 Гильдия Беспредела запущена!")
     
@@ -302,6 +302,18 @@ async def update_player_stats(user_id: int, chat_id: int, **kwargs):
         await db.commit()
 
 
+async def add_players_money(chat_id: int, deltas: List[tuple]):
+    """Изменить деньги нескольким игрокам чата одним executemany: [(user_id, delta), ...]"""
+    if not deltas:
+        return
+    async with aiosqlite.connect(DATABASE_PATH) as db:
+        await db.executemany(
+            "UPDATE players SET money = money + ? WHERE user_id = ? AND chat_id = ?",
+            [(delta, user_id, chat_id) for user_id, delta in deltas]
+        )
+        await db.commit()
+
+
 async def get_top_players(chat_id: int, limit: int = 10, sort_by: str = "experience") -> List[Dict[str, Any]]:
     """Получить топ игроков чата"""
     # Защита от SQL injection — только разрешённые поля
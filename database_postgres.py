@@ -5,6 +5,7 @@ v3.1 - Production-ready: SSL, retry logic, connection health checks
 """
 import asyncpg
 import asyncio
+import random
 import time
 import os
 import logging
@@ -355,6 +356,74 @@ async def init_db():
             ON chat_media(chat_id, file_type, created_at DESC)
         """)
         
+        # Счётчики медиа по типам (chat_media_counts) — поддерживаются триггером,
+        # чтобы /meme и /memestats не делали COUNT(*) по всей коллекции
+        await conn.execute("""
+            CREATE OR REPLACE FUNCTION chat_media_counts_trg() RETURNS trigger AS $$
+            BEGIN
+                IF TG_OP IN ('DELETE', 'UPDATE') AND OLD.is_approved = 1 THEN
+                    UPDATE chat_media_counts SET n = n - 1
+                    WHERE chat_id = OLD.chat_id AND file_type = OLD.file_type;
+                END IF;
+                IF TG_OP IN ('INSERT', 'UPDATE') AND NEW.is_approved = 1 THEN
+                    INSERT INTO chat_media_counts (chat_id, file_type, n)
+                    VALUES (NEW.chat_id, NEW.file_type, 1)
+                    ON CONFLICT (chat_id, file_type) DO UPDATE SET n = chat_media_counts.n + 1;
+                END IF;
+                RETURN NULL;
+            END
+            $$ LANGUAGE plpgsql
+        """)
+        # Таблица, триггер и начальное заполнение — одной транзакцией: если запуск
+        # упадёт посередине, следующий увидит, что таблицы нет, и заполнит заново
+        async with conn.transaction():
+            counts_exist = await conn.fetchval("SELECT to_regclass('chat_media_counts') IS NOT NULL")
+            trigger_exists = await conn.fetchval("""
+                SELECT EXISTS (
+                    SELECT 1 FROM pg_trigger
+                    WHERE tgname = 'trg_chat_media_counts' AND tgrelid = 'chat_media'::regclass
+                )
+            """)
+            if not counts_exist or not trigger_exists:
+                # Блокируем вставки, чтобы ни одна строка не посчиталась дважды или мимо
+                await conn.execute("LOCK TABLE chat_media IN SHARE ROW EXCLUSIVE MODE")
+            if not counts_exist:
+                await conn.execute("""
+                    CREATE TABLE chat_media_counts (
+                        chat_id BIGINT NOT NULL,
+                        file_type TEXT NOT NULL,
+                        n BIGINT NOT NULL DEFAULT 0,
+                        PRIMARY KEY (chat_id, file_type)
+                    )
+                """)
+            if not trigger_exists:
+                await conn.execute("""
+                    CREATE TRIGGER trg_chat_media_counts
+                    AFTER INSERT OR DELETE OR UPDATE OF chat_id, file_type, is_approved ON chat_media
+                    FOR EACH ROW EXECUTE FUNCTION chat_media_counts_trg()
+                """)
+            if not counts_exist or not trigger_exists:
+                # Первый запуск (или счётчики жили без триггера): считаем заново
+                await conn.execute("DELETE FROM chat_media_counts")
+                await conn.execute("""
+                    INSERT INTO chat_media_counts (chat_id, file_type, n)
+                    SELECT chat_id, file_type, COUNT(*)
+                    FROM chat_media
+                    WHERE is_approved = 1
+                    GROUP BY chat_id, file_type
+                """)
+        
+        # Частичные индексы для случайной выборки по диапазону id (get_random_media):
+        # только одобренные медиа, поэтому поиск ближайшего id — один спуск по дереву
+        await conn.execute("""
+            CREATE INDEX IF NOT EXISTS idx_media_approved_chat_id 
+            ON chat_media(chat_id, id) WHERE is_approved = 1
+        """)
+        await conn.execute("""
+            CREATE INDEX IF NOT EXISTS idx_media_approved_chat_type_id 
+            ON chat_media(chat_id, file_type, id) WHERE is_approved = 1
+        """)
+        
         # ========== МИГРАЦИЯ user_profiles на PER-CHAT ==========
         # Проверяем структуру существующей таблицы user_profiles
         # Если она существует с user_id PRIMARY KEY (старая версия), пересоздаём
@@ -909,6 +978,18 @@ async def update_player_stats(user_id: int, chat_id: int, **kwargs):
         await conn.execute(query, *values)
 
 
+async def add_players_money(chat_id: int, deltas: List[tuple]):
+    """Изменить деньги нескольким игрокам чата одним executemany: [(user_id, delta), ...]"""
+    if not deltas:
+        return
+    async with (await get_pool()).acquire() as conn:
+        async with conn.transaction():
+            await conn.executemany(
+                "UPDATE players SET money = money + $1 WHERE user_id = $2 AND chat_id = $3",
+                [(delta, user_id, chat_id) for user_id, delta in deltas]
+            )
+
+
 async def get_top_players(chat_id: int, limit: int = 10, sort_by: str = "experience") -> List[Dict[str, Any]]:
     """Получить топ игроков чата"""
     # Защита от SQL injection - только разрешённые поля
@@ -956,14 +1037,26 @@ async def is_in_jail(user_id: int, chat_id: int) -> tuple:
     return False, 0
 
 
+_ADD_TO_TREASURY_SQL = """
+    INSERT INTO chat_treasury (chat_id, money)
+    VALUES ($1, $2)
+    ON CONFLICT(chat_id) DO UPDATE SET money = chat_treasury.money + $2
+"""
+
+
 async def add_to_treasury(chat_id: int, amount: int):
     """Добавить деньги в общак чата"""
     async with (await get_pool()).acquire() as conn:
-        await conn.execute("""
-            INSERT INTO chat_treasury (chat_id, money)
-            VALUES ($1, $2)
-            ON CONFLICT(chat_id) DO UPDATE SET money = chat_treasury.money + $2
-        """, chat_id, amount)
+        await conn.execute(_ADD_TO_TREASURY_SQL, chat_id, amount)
+
+
+async def _write_treasury(rows: List[tuple]):
+    """Записать пачку пополнений общака — по одной строке на чат"""
+    totals: Dict[int, int] = {}
+    for chat_id, amount in rows:
+        totals[chat_id] = totals.get(chat_id, 0) + amount
+    async with (await get_pool()).acquire() as conn:
+        await conn.executemany(_ADD_TO_TREASURY_SQL, list(totals.items()))
 
 
 async def get_treasury(chat_id: int) -> int:
@@ -1011,6 +1104,86 @@ async def get_player_achievements(user_id: int) -> List[str]:
 
 # ==================== СООБЩЕНИЯ ЧАТА ====================
 
+_INSERT_CHAT_MESSAGE_SQL = """
+    INSERT INTO chat_messages 
+    (chat_id, user_id, username, first_name, message_text, message_type,
+     reply_to_user_id, reply_to_first_name, reply_to_username, sticker_emoji, 
+     image_description, file_id, file_unique_id, voice_transcription, created_at)
+    VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, $13, $14, $15)
+"""
+
+# Обновляем реестр пользователей чата для быстрого поиска
+_UPSERT_CHAT_USER_SQL = """
+    INSERT INTO chat_users (chat_id, user_id, first_name, username, message_count, first_seen_at, last_seen_at)
+    VALUES ($1, $2, $3, $4, 1, $5, $5)
+    ON CONFLICT (chat_id, user_id) DO UPDATE SET
+        first_name = COALESCE(EXCLUDED.first_name, chat_users.first_name),
+        username = COALESCE(EXCLUDED.username, chat_users.username),
+        message_count = chat_users.message_count + 1,
+        last_seen_at = EXCLUDED.last_seen_at
+"""
+
+
+def _chat_message_row(
+    chat_id: int,
+    user_id: int,
+    username: str,
+    first_name: str,
+    message_text: str,
+    message_type: str = "text",
+    reply_to_user_id: int = None,
+    reply_to_first_name: str = None,
+    reply_to_username: str = None,
+    sticker_emoji: str = None,
+    image_description: str = None,
+    file_id: str = None,
+    file_unique_id: str = None,
+    voice_transcription: str = None
+) -> tuple:
+    """Собрать строку chat_messages (время фиксируется в момент вызова)"""
+    return (chat_id, user_id, username, first_name, message_text, message_type,
+            reply_to_user_id, reply_to_first_name, reply_to_username, sticker_emoji,
+            image_description, file_id, file_unique_id, voice_transcription, int(time.time()))
+
+
+_CHAT_MESSAGE_COLUMNS = [
+    'chat_id', 'user_id', 'username', 'first_name', 'message_text', 'message_type',
+    'reply_to_user_id', 'reply_to_first_name', 'reply_to_username', 'sticker_emoji',
+    'image_description', 'file_id', 'file_unique_id', 'voice_transcription', 'created_at'
+]
+
+
+# Подписчики на запись сообщений: вызываются с записанными строками после коммита
+_messages_written_callbacks: List[Any] = []
+
+
+def on_messages_written(callback):
+    """Подписаться на запись сообщений: callback(rows) после коммита каждой пачки"""
+    _messages_written_callbacks.append(callback)
+
+
+async def _write_chat_messages(rows: List[tuple]):
+    """Записать пачку сообщений в одной транзакции (COPY для пачек, INSERT для одиночных)"""
+    # (chat_id, user_id, first_name, username, created_at) для реестра пользователей
+    user_rows = [(r[0], r[1], r[3], r[2], r[14]) for r in rows]
+    async with (await get_pool()).acquire() as conn:
+        async with conn.transaction():
+            if len(rows) == 1:
+                await conn.execute(_INSERT_CHAT_MESSAGE_SQL, *rows[0])
+            else:
+                await conn.copy_records_to_table(
+                    'chat_messages', records=rows, columns=_CHAT_MESSAGE_COLUMNS
+                )
+            await conn.executemany(_UPSERT_CHAT_USER_SQL, user_rows)
+    
+    # Ошибка подписчика не должна выглядеть как сбой записи — строки уже в БД
+    for callback in _messages_written_callbacks:
+        try:
+            callback(rows)
+        except Exception as e:
+            logger.warning(f"messages written callback failed: {e}")
+
+
 async def save_chat_message(
     chat_id: int,
     user_id: int,
@@ -1027,29 +1200,152 @@ async def save_chat_message(
     file_unique_id: str = None,
     voice_transcription: str = None
 ):
-    """Сохранить сообщение чата для аналитики"""
-    now = int(time.time())
-    async with (await get_pool()).acquire() as conn:
-        await conn.execute("""
-            INSERT INTO chat_messages 
-            (chat_id, user_id, username, first_name, message_text, message_type,
-             reply_to_user_id, reply_to_first_name, reply_to_username, sticker_emoji, 
-             image_description, file_id, file_unique_id, voice_transcription, created_at)
-            VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, $13, $14, $15)
-        """, chat_id, user_id, username, first_name, message_text, message_type,
-             reply_to_user_id, reply_to_first_name, reply_to_username, sticker_emoji, 
-             image_description, file_id, file_unique_id, voice_transcription, now)
+    """Сохранить сообщение чата для аналитики (сразу, без буфера)"""
+    await _write_chat_messages([_chat_message_row(
+        chat_id, user_id, username, first_name, message_text, message_type,
+        reply_to_user_id, reply_to_first_name, reply_to_username, sticker_emoji,
+        image_description, file_id, file_unique_id, voice_transcription
+    )])
+
+
+# ==================== БУФЕРЫ ЗАПИСИ ====================
+# Каждое сообщение чата — это INSERT + UPSERT, каждое медиа — ещё один INSERT,
+# плюс UPSERT информации о чате на каждое текстовое сообщение.
+# В активных чатах это главная нагрузка на БД, поэтому копим строки в очередях
+# и пишем пачками: до 100 строк или раз в 500 мс — что наступит раньше.
+
+WRITE_BUFFER_MAX = 10000
+WRITE_FLUSH_BATCH = 100
+WRITE_FLUSH_INTERVAL = 0.5  # секунд
+
+_write_buffers: Dict[str, asyncio.Queue] = {}
+_write_flush_tasks: Dict[str, asyncio.Task] = {}
+
+
+def _buffer_writers() -> Dict[str, Any]:
+    """Имя буфера → функция записи пачки строк"""
+    return {
+        'messages': _write_chat_messages,
+        'media': _write_media_rows,
+        'chat_info': _write_chat_info,
+        'treasury': _write_treasury,
+    }
+
+
+async def _enqueue_write(name: str, row: tuple):
+    """Положить строку в буфер; если он не запущен или переполнен — пишем напрямую"""
+    buffer = _write_buffers.get(name)
+    if buffer is not None:
+        try:
+            buffer.put_nowait(row)
+            return
+        except asyncio.QueueFull:
+            logger.warning(f"Write buffer '{name}' is full, writing directly")
+    await _buffer_writers()[name]([row])
+
+
+async def queue_chat_message(*args, **kwargs):
+    """Поставить сообщение в буфер записи (аргументы как у save_chat_message)"""
+    await _enqueue_write('messages', _chat_message_row(*args, **kwargs))
+
+
+async def queue_chat_info(chat_id: int, title: str = None, username: str = None, chat_type: str = None):
+    """Поставить обновление информации о чате в буфер записи"""
+    await _enqueue_write('chat_info', (chat_id, title, username, chat_type, int(time.time())))
+
+
+async def queue_treasury(chat_id: int, amount: int):
+    """Поставить пополнение общака в буфер записи (не для списаний с проверкой баланса)"""
+    await _enqueue_write('treasury', (chat_id, amount))
+
+
+async def _flush_loop(name: str, buffer: asyncio.Queue, writer):
+    """Фоновая задача: собирает пачку из буфера и пишет её одним запросом"""
+    loop = asyncio.get_running_loop()
+    stopping = False
+    
+    while not stopping:
+        row = await buffer.get()
+        if row is None:
+            break
         
-        # Обновляем реестр пользователей чата для быстрого поиска
-        await conn.execute("""
-            INSERT INTO chat_users (chat_id, user_id, first_name, username, message_count, first_seen_at, last_seen_at)
-            VALUES ($1, $2, $3, $4, 1, $5, $5)
-            ON CONFLICT (chat_id, user_id) DO UPDATE SET
-                first_name = COALESCE(EXCLUDED.first_name, chat_users.first_name),
-                username = COALESCE(EXCLUDED.username, chat_users.username),
-                message_count = chat_users.message_count + 1,
-                last_seen_at = EXCLUDED.last_seen_at
-        """, chat_id, user_id, first_name, username, now)
+        batch = [row]
+        deadline = loop.time() + WRITE_FLUSH_INTERVAL
+        while len(batch) < WRITE_FLUSH_BATCH:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                row = await asyncio.wait_for(buffer.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            if row is None:
+                # Сигнал остановки: дописываем текущую пачку и выходим
+                stopping = True
+                break
+            batch.append(row)
+        
+        await _write_batch(name, writer, batch)
+
+
+async def _write_batch(name: str, writer, batch: List[tuple]):
+    """Записать пачку; если она не прошла — пишем по одной строке, чтобы плохая строка не утянула остальные"""
+    try:
+        await _execute_with_retry(writer, batch)
+        return
+    except Exception as e:
+        if len(batch) == 1:
+            logger.error(f"Failed to write row from '{name}' buffer: {e}")
+            return
+        logger.warning(f"Failed to flush {len(batch)} rows from '{name}' buffer, retrying row by row: {e}")
+    
+    failed = 0
+    for row in batch:
+        try:
+            await _execute_with_retry(writer, [row])
+        except Exception as e:
+            failed += 1
+            logger.error(f"Failed to write row from '{name}' buffer: {e}")
+    if failed:
+        logger.error(f"Dropped {failed}/{len(batch)} rows from '{name}' buffer")
+
+
+def start_write_buffers():
+    """Запустить фоновую пакетную запись (вызывать после init_db)"""
+    if _write_flush_tasks:
+        return
+    for name, writer in _buffer_writers().items():
+        buffer = asyncio.Queue(maxsize=WRITE_BUFFER_MAX)
+        _write_buffers[name] = buffer
+        _write_flush_tasks[name] = asyncio.create_task(_flush_loop(name, buffer, writer))
+    logger.info("📝 Write buffers started")
+
+
+async def stop_write_buffers():
+    """Остановить фоновую запись и дописать всё, что осталось в буферах"""
+    if not _write_flush_tasks:
+        return
+    
+    buffers = dict(_write_buffers)
+    tasks = dict(_write_flush_tasks)
+    # Новые строки с этого момента пишутся напрямую
+    _write_buffers.clear()
+    _write_flush_tasks.clear()
+    
+    writers = _buffer_writers()
+    for name, buffer in buffers.items():
+        await buffer.put(None)
+        await tasks[name]
+        
+        # Всё, что успело лечь в очередь после сигнала остановки
+        leftover = []
+        while not buffer.empty():
+            row = buffer.get_nowait()
+            if row is not None:
+                leftover.append(row)
+        if leftover:
+            await _write_batch(name, writers[name], leftover)
+    logger.info("📝 Write buffers flushed")
 
 
 async def find_user_in_chat(chat_id: int, search_term: str) -> Optional[Dict[str, Any]]:
@@ -1828,18 +2124,36 @@ async def get_database_stats() -> Dict[str, Any]:
         return stats
 
 
+_UPSERT_CHAT_INFO_SQL = """
+    INSERT INTO chats (chat_id, title, username, chat_type, first_seen, last_activity)
+    VALUES ($1, $2, $3, $4, $5, $5)
+    ON CONFLICT (chat_id) DO UPDATE SET 
+        title = COALESCE($2, chats.title),
+        username = COALESCE($3, chats.username),
+        chat_type = COALESCE($4, chats.chat_type),
+        last_activity = $5
+"""
+
+
 async def save_chat_info(chat_id: int, title: str = None, username: str = None, chat_type: str = None):
     """Сохранить или обновить информацию о чате"""
     async with (await get_pool()).acquire() as conn:
-        await conn.execute("""
-            INSERT INTO chats (chat_id, title, username, chat_type, first_seen, last_activity)
-            VALUES ($1, $2, $3, $4, $5, $5)
-            ON CONFLICT (chat_id) DO UPDATE SET 
-                title = COALESCE($2, chats.title),
-                username = COALESCE($3, chats.username),
-                chat_type = COALESCE($4, chats.chat_type),
-                last_activity = $5
-        """, chat_id, title, username, chat_type, int(time.time()))
+        await conn.execute(_UPSERT_CHAT_INFO_SQL, chat_id, title, username, chat_type, int(time.time()))
+
+
+async def _write_chat_info(rows: List[tuple]):
+    """Записать пачку обновлений чатов — по одной строке на чат"""
+    # В пачке один чат встречается много раз: берём последние непустые поля
+    merged: Dict[int, tuple] = {}
+    for chat_id, title, username, chat_type, ts in rows:
+        prev = merged.get(chat_id)
+        if prev is not None:
+            title = title if title is not None else prev[1]
+            username = username if username is not None else prev[2]
+            chat_type = chat_type if chat_type is not None else prev[3]
+        merged[chat_id] = (chat_id, title, username, chat_type, ts)
+    async with (await get_pool()).acquire() as conn:
+        await conn.executemany(_UPSERT_CHAT_INFO_SQL, list(merged.values()))
 
 
 async def get_chat_info(chat_id: int) -> Optional[Dict[str, Any]]:
@@ -1851,8 +2165,11 @@ async def get_chat_info(chat_id: int) -> Optional[Dict[str, Any]]:
         return dict(row) if row else None
 
 
-async def get_all_chats_stats() -> List[Dict[str, Any]]:
-    """Получить статистику по всем чатам с названиями"""
+async def get_all_chats_stats(limit: int = 50) -> List[Dict[str, Any]]:
+    """Получить статистику по самым активным чатам с названиями.
+
+    total_chats в каждой строке — общее число чатов (до LIMIT).
+    """
     async with (await get_pool()).acquire() as conn:
         day_ago = int(time.time()) - 86400
         week_ago = int(time.time()) - (7 * 86400)
@@ -1866,18 +2183,19 @@ async def get_all_chats_stats() -> List[Dict[str, Any]]:
                 COUNT(DISTINCT m.user_id) as unique_users,
                 COUNT(*) FILTER (WHERE m.created_at >= $1) as messages_24h,
                 COUNT(*) FILTER (WHERE m.created_at >= $2) as messages_7d,
-                MAX(m.created_at) as last_activity
+                MAX(m.created_at) as last_activity,
+                COUNT(*) OVER () as total_chats
             FROM chat_messages m
             LEFT JOIN chats c ON m.chat_id = c.chat_id
             GROUP BY m.chat_id, c.title, c.username
             ORDER BY messages_24h DESC, total_messages DESC
-            LIMIT 50
-        """, day_ago, week_ago)
+            LIMIT $3
+        """, day_ago, week_ago, limit)
         
         return [dict(row) for row in rows]
 
 
-async def get_chat_details(chat_id: int) -> Dict[str, Any]:
+async def get_chat_details(chat_id: int, top_limit: int = 10) -> Dict[str, Any]:
     """Получить детальную статистику по конкретному чату"""
     async with (await get_pool()).acquire() as conn:
         day_ago = int(time.time()) - 86400
@@ -1918,8 +2236,8 @@ async def get_chat_details(chat_id: int) -> Dict[str, Any]:
             WHERE chat_id = $1
             GROUP BY user_id, first_name, username
             ORDER BY msg_count DESC
-            LIMIT 10
-        """, chat_id)
+            LIMIT $2
+        """, chat_id, top_limit)
         stats['top_users'] = [dict(u) for u in top_users]
         
         # Количество сводок
@@ -2058,6 +2376,7 @@ async def save_media(
                 (chat_id, user_id, file_id, file_type, file_unique_id, description, caption, created_at)
                 VALUES ($1, $2, $3, $4, $5, $6, $7, $8)
             """, chat_id, user_id, file_id, file_type, unique_key, description, caption, int(time.time()))
+            _invalidate_media_caches(chat_id)
             logger.info(f"Saved media: type={file_type}, chat={chat_id}")
             return True
         except Exception as e:
@@ -2065,50 +2384,228 @@ async def save_media(
             return False
 
 
-async def get_random_media(chat_id: int, file_type: str = None) -> Optional[Dict[str, Any]]:
-    """Получить случайное медиа из коллекции чата"""
+# Вставка без дублей: тот же фильтр, что и в save_media (по file_unique_id или file_id)
+_INSERT_MEDIA_IF_NEW_SQL = """
+    INSERT INTO chat_media 
+    (chat_id, user_id, file_id, file_type, file_unique_id, description, caption, created_at)
+    SELECT $1, $2, $3, $4, $5, $6, $7, $8
+    WHERE NOT EXISTS (
+        SELECT 1 FROM chat_media 
+        WHERE chat_id = $1 AND (file_unique_id = $5 OR file_id = $3)
+    )
+    ON CONFLICT (chat_id, file_unique_id) DO NOTHING
+"""
+
+
+async def _write_media_rows(rows: List[tuple]):
+    """Записать пачку медиа одним executemany (дубли пропускаются)"""
+    async with (await get_pool()).acquire() as conn:
+        async with conn.transaction():
+            await conn.executemany(_INSERT_MEDIA_IF_NEW_SQL, rows)
+    for chat_id in {r[0] for r in rows}:
+        _invalidate_media_caches(chat_id)
+
+
+_INSERT_MEDIA_BULK_SQL = """
+    INSERT INTO chat_media 
+    (chat_id, user_id, file_id, file_type, file_unique_id, description, caption, created_at)
+    SELECT r.* FROM unnest(
+        $1::bigint[], $2::bigint[], $3::text[], $4::text[],
+        $5::text[], $6::text[], $7::text[], $8::bigint[]
+    ) AS r(chat_id, user_id, file_id, file_type, file_unique_id, description, caption, created_at)
+    WHERE NOT EXISTS (
+        SELECT 1 FROM chat_media m
+        WHERE m.chat_id = r.chat_id AND (m.file_unique_id = r.file_unique_id OR m.file_id = r.file_id)
+    )
+    ON CONFLICT (chat_id, file_unique_id) DO NOTHING
+    RETURNING chat_id
+"""
+
+
+async def save_media_bulk(rows: List[Dict[str, Any]]) -> int:
+    """Сохранить пачку медиа одним запросом (ключи — как у save_media).
+
+    Возвращает число реально добавленных строк (дубли пропускаются).
+    """
+    if not rows:
+        return 0
+    now = int(time.time())
+    columns = list(zip(*(
+        (
+            r['chat_id'], r['user_id'], r['file_id'], r['file_type'],
+            r.get('file_unique_id') or r['file_id'],
+            r.get('description'), r.get('caption'), now
+        )
+        for r in rows
+    )))
+    async with (await get_pool()).acquire() as conn:
+        try:
+            inserted = await conn.fetch(_INSERT_MEDIA_BULK_SQL, *columns)
+        except Exception as e:
+            logger.warning(f"Could not save media batch: {e}")
+            return 0
+    for chat_id in {r['chat_id'] for r in inserted}:
+        _invalidate_media_caches(chat_id)
+    logger.info(f"Saved media batch: {len(inserted)}/{len(rows)}")
+    return len(inserted)
+
+
+async def get_vk_media_keys(chat_id: int) -> set:
+    """Ключи дедупликации мемов, импортированных из VK (хранятся в caption)"""
     async with (await get_pool()).acquire() as conn:
-        if file_type:
-            row = await conn.fetchrow("""
-                SELECT * FROM chat_media 
-                WHERE chat_id = $1 AND file_type = $2 AND is_approved = 1
+        rows = await conn.fetch("""
+            SELECT caption FROM chat_media 
+            WHERE chat_id = $1 AND description LIKE 'VK:%' AND caption IS NOT NULL
+        """, chat_id)
+    return {row['caption'][:50] for row in rows}
+
+
+async def queue_media(
+    chat_id: int,
+    user_id: int,
+    file_id: str,
+    file_type: str,
+    file_unique_id: str = None,
+    description: str = None,
+    caption: str = None
+):
+    """Поставить медиа в буфер записи (как save_media, но без ожидания INSERT)"""
+    await _enqueue_write('media', (
+        chat_id, user_id, file_id, file_type, file_unique_id or file_id,
+        description, caption, int(time.time())
+    ))
+
+
+# Кэш диапазона id медиа: (chat_id, file_type) -> (expires_at, min_id, max_id, count)
+# ORDER BY RANDOM() читает и сортирует всю коллекцию чата, а вызывается на каждый
+# 15%-й мем. Для больших коллекций берём случайную точку в [min_id, max_id] и
+# идём по индексу к ближайшему id.
+MEDIA_RANGE_TTL = 300  # секунд
+MEDIA_RANDOM_SCAN_THRESHOLD = 1000  # Меньше строк — честный ORDER BY RANDOM()
+_media_range_cache: Dict[tuple, tuple] = {}
+
+
+def _invalidate_media_caches(chat_id: int):
+    """Сбросить кэши диапазонов id и статистики медиа для чата (после вставки медиа)"""
+    for key in [k for k in _media_range_cache if k[0] == chat_id]:
+        _media_range_cache.pop(key, None)
+    _media_stats_cache.pop(chat_id, None)
+
+
+def _media_queries(type_filter: str, pivot_param: str) -> Dict[str, str]:
+    """Тексты запросов get_random_media — одинаковые строки, чтобы срабатывал кэш asyncpg"""
+    return {
+        'range': f"""
+            SELECT MIN(id) AS min_id, MAX(id) AS max_id, COUNT(*) AS cnt
+            FROM chat_media
+            WHERE chat_id = $1 {type_filter} AND is_approved = 1
+        """,
+        # Выбор и учёт использования одним запросом: UPDATE ... RETURNING
+        'random': f"""
+            UPDATE chat_media 
+            SET usage_count = usage_count + 1, last_used_at = EXTRACT(EPOCH FROM NOW())::BIGINT
+            WHERE id = (
+                SELECT id FROM chat_media 
+                WHERE chat_id = $1 {type_filter} AND is_approved = 1
                 ORDER BY RANDOM()
                 LIMIT 1
-            """, chat_id, file_type)
-        else:
-            row = await conn.fetchrow("""
-                SELECT * FROM chat_media 
-                WHERE chat_id = $1 AND is_approved = 1
-                ORDER BY RANDOM()
+            )
+            RETURNING *
+        """,
+        'from_pivot': f"""
+            UPDATE chat_media 
+            SET usage_count = usage_count + 1, last_used_at = EXTRACT(EPOCH FROM NOW())::BIGINT
+            WHERE id = (
+                SELECT id FROM chat_media 
+                WHERE chat_id = $1 {type_filter} AND is_approved = 1 AND id >= {pivot_param}
+                ORDER BY id
                 LIMIT 1
-            """, chat_id)
-        
-        return dict(row) if row else None
+            )
+            RETURNING *
+        """,
+        'first': f"""
+            UPDATE chat_media 
+            SET usage_count = usage_count + 1, last_used_at = EXTRACT(EPOCH FROM NOW())::BIGINT
+            WHERE id = (
+                SELECT id FROM chat_media 
+                WHERE chat_id = $1 {type_filter} AND is_approved = 1
+                ORDER BY id
+                LIMIT 1
+            )
+            RETURNING *
+        """,
+    }
 
 
-async def get_media_stats(chat_id: int) -> Dict[str, int]:
-    """Получить статистику медиа в чате"""
+_MEDIA_SQL_ANY = _media_queries("", "$2")
+_MEDIA_SQL_TYPED = _media_queries("AND file_type = $2", "$3")
+
+_MEDIA_STATS_SQL = """
+    SELECT file_type, n AS count
+    FROM chat_media_counts
+    WHERE chat_id = $1 AND n > 0
+"""
+
+# Статистика медиа чата: chat_id -> (expires_at, stats). Гасит повторы в пачке /meme
+MEDIA_STATS_TTL = 30  # секунд
+_media_stats_cache: Dict[int, tuple] = {}
+
+async def _get_media_range(conn, chat_id: int, file_type: str = None) -> Optional[tuple]:
+    """(min_id, max_id, count) одобренных медиа чата, кэшируется на MEDIA_RANGE_TTL"""
+    key = (chat_id, file_type)
+    now = time.monotonic()
+    cached = _media_range_cache.get(key)
+    if cached and cached[0] > now:
+        return cached[1:]
+    
+    if file_type:
+        row = await conn.fetchrow(_MEDIA_SQL_TYPED['range'], chat_id, file_type)
+    else:
+        row = await conn.fetchrow(_MEDIA_SQL_ANY['range'], chat_id)
+    
+    value = (row['min_id'], row['max_id'], row['cnt'])
+    _media_range_cache[key] = (now + MEDIA_RANGE_TTL,) + value
+    return value
+
+
+async def get_random_media(chat_id: int, file_type: str = None) -> Optional[Dict[str, Any]]:
+    """Получить случайное медиа из коллекции чата и сразу засчитать его использование"""
     async with (await get_pool()).acquire() as conn:
-        rows = await conn.fetch("""
-            SELECT file_type, COUNT(*) as count
-            FROM chat_media
-            WHERE chat_id = $1 AND is_approved = 1
-            GROUP BY file_type
-        """, chat_id)
+        min_id, max_id, count = await _get_media_range(conn, chat_id, file_type)
+        if not count:
+            return None
         
-        stats = {row['file_type']: row['count'] for row in rows}
-        stats['total'] = sum(stats.values())
-        return stats
+        sql = _MEDIA_SQL_TYPED if file_type else _MEDIA_SQL_ANY
+        params = [chat_id, file_type] if file_type else [chat_id]
+        
+        if count < MEDIA_RANDOM_SCAN_THRESHOLD:
+            row = await conn.fetchrow(sql['random'], *params)
+            return dict(row) if row else None
+        
+        # Случайная точка в диапазоне → первый id не меньше неё (index range scan)
+        pivot = random.randint(min_id, max_id)
+        row = await conn.fetchrow(sql['from_pivot'], *params, pivot)
+        if not row:
+            # Хвост диапазона удалили — заходим с начала
+            row = await conn.fetchrow(sql['first'], *params)
+        
+        return dict(row) if row else None
 
 
-async def increment_media_usage(media_id: int):
-    """Увеличить счётчик использования медиа"""
+async def get_media_stats(chat_id: int) -> Dict[str, int]:
+    """Получить статистику медиа в чате (из счётчиков, кэшируется на MEDIA_STATS_TTL)"""
+    now = time.monotonic()
+    cached = _media_stats_cache.get(chat_id)
+    if cached and cached[0] > now:
+        return dict(cached[1])
+    
     async with (await get_pool()).acquire() as conn:
-        await conn.execute("""
-            UPDATE chat_media 
-            SET usage_count = usage_count + 1, last_used_at = $2
-            WHERE id = $1
-        """, media_id, int(time.time()))
+        rows = await conn.fetch(_MEDIA_STATS_SQL, chat_id)
+    
+    stats = {row['file_type']: row['count'] for row in rows}
+    stats['total'] = sum(stats.values())
+    _media_stats_cache[chat_id] = (now + MEDIA_STATS_TTL, stats)
+    return dict(stats)
 
 
 async def get_top_media(chat_id: int, limit: int = 10) -> List[Dict[str, Any]]:
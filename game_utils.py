@@ -1,26 +1,23 @@
 import random
 import time
+from bisect import bisect_right
 from typing import Dict, Any, Optional, Tuple
 from config import RANKS, CLASSES, CRIMES, ATTACK_MESSAGES
 
 
+# Пороги опыта по возрастанию (RANKS отсортирован) — ранг ищем бинарным поиском
+_RANK_THRESHOLDS = [rank['min_exp'] for rank in RANKS]
+
+
 def get_rank(experience: int) -> Dict[str, Any]:
     """Получить ранг по опыту"""
-    current_rank = RANKS[0]
-    for rank in RANKS:
-        if experience >= rank['min_exp']:
-            current_rank = rank
-        else:
-            break
-    return current_rank
+    return RANKS[max(0, bisect_right(_RANK_THRESHOLDS, experience) - 1)]
 
 
 def get_next_rank(experience: int) -> Optional[Dict[str, Any]]:
     """Получить следующий ранг"""
-    for i, rank in enumerate(RANKS):
-        if experience < rank['min_exp']:
-            return rank
-    return None
+    i = bisect_right(_RANK_THRESHOLDS, experience)
+    return RANKS[i] if i < len(RANKS) else None
 
 
 def exp_to_next_rank(experience: int) -> Tuple[int, int]:
@@ -148,6 +145,11 @@ def format_top_players(players: list, sort_by: str = "experience") -> str:
     return text
 
 
+def roll_percent(chance: float) -> bool:
+    """Бросок с вероятностью chance% — один random() вместо randint"""
+    return random.random() * 100 < chance
+
+
 def calculate_crime_success(player: Dict[str, Any], crime: Dict[str, Any]) -> bool:
     """Рассчитать успех преступления"""
     base_chance = crime['success_rate']
@@ -160,7 +162,7 @@ def calculate_crime_success(player: Dict[str, Any], crime: Dict[str, Any]) -> bo
     total_chance = base_chance + luck_bonus + class_bonus
     total_chance = min(95, max(5, total_chance))  # Между 5% и 95%
     
-    return random.randint(1, 100) <= total_chance
+    return roll_percent(total_chance)
 
 
 def calculate_crime_reward(crime: Dict[str, Any], player: Dict[str, Any]) -> int:
@@ -188,7 +190,7 @@ def calculate_pvp_success(attacker: Dict[str, Any], victim: Dict[str, Any]) -> b
     base_chance = 50 + (attack_power - defense_power) + attack_bonus + exp_diff
     base_chance = min(80, max(20, base_chance))  # Между 20% и 80%
     
-    return random.randint(1, 100) <= base_chance
+    return roll_percent(base_chance)
 
 
 def calculate_pvp_steal_amount(victim: Dict[str, Any]) -> int: